@@ -111,11 +111,40 @@ class Config(object):
         self.database_debug = False
         self.twophase_commit = False
 
+        # FileCacher.
+        # Max size of each local file cache, in MiB (None for no limit).
+        self.cache_max_size_mib = None
+        # Whether all services on a host share the same cache.
+        self.shared_cache = False
+        # Max size of the slices of a file fetched in a single query
+        # when reading it from the database, in KiB.
+        self.db_read_chunk_size_kib = 4096
+
         # Worker.
         self.keep_sandbox = True
+        # Number of files to fetch at the same time when precaching.
+        self.precache_concurrency = 4
+        # Number of jobs executed at the same time by each Worker (0
+        # for one for each CPU core).
+        self.worker_slots = 1
+        # Whether to pin the sandboxes of each slot to a CPU core.
+        self.worker_pin_slots = False
+        # Whether to run the checker of a testcase while the next one
+        # runs, in a second slot.
+        self.worker_pipelined_checker = False
+        # Number of successful compilations remembered by each Worker,
+        # to avoid running them again (0 to disable).
+        self.worker_compilation_cache_size = 0
         self.use_cgroups = True
         self.sandbox_implementation = 'isolate'
 
+        # EvaluationService.
+        # Whether to keep a journal of the queue on disk.
+        self.es_queue_journal = False
+        # Number of evaluations whose results are remembered, to reuse
+        # them for evaluations with the same inputs (0 to disable).
+        self.es_evaluation_memo_size = 0
+
         # Sandbox.
         # Max size of each writable file during an evaluation step, in KiB.
         self.max_file_size = 1048576
@@ -58,7 +58,7 @@ __all__ = [
     # base
     "metadata", "Base",
     # fsobject
-    "FSObject", "LargeObject",
+    "FSObject", "LargeObject", "LargeObjectReader",
     # contest
     "Contest", "Announcement",
     # user
@@ -101,7 +101,7 @@ from .session import Session, ScopedSession, SessionGen, \
 from .types import CastingArray, Codename, Filename, FilenameSchema, \
     FilenameSchemaArray, Digest
 from .base import Base
-from .fsobject import FSObject, LargeObject
+from .fsobject import FSObject, LargeObject, LargeObjectReader
 from .admin import Admin
 from .contest import Contest, Announcement
 from .user import User, Team, Participation, Message, Question
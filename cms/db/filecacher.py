@@ -33,18 +33,26 @@ from future.builtins.disabled import *  # noqa
 from future.builtins import *  # noqa
 
 import atexit
+import errno
+import fcntl
 import io
 import logging
 import os
+import stat
 import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
 
 import gevent
+import gevent.pool
 
 from sqlalchemy.exc import IntegrityError
 
 from cmscommon.digest import Digester
 from cms import config, mkdir, rmtree
-from cms.db import SessionGen, Digest, FSObject, LargeObject
+from cms.db import SessionGen, Digest, FSObject, LargeObject, \
+    LargeObjectReader
 
 
 logger = logging.getLogger(__name__)
@@ -80,6 +88,55 @@ def copyfileobj(source_fobj, destination_fobj,
         gevent.sleep(0)
 
 
+# The ioctl request to clone a file (sharing its extents, with
+# copy-on-write semantics) on file systems supporting it (Btrfs, XFS,
+# ...). From linux/fs.h: _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+
+def reflink(source_path, destination_path):
+    """Create a copy-on-write clone of a file, if supported.
+
+    source_path (string): the file to clone.
+    destination_path (string): the path of the clone, which must not
+        exist.
+
+    return (bool): True if the clone was created, False if the file
+        system (or the kernel) doesn't support reflinks.
+
+    raise (OSError): if the destination already exists.
+
+    """
+    fd = os.open(destination_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    try:
+        with io.open(source_path, 'rb') as source_fobj:
+            cloned = clone_fobj(source_fobj, fd)
+    except (IOError, OSError):
+        cloned = False
+    os.close(fd)
+    if not cloned:
+        os.unlink(destination_path)
+    return cloned
+
+
+def clone_fobj(source_fobj, destination_fd):
+    """Make a file a copy-on-write clone of another, if supported.
+
+    source_fobj (fileobj): the file to clone, open for reading.
+    destination_fd (int): the file descriptor of the clone, open for
+        writing.
+
+    return (bool): True if the clone was made, False if the file
+        system (or the kernel) doesn't support reflinks.
+
+    """
+    try:
+        fcntl.ioctl(destination_fd, FICLONE, source_fobj.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+
 class TombstoneError(RuntimeError):
     """An error that represents the file cacher trying to read
     files that have been deleted from the database.
@@ -88,6 +145,222 @@ class TombstoneError(RuntimeError):
     pass
 
 
+class CacheIndex(object):
+    """In-memory index of the files stored in a local cache directory.
+
+    The index records the size of each cached file and keeps the files
+    sorted by last access, so that the least recently used ones can be
+    evicted when the total size exceeds a given budget. Files can be
+    pinned (for example while they are being copied into a sandbox):
+    pinned files are never evicted.
+
+    The index is seeded by scanning the directory, so that a service
+    restarting on a warm cache doesn't lose track of its content.
+
+    If the directory is shared with other processes, pins only protect
+    files from the evictions of this process: the others are kept out
+    by the lock on the digest, which eviction only tries to take. The
+    index is then scanned again whenever the files added since the
+    last scan might have made the directory (where the other processes
+    add files too) exceed the budget.
+
+    """
+
+    # In a shared directory, fraction of the budget that can be added
+    # by this process before scanning the directory again.
+    RESCAN_FRACTION = 0.1
+
+    def __init__(self, directory, max_size=None, try_lock=None):
+        """Initialize the index.
+
+        directory (string): the directory containing the cached files,
+            named after their digest.
+        max_size (int|None): the maximum total size of the cached
+            files, in bytes; None means no limit.
+        try_lock (function|None): if the directory is shared, a
+            function that, given a digest, returns a context manager
+            trying to lock it, whose value is whether it succeeded.
+
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.try_lock = try_lock
+        # Bytes added since the last scan.
+        self._added_since_scan = 0
+
+        # Map from digest to size, from least to most recently used.
+        self._files = OrderedDict()
+        self._total_size = 0
+        # Map from digest to number of active pins.
+        self._pins = {}
+
+        self.scan()
+
+    @property
+    def total_size(self):
+        """Return the total size of the indexed files, in bytes."""
+        return self._total_size
+
+    def __contains__(self, digest):
+        return digest in self._files
+
+    def scan(self):
+        """Rebuild the index from the content of the directory.
+
+        Files are ordered by their last access (or modification, if
+        the file system doesn't record accesses) time. Entries whose
+        name starts with a dot or an underscore (temporary files and
+        directories) are ignored.
+
+        """
+        self._files = OrderedDict()
+        self._total_size = 0
+        self._added_since_scan = 0
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        entries = []
+        for name in names:
+            if name.startswith(".") or name.startswith("_"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((max(st.st_atime, st.st_mtime), name, st.st_size))
+        for _, digest, size in sorted(entries):
+            self._files[digest] = size
+            self._total_size += size
+
+    def touch(self, digest):
+        """Mark a file as just accessed.
+
+        If the file is not indexed yet (for example because someone
+        else put it in the directory) it is added to the index.
+
+        digest (unicode): the digest of the file.
+
+        """
+        if digest in self._files:
+            # Move the entry to the end (py2-compatible move_to_end).
+            self._files[digest] = self._files.pop(digest)
+        else:
+            try:
+                size = os.stat(os.path.join(self.directory, digest)).st_size
+            except OSError:
+                return
+            self.add(digest, size)
+
+    def add(self, digest, size):
+        """Record a file as just added to the directory, and evict
+        older files if the budget is exceeded.
+
+        digest (unicode): the digest of the file.
+        size (int): the size of the file, in bytes.
+
+        """
+        self.remove(digest)
+        self._files[digest] = size
+        self._total_size += size
+        self._added_since_scan += size
+        if self.try_lock is not None and self.max_size is not None \
+                and self._added_since_scan \
+                >= self.max_size * CacheIndex.RESCAN_FRACTION:
+            self.scan()
+        self.evict()
+
+    def remove(self, digest):
+        """Forget about a file (that has been removed by the caller).
+
+        digest (unicode): the digest of the file.
+
+        """
+        size = self._files.pop(digest, None)
+        if size is not None:
+            self._total_size -= size
+
+    def clear(self):
+        """Forget about all files."""
+        self._files = OrderedDict()
+        self._total_size = 0
+
+    @contextmanager
+    def pinned(self, digest):
+        """Context manager preventing the eviction of a file.
+
+        digest (unicode): the digest of the file to pin.
+
+        """
+        self.pin(digest)
+        try:
+            yield
+        finally:
+            self.unpin(digest)
+
+    def pin(self, digest):
+        """Prevent the eviction of a file until it is unpinned.
+
+        Pins are counted: a file pinned twice needs to be unpinned
+        twice.
+
+        digest (unicode): the digest of the file to pin.
+
+        """
+        self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def unpin(self, digest):
+        """Remove a pin added by pin.
+
+        digest (unicode): the digest of the file to unpin.
+
+        """
+        self._pins[digest] -= 1
+        if self._pins[digest] == 0:
+            del self._pins[digest]
+
+    def evict(self):
+        """Delete least recently used files until the total size fits
+        the budget (or only pinned files are left).
+
+        return ([unicode]): the digests of the evicted files.
+
+        """
+        evicted = []
+        if self.max_size is None or self._total_size <= self.max_size:
+            return evicted
+        for digest in list(self._files):
+            if self._total_size <= self.max_size:
+                break
+            if digest in self._pins:
+                continue
+            if self.try_lock is None:
+                self._unlink(digest)
+            else:
+                with self.try_lock(digest) as locked:
+                    # Someone else is using it.
+                    if not locked:
+                        continue
+                    self._unlink(digest)
+            self.remove(digest)
+            evicted.append(digest)
+        if len(evicted) > 0:
+            logger.debug("Evicted %d files from the cache in %s.",
+                         len(evicted), self.directory)
+        return evicted
+
+    def _unlink(self, digest):
+        """Delete a file from the directory, if it is there.
+
+        digest (unicode): the digest of the file.
+
+        """
+        try:
+            os.unlink(os.path.join(self.directory, digest))
+        except OSError:
+            pass
+
+
 class FileCacherBackend(object):
     """Abstract base class for all FileCacher backends.
 
@@ -319,7 +592,10 @@ class DBBackend(FileCacherBackend):
             if fso is None:
                 raise KeyError("File not found.")
 
-            return fso.get_lobject(mode='rb')
+            # Files are only ever read sequentially from the beginning,
+            # so we can fetch them in large slices.
+            return LargeObjectReader(
+                fso.loid, config.db_read_chunk_size_kib * 1024)
 
     def create_file(self, digest):
         """See FileCacherBackend.create_file().
@@ -485,6 +761,14 @@ class FileCacher(object):
     # CHUNK_SIZE should be a multiple of these values.
     CHUNK_SIZE = 2 ** 14  # 16348
 
+    # How long to wait (in seconds) before trying again to acquire a
+    # lock on a digest held by someone else.
+    LOCK_POLL_INTERVAL = 0.05
+
+    # Maximum number of files saved in the backend at the same time
+    # in the background (each save uses a connection to the backend).
+    BACKGROUND_SAVES = 4
+
     def __init__(self, service=None, path=None, null=False):
         """Initialize.
 
@@ -494,7 +778,8 @@ class FileCacher(object):
         service (Service|None): the service we are running for. Only
             used if present to determine the location of the
             file-system cache (and to provide the shard number to the
-            Sandbox... sigh!).
+            Sandbox... sigh!). If the shared_cache setting is enabled,
+            all services on the host use the same cache.
         path (string|None): if specified, back the FileCacher with a
             file system-based storage instead of the default
             database-based one. The specified directory will be used
@@ -506,6 +791,7 @@ class FileCacher(object):
 
         """
         self.service = service
+        self.shared = False
 
         if null:
             self.backend = NullBackend()
@@ -523,12 +809,21 @@ class FileCacher(object):
             # Delete this directory on exit since it has a random name and
             # won't be used again.
             atexit.register(lambda: rmtree(self.file_dir))
+        elif config.shared_cache:
+            # All services on the host use the same directory; loads
+            # are serialized across processes using per-digest locks.
+            self.shared = True
+            self.file_dir = os.path.join(config.cache_dir, "fs-cache-shared")
         else:
             self.file_dir = os.path.join(
                 config.cache_dir,
                 "fs-cache-%s-%d" % (service.name, service.shard))
         self._create_directory_or_die(self.file_dir)
 
+        self.lock_dir = os.path.join(self.file_dir, "_locks")
+        if self.shared:
+            self._create_directory_or_die(self.lock_dir)
+
         # Temp dir must be a subdirectory of file_dir to avoid cross-filesystem
         # moves.
         self.temp_dir = tempfile.mkdtemp(dir=self.file_dir, prefix="_temp")
@@ -536,6 +831,21 @@ class FileCacher(object):
         # Just to make sure it was created.
         self._create_directory_or_die(self.file_dir)
 
+        max_size = None
+        if config.cache_max_size_mib is not None:
+            max_size = config.cache_max_size_mib * 1024 * 1024
+        self.index = CacheIndex(
+            self.file_dir, max_size,
+            try_lock=partial(self._digest_lock, blocking=False)
+            if self.shared else None)
+
+        # The greenlets saving files in the backend in the background,
+        # the errors they met, and how many background_saves contexts
+        # are active.
+        self._saves = gevent.pool.Pool(self.BACKGROUND_SAVES)
+        self._save_errors = []
+        self._background_saves = 0
+
     @staticmethod
     def _create_directory_or_die(directory):
         """Create directory and ensure it exists, or raise a RuntimeError."""
@@ -544,12 +854,71 @@ class FileCacher(object):
             logger.error(msg)
             raise RuntimeError(msg)
 
+    @contextmanager
+    def _digest_lock(self, digest, blocking=True):
+        """Context manager holding an exclusive lock on a digest.
+
+        The lock is only taken if the cache is shared with other
+        processes, and it is a file lock, so that it works across
+        processes (and across greenlets of the same process, since
+        each acquisition opens the lock file anew, which also means
+        that it is not reentrant). While waiting we yield to the other
+        greenlets. The lock file is deleted on release if the file of
+        the digest is not in the cache.
+
+        digest (unicode): the digest to lock.
+        blocking (bool): whether to wait for the lock if someone else
+            holds it, instead of giving up.
+
+        yield (bool): whether the lock is held (or not needed).
+
+        """
+        if not self.shared:
+            yield True
+            return
+
+        lock_path = os.path.join(self.lock_dir, digest)
+        while True:
+            with io.open(lock_path, 'ab') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as error:
+                    if error.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    if not blocking:
+                        yield False
+                        return
+                    gevent.sleep(self.LOCK_POLL_INTERVAL)
+                    continue
+
+                try:
+                    # Whoever held the lock might have deleted the lock
+                    # file, and someone else might have created a new
+                    # one: then the lock we have protects nothing.
+                    try:
+                        current = os.stat(lock_path).st_ino
+                    except OSError:
+                        current = None
+                    if current != os.fstat(lock_file.fileno()).st_ino:
+                        continue
+                    yield True
+                    if not os.path.exists(
+                            os.path.join(self.file_dir, digest)):
+                        os.unlink(lock_path)
+                    return
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
     def load(self, digest, if_needed=False):
         """Load the file with the given digest into the cache.
 
         Ask the backend to provide the file and, if it's available,
         copy its content into the file-system cache.
 
+        If the cache is shared with other processes, concurrent loads
+        of the same digest are serialized, and (with if_needed) only
+        the first one actually fetches the file from the backend.
+
         digest (unicode): the digest of the file to load.
         if_needed (bool): only load the file if it is not present in
             the local cache.
@@ -562,17 +931,81 @@ class FileCacher(object):
             raise TombstoneError()
         cache_file_path = os.path.join(self.file_dir, digest)
         if if_needed and os.path.exists(cache_file_path):
+            self.index.touch(digest)
             return
 
+        with self._digest_lock(digest):
+            # Someone else might have loaded it while we were waiting.
+            if if_needed and os.path.exists(cache_file_path):
+                self.index.touch(digest)
+                return
+            self._load(digest, cache_file_path)
+
+    def load_many(self, digests, concurrency=1, if_needed=True,
+                  progress_callback=None):
+        """Load many files into the cache, fetching some concurrently.
+
+        Each concurrent fetch uses its own connection to the backend
+        (for the database backend, its own PostgreSQL connection), so
+        the concurrency should be kept small. Errors are not raised,
+        but collected and returned, so that a missing file doesn't
+        prevent the others from being loaded.
+
+        digests ([unicode]): the digests of the files to load
+            (duplicates are ignored).
+        concurrency (int): the maximum number of files to fetch at the
+            same time.
+        if_needed (bool): only load the files not present in the local
+            cache.
+        progress_callback (function|None): if given, called after each
+            file (successfully loaded or not) with the number of
+            processed files and the total number of files.
+
+        return ({unicode: Exception}): for each digest that couldn't be
+            loaded, the error that prevented it.
+
+        """
+        digests = list(OrderedDict.fromkeys(digests))
+        errors = {}
+        processed = [0]
+
+        def load_one(digest):
+            try:
+                self.load(digest, if_needed=if_needed)
+            except Exception as error:
+                errors[digest] = error
+            processed[0] += 1
+            if progress_callback is not None:
+                progress_callback(processed[0], len(digests))
+
+        pool = gevent.pool.Pool(concurrency)
+        for digest in digests:
+            pool.spawn(load_one, digest)
+        pool.join()
+
+        return errors
+
+    def _load(self, digest, cache_file_path):
+        """Copy a file from the backend into the cache.
+
+        digest (unicode): the digest of the file to load.
+        cache_file_path (string): where to put the file.
+
+        raise (KeyError): if the backend cannot find the file.
+
+        """
+
         ftmp_handle, temp_file_path = tempfile.mkstemp(dir=self.temp_dir,
                                                        text=False)
         with io.open(ftmp_handle, 'wb') as ftmp, \
                 self.backend.get_file(digest) as fobj:
             copyfileobj(fobj, ftmp, self.CHUNK_SIZE)
+            size = ftmp.tell()
 
         # Then move it to its real location (this operation is atomic
         # by POSIX requirement)
         os.rename(temp_file_path, cache_file_path)
+        self.index.add(digest, size)
 
     def get_file(self, digest):
         """Retrieve a file from the storage.
@@ -600,15 +1033,32 @@ class FileCacher(object):
 
         logger.debug("Getting file %s.", digest)
 
+        # Pin (and, if the cache is shared, lock) the file so that it
+        # cannot be evicted between the moment it is loaded and the
+        # moment it is opened.
+        with self.index.pinned(digest), self._digest_lock(digest):
+            self._load_if_needed(digest, cache_file_path)
+            return io.open(cache_file_path, 'rb')
+
+    def _load_if_needed(self, digest, cache_file_path):
+        """Make sure a file is in the cache; the caller must hold the
+        lock on its digest.
+
+        digest (unicode): the digest of the file to load.
+        cache_file_path (string): where the file is in the cache.
+
+        raise (KeyError): if the backend cannot find the file.
+
+        """
         if not os.path.exists(cache_file_path):
             logger.debug("File %s not in cache, downloading "
                          "from database.", digest)
 
-            self.load(digest)
+            self._load(digest, cache_file_path)
 
             logger.debug("File %s downloaded.", digest)
-
-        return io.open(cache_file_path, 'rb')
+        else:
+            self.index.touch(digest)
 
     def get_file_content(self, digest):
         """Retrieve a file from the storage.
@@ -645,7 +1095,7 @@ class FileCacher(object):
         """
         if digest == Digest.TOMBSTONE:
             raise TombstoneError()
-        with self.get_file(digest) as src:
+        with self.index.pinned(digest), self.get_file(digest) as src:
             copyfileobj(src, dst, self.CHUNK_SIZE)
 
     def get_file_to_path(self, digest, dst_path):
@@ -663,10 +1113,72 @@ class FileCacher(object):
         """
         if digest == Digest.TOMBSTONE:
             raise TombstoneError()
-        with self.get_file(digest) as src:
+        with self.index.pinned(digest), self.get_file(digest) as src:
             with io.open(dst_path, 'wb') as dst:
                 copyfileobj(src, dst, self.CHUNK_SIZE)
 
+    def link_file_to_path(self, digest, dst_path, allow_hard_link=True):
+        """Retrieve a file from the storage, avoiding copies if possible.
+
+        See `get_file_to_path'. The destination is created, in order of
+        preference, as a copy-on-write clone of the cached file (if the
+        file system supports reflinks), as a hard link to it (if
+        allowed) or as a plain copy. All these require the destination
+        to be on the same file system as the cache, except the last.
+
+        In all cases the destination is made read-only for everybody.
+        With a hard link it shares the inode, hence the content and the
+        permissions, with the cached file, so it must never be made
+        writable again: the caller has to ensure that whoever gets
+        access to it cannot change its permissions (that is, cannot
+        run as the user owning the cache).
+
+        digest (unicode): the digest of the file to get.
+        dst_path (string): the location on the file-system where to
+            create the file; it must not exist.
+        allow_hard_link (bool): whether a hard link may be used.
+
+        return (bool): True if the file was cloned or linked, False if
+            it had to be copied.
+
+        raise (KeyError): if the file cannot be found.
+        raise (TombstoneError): if the digest is the tombstone.
+        raise (OSError): if the destination already exists.
+
+        """
+        if digest == Digest.TOMBSTONE:
+            raise TombstoneError()
+        cache_file_path = os.path.join(self.file_dir, digest)
+        readonly = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+        with self.index.pinned(digest), self._digest_lock(digest):
+            self._load_if_needed(digest, cache_file_path)
+
+            if reflink(cache_file_path, dst_path):
+                os.chmod(dst_path, readonly)
+                logger.debug("File %s cloned to %s.", digest, dst_path)
+                return True
+
+            if allow_hard_link:
+                try:
+                    os.link(cache_file_path, dst_path)
+                except OSError as error:
+                    if error.errno == errno.EEXIST:
+                        raise
+                else:
+                    # Only now, as the cached file must keep its mode
+                    # if we fall back to copying (e.g., with EXDEV).
+                    os.chmod(dst_path, readonly)
+                    logger.debug("File %s linked to %s.", digest, dst_path)
+                    return True
+
+            fd = os.open(dst_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with io.open(fd, 'wb') as dst, \
+                    io.open(cache_file_path, 'rb') as src:
+                copyfileobj(src, dst, self.CHUNK_SIZE)
+            os.chmod(dst_path, readonly)
+            return False
+
     def save(self, digest, desc=""):
         """Save the file with the given digest into the backend.
 
@@ -689,7 +1201,10 @@ class FileCacher(object):
         if fobj is None:
             return
 
-        with io.open(cache_file_path, 'rb') as src:
+        # Once opened, the file can be evicted without harm.
+        with self._digest_lock(digest):
+            src = io.open(cache_file_path, 'rb')
+        with src:
             copyfileobj(src, fobj, self.CHUNK_SIZE)
 
         self.backend.commit_file(fobj, digest, desc)
@@ -737,6 +1252,7 @@ class FileCacher(object):
                 buf = src.read(self.CHUNK_SIZE)
             digest = d.digest()
             dst.flush()
+            size = dst.tell()
 
             logger.debug("File has digest %s.", digest)
 
@@ -750,8 +1266,11 @@ class FileCacher(object):
         # Store the file in the backend. We do that even if the file
         # was already in the cache (that is, we ignore the check above)
         # because there's a (small) chance that the file got removed
-        # from the backend but somehow remained in the cache.
-        self.save(digest, desc)
+        # from the backend but somehow remained in the cache. The file
+        # is pinned so that it isn't evicted before being saved.
+        with self.index.pinned(digest):
+            self.index.add(digest, size)
+            self.save(digest, desc)
 
         return digest
 
@@ -771,22 +1290,133 @@ class FileCacher(object):
         with io.BytesIO(content) as src:
             return self.put_file_from_fobj(src, desc)
 
-    def put_file_from_path(self, src_path, desc=""):
+    def put_file_from_path(self, src_path, desc="", trunc_len=None,
+                           background=None):
         """Store a file in the storage.
 
         See `put_file_from_fobj'. This method will read the content of
-        the file from the given file-system location.
+        the file from the given file-system location, only once: if
+        the file system supports reflinks, the copy in the cache is a
+        clone of the file and the content is read just to compute the
+        digest; otherwise the copy is written while computing it.
 
         src_path (string): an accessible location on the file-system
             from which to read the contents of the file.
         desc (unicode): the (optional) description to associate to the
             file.
+        trunc_len (int|None): if not None, store only the first
+            trunc_len bytes of the file.
+        background (bool|None): whether to save the file in the
+            backend in a new greenlet, instead of before returning (the
+            file is in the cache in any case); None to do so only
+            inside `background_saves'.
 
         return (unicode): the digest of the stored file.
 
         """
         with io.open(src_path, 'rb') as src:
-            return self.put_file_from_fobj(src, desc)
+            fd, temp_file_path = tempfile.mkstemp(dir=self.temp_dir)
+            try:
+                with io.open(fd, 'wb') as dst:
+                    d = Digester()
+                    cloned = clone_fobj(src, dst.fileno())
+                    if cloned and trunc_len is not None:
+                        dst.truncate(trunc_len)
+                    size = 0
+                    while trunc_len is None or size < trunc_len:
+                        to_read = self.CHUNK_SIZE if trunc_len is None \
+                            else min(self.CHUNK_SIZE, trunc_len - size)
+                        buf = src.read(to_read)
+                        if len(buf) == 0:
+                            break
+                        d.update(buf)
+                        size += len(buf)
+                        if not cloned:
+                            dst.write(buf)
+                        # Cooperative yield.
+                        gevent.sleep(0)
+                    digest = d.digest()
+            except:
+                os.unlink(temp_file_path)
+                raise
+
+        logger.debug("File has digest %s.", digest)
+
+        cache_file_path = os.path.join(self.file_dir, digest)
+        if not os.path.exists(cache_file_path):
+            os.rename(temp_file_path, cache_file_path)
+        else:
+            os.unlink(temp_file_path)
+
+        # As in put_file_from_fobj, we save the file even if it was
+        # already in the cache.
+        if background is None:
+            background = self._background_saves > 0
+        self.index.pin(digest)
+        self.index.add(digest, size)
+        if not background:
+            try:
+                self.save(digest, desc)
+            finally:
+                self.index.unpin(digest)
+        else:
+            self._saves.spawn(self._save_and_unpin, digest, desc)
+
+        return digest
+
+    def _save_and_unpin(self, digest, desc):
+        """Save a file in the backend and then unpin it.
+
+        Errors are recorded, to be raised by wait_for_saves.
+
+        digest (unicode): the digest of the file, already pinned.
+        desc (unicode): the description to associate to the file.
+
+        """
+        try:
+            self.save(digest, desc)
+        except Exception as error:
+            logger.error("Could not save file %s (%s) in the background.",
+                         digest, desc, exc_info=True)
+            self._save_errors.append(error)
+        finally:
+            self.index.unpin(digest)
+
+    @contextmanager
+    def background_saves(self):
+        """Context manager making put_file_from_path save the files in
+        the background, and waiting for them to be saved on exit.
+
+        raise (Exception): the error that prevented a file from being
+            saved, if any.
+
+        """
+        self._background_saves += 1
+        try:
+            yield
+        except Exception:
+            # The errors of the saves have been logged, and would hide
+            # this one.
+            self._saves.join()
+            self._save_errors = []
+            raise
+        finally:
+            self._background_saves -= 1
+        self.wait_for_saves()
+
+    def wait_for_saves(self):
+        """Wait until the files being saved in the background (see
+        `put_file_from_path') are in the backend.
+
+        raise (Exception): the error that prevented a file from being
+            saved, if any.
+
+        """
+        self._saves.join()
+        if len(self._save_errors) > 0:
+            error = self._save_errors[0]
+            self._save_errors = []
+            raise error
 
     def describe(self, digest):
         """Return the description of a file given its digest.
@@ -843,11 +1473,24 @@ class FileCacher(object):
             os.unlink(cache_file_path)
         except OSError:
             pass
+        self.index.remove(digest)
 
     def purge_cache(self):
         """Empty the local cache.
 
+        If the cache is shared with other processes, the files in use
+        by someone else are left there.
+
         """
+        if self.shared:
+            for name in os.listdir(self.file_dir):
+                if name.startswith(".") or name.startswith("_"):
+                    continue
+                with self._digest_lock(name, blocking=False) as locked:
+                    if locked:
+                        os.unlink(os.path.join(self.file_dir, name))
+            self.index.scan()
+            return
         self.destroy_cache()
         if not mkdir(config.cache_dir) or not mkdir(self.file_dir):
             logger.error("Cannot create necessary directories.")
@@ -859,8 +1502,16 @@ class FileCacher(object):
         Nothing that could have been created by this object will be
         left on disk. After that, this instance isn't usable anymore.
 
+        If the cache is shared with other processes, only the private
+        temporary directory is removed, as the cached files might be in
+        use by someone else.
+
         """
-        rmtree(self.file_dir)
+        if self.shared:
+            rmtree(self.temp_dir)
+        else:
+            rmtree(self.file_dir)
+        self.index.clear()
 
     def list(self):
         """List the files available in the storage.
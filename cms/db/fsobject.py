@@ -351,6 +351,136 @@ class LargeObject(io.RawIOBase):
             cursor.execute("SELECT lo_unlink(%(loid)s);", {'loid': loid})
 
 
+class LargeObjectReader(io.RawIOBase):
+
+    """Read a PostgreSQL large object sequentially, in large slices.
+
+    LargeObject issues a loread query for each call to readinto, hence
+    its throughput is bound by the size of the buffer of the caller
+    (usually FileCacher.CHUNK_SIZE) and by the latency of the database.
+    This class instead fetches slices of the large object with the
+    server-side function lo_get(loid, offset, length), which does not
+    even require to open the object, and serves the reads from the
+    last slice fetched. Slices start small, so that reading just the
+    beginning of a file stays cheap, and double in size at each query,
+    up to the given maximum.
+
+    Like LargeObject, this maintains its own connection to the
+    database. All reads happen in the same transaction, so they see a
+    consistent snapshot of the large object.
+
+    """
+
+    # Size of the first slice fetched (unless the caller asks for more).
+    MIN_CHUNK_SIZE = 2 ** 16
+
+    def __init__(self, loid, chunk_size):
+        """Prepare to read a large object.
+
+        loid (int): the large object ID.
+        chunk_size (int): maximum size, in bytes, of the slices fetched
+            from the database.
+
+        """
+        io.RawIOBase.__init__(self)
+
+        self.loid = loid
+        self._max_chunk_size = max(chunk_size, 1)
+        self._chunk_size = min(LargeObjectReader.MIN_CHUNK_SIZE,
+                               self._max_chunk_size)
+
+        # Offset in the large object of the end of the last slice.
+        self._offset = 0
+        # Last slice fetched, and how much of it has already been read.
+        self._slice = b""
+        self._slice_pos = 0
+        self._eof = False
+
+        self._conn = custom_psycopg2_connection()
+
+    def readable(self):
+        """See IOBase.readable().
+
+        """
+        return True
+
+    @property
+    def closed(self):
+        """See IOBase.closed().
+
+        """
+        return self._conn is None
+
+    def _fetch(self, min_length):
+        """Replace the current slice with the following one.
+
+        min_length (int): minimum number of bytes to ask for.
+
+        raise (IOError): if the database returned an error.
+
+        """
+        length = max(self._chunk_size, min_length)
+        try:
+            with self._conn.cursor() as cursor:
+                cursor.execute("SELECT lo_get(%(loid)s, %(offset)s, %(len)s);",
+                               {'loid': self.loid,
+                                'offset': self._offset,
+                                'len': length})
+                data, = cursor.fetchone()
+        except psycopg2.DatabaseError:
+            raise IOError("Couldn't read large object with LOID %s." %
+                          self.loid)
+
+        # lo_get returns less than asked only at the end of the object.
+        self._eof = len(data) < length
+        self._slice = data
+        self._slice_pos = 0
+        self._offset += len(data)
+        self._chunk_size = min(2 * self._chunk_size, self._max_chunk_size)
+
+    def readinto(self, buf):
+        """Read from the large object, and write to the given buffer.
+
+        A query is performed only if the current slice is exhausted;
+        the number of bytes returned is then bounded by the size of the
+        slice and not only by that of the buffer.
+
+        buf (bytearray): buffer into which to write data.
+
+        return (int): the number of bytes read.
+
+        raise (io.UnsupportedOperation): when the file is closed.
+
+        """
+        if self._conn is None:
+            raise io.UnsupportedOperation("Large object is closed.")
+
+        if self._slice_pos == len(self._slice):
+            if self._eof:
+                return 0
+            self._fetch(len(buf))
+
+        n = min(len(buf), len(self._slice) - self._slice_pos)
+        buf[:n] = self._slice[self._slice_pos:self._slice_pos + n]
+        self._slice_pos += n
+        return n
+
+    def close(self):
+        """Close the reader and its connection.
+
+        It is allowed to close an object more than once, with the calls
+        after the first doing nothing.
+
+        """
+        if self._conn is None:
+            return
+
+        self._conn.commit()
+        self._conn.close()
+        self._conn = None
+        self._slice = b""
+
+
 class FSObject(Base):
     """Class to describe a file stored in the database.
 
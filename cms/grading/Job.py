@@ -558,15 +558,27 @@ class EvaluationJob(Job):
         # only if it is True.
 
         sr.evaluations += [Evaluation(
-            text=self.text,
-            outcome=self.outcome,
-            execution_time=self.plus.get('execution_time'),
-            execution_wall_clock_time=self.plus.get(
+            testcase=sr.dataset.testcases[self.operation.testcase_codename],
+            **self.evaluation_values())]
+
+    def evaluation_values(self):
+        """Return the values of the evaluation resulting from the job.
+
+        return (dict): the values of the columns of the Evaluation,
+            except those identifying the submission result and the
+            testcase.
+
+        """
+        return {
+            "text": self.text,
+            "outcome": self.outcome,
+            "execution_time": self.plus.get('execution_time'),
+            "execution_wall_clock_time": self.plus.get(
                 'execution_wall_clock_time'),
-            execution_memory=self.plus.get('execution_memory'),
-            evaluation_shard=self.shard,
-            evaluation_sandbox=":".join(self.sandboxes),
-            testcase=sr.dataset.testcases[self.operation.testcase_codename])]
+            "execution_memory": self.plus.get('execution_memory'),
+            "evaluation_shard": self.shard,
+            "evaluation_sandbox": ":".join(self.sandboxes),
+        }
 
     @staticmethod
     def from_user_test(operation, user_test, dataset):
@@ -33,12 +33,15 @@ import logging
 import os
 import resource
 import select
+import shutil
 import stat
 import tempfile
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 from functools import wraps, partial
 
 import gevent
+import gevent.local
 from gevent import subprocess
 
 from cms import config, rmtree
@@ -182,6 +185,129 @@ class Truncator(io.RawIOBase):
         raise io.UnsupportedOperation('write')
 
 
+class SandboxSlot(object):
+    """A share of the resources of the machine reserved for sandboxes.
+
+    A Worker executing more than one job at a time gives each of them
+    a slot. Isolate sandboxes created while a slot is in use (by the
+    current greenlet, see use()) take their box id from the range of
+    the slot, instead of the one of the Worker, and run their processes
+    on the CPU core of the slot, if any.
+
+    The slot also keeps a pool of the isolate boxes that it initialized
+    and that are not in use anymore: sandboxes created later lease one
+    of them instead of initializing a new box, which costs more than
+    running a tiny testcase.
+
+    A slot can have a second slot, on another CPU core, where task
+    types run checkers while the first one goes on with the next
+    testcase.
+
+    """
+
+    # Number of box ids in the range of each slot; sandboxes created in
+    # the same slot cycle through them.
+    BOX_IDS_PER_SLOT = 10
+
+    _current = gevent.local.local()
+
+    def __init__(self, index, first_box_id, cpu=None):
+        """Create a slot.
+
+        index (int): index of the slot amongst those of the Worker.
+        first_box_id (int): first box id of the range of the slot.
+        cpu (int|None): CPU core to pin the sandboxed processes to, or
+            None not to pin them.
+
+        """
+        self.index = index
+        self.first_box_id = first_box_id
+        self.cpu = cpu
+        self._next_id = 0
+
+        # The slot for the checkers of the jobs in this slot, or None
+        # if they run here.
+        self.checker_slot = None
+
+        # Initialized boxes not in use, from their id to the path of
+        # their box directory.
+        self._idle_boxes = {}
+
+        # Number of boxes leased, how many of them came from the pool,
+        # and the total time spent leasing them.
+        self.leases = 0
+        self.reused_leases = 0
+        self.lease_time = 0.0
+
+    def next_box_id(self):
+        """Return the box id for a new sandbox in this slot.
+
+        return (int): a box id in the range of the slot.
+
+        """
+        box_id = self.first_box_id \
+            + self._next_id % SandboxSlot.BOX_IDS_PER_SLOT
+        self._next_id += 1
+        return box_id
+
+    def lease_box(self):
+        """Take an initialized box from the pool, if there is one.
+
+        return ((int, str)|None): the id of the box and the path of its
+            box directory, or None if the pool is empty.
+
+        """
+        if len(self._idle_boxes) == 0:
+            return None
+        return self._idle_boxes.popitem()
+
+    def return_box(self, box_id, box_path):
+        """Put an initialized box in the pool, ready to be leased.
+
+        The caller must have removed all the files of the previous
+        user of the box.
+
+        box_id (int): the id of the box.
+        box_path (str): the path of its box directory.
+
+        """
+        self._idle_boxes[box_id] = box_path
+
+    def record_lease(self, seconds, reused):
+        """Account for a box leased by a new sandbox.
+
+        seconds (float): the time it took to get the box ready.
+        reused (bool): whether the box came from the pool.
+
+        """
+        self.leases += 1
+        if reused:
+            self.reused_leases += 1
+        self.lease_time += seconds
+
+    @contextmanager
+    def use(self):
+        """Make this the slot of the sandboxes created by the current
+        greenlet, for the duration of the context.
+
+        """
+        previous = getattr(SandboxSlot._current, "slot", None)
+        SandboxSlot._current.slot = self
+        try:
+            yield self
+        finally:
+            SandboxSlot._current.slot = previous
+
+    @staticmethod
+    def current():
+        """Return the slot in use by the current greenlet.
+
+        return (SandboxSlot|None): the slot, or None if there is none.
+
+        """
+        return getattr(SandboxSlot._current, "slot", None)
+
+
 class SandboxBase(with_metaclass(ABCMeta, object)):
     """A base class for all sandboxes, meant to contain common
     resources.
@@ -195,6 +321,11 @@ class SandboxBase(with_metaclass(ABCMeta, object)):
     EXIT_TIMEOUT_WALL = 'wall timeout'
     EXIT_NONZERO_RETURN = 'nonzero return'
 
+    # Whether read-only files can be hard links to the files in the
+    # cache. This is safe only if the sandboxed processes run as a user
+    # that cannot change the permissions of the cached files.
+    HARD_LINKS_ALLOWED = False
+
     def __init__(self, file_cacher, name=None, temp_dir=None):
         """Initialization.
 
@@ -212,6 +343,10 @@ class SandboxBase(with_metaclass(ABCMeta, object)):
 
         self.cmd_file = "commands.log"
 
+        # Relative paths of the files created read-only, that might
+        # share their storage with the file cacher.
+        self.readonly_files = set()
+
         # These are not necessarily used, but are here for API compatibility
         # TODO: move all other common properties here.
         self.box_id = 0
@@ -366,14 +501,26 @@ class SandboxBase(with_metaclass(ABCMeta, object)):
         os.chmod(real_path, mod)
         return file_
 
-    def create_file_from_storage(self, path, digest, executable=False):
+    def create_file_from_storage(self, path, digest, executable=False,
+                                 readonly=False):
         """Write a file taken from FS in the sandbox.
 
         path (string): relative path of the file inside the sandbox.
         digest (string): digest of the file in FS.
         executable (bool): to set permissions.
+        readonly (bool): if True, nobody can write the file; this
+            allows to avoid copying it, by cloning or linking the copy
+            in the file cacher when possible. Ignored for executables.
 
         """
+        if readonly and not executable:
+            logger.debug("Creating read-only file %s in sandbox.", path)
+            self.file_cacher.link_file_to_path(
+                digest, self.relative_path(path),
+                allow_hard_link=self.HARD_LINKS_ALLOWED)
+            self.readonly_files.add(os.path.normpath(path))
+            return
+
         with self.create_file(path, executable) as dest_fobj:
             self.file_cacher.get_file_to_fobj(digest, dest_fobj)
 
@@ -444,6 +591,8 @@ class SandboxBase(with_metaclass(ABCMeta, object)):
     def get_file_to_storage(self, path, description="", trunc_len=None):
         """Put a sandbox file in FS and return its digest.
 
+        The file is read only once (see FileCacher.put_file_from_path).
+
         path (str): relative path of the file inside the sandbox.
         description (str): the description for FS.
         trunc_len (int|None): if None, does nothing; otherwise, before
@@ -452,8 +601,9 @@ class SandboxBase(with_metaclass(ABCMeta, object)):
         return (str): the digest of the file.
 
         """
-        with self.get_file(path, trunc_len=trunc_len) as file_:
-            return self.file_cacher.put_file_from_fobj(file_, description)
+        logger.debug("Retrieving file %s from sandbox.", path)
+        return self.file_cacher.put_file_from_path(
+            self.relative_path(path), description, trunc_len=trunc_len)
 
     def stat_file(self, path):
         """Return the stats of a file in the sandbox.
@@ -482,6 +632,29 @@ class SandboxBase(with_metaclass(ABCMeta, object)):
 
         """
         os.remove(self.relative_path(path))
+        self.readonly_files.discard(os.path.normpath(path))
+
+    def clear(self, keep=()):
+        """Delete the files in the sandbox, except some, so that it can
+        be used for another execution independent from the previous
+        ones.
+
+        keep ([str]): relative paths of the files to keep, at the top
+            level of the sandbox.
+
+        raise (OSError): if some files cannot be deleted.
+
+        """
+        keep = set(os.path.normpath(path) for path in keep)
+        for filename in os.listdir(self.relative_path("")):
+            if filename in keep:
+                continue
+            path = self.relative_path(filename)
+            if os.path.isdir(path) and not os.path.islink(path):
+                rmtree(path)
+            else:
+                os.remove(path)
+            self.readonly_files.discard(filename)
 
     @abstractmethod
     def execute_without_std(self, command, wait=False):
@@ -853,6 +1026,9 @@ class IsolateSandbox(SandboxBase):
     """
     next_id = 0
 
+    # Sandboxed processes run as a dedicated user.
+    HARD_LINKS_ALLOWED = True
+
     # If the command line starts with this command name, we are just
     # going to execute it without sandboxing, and with all permissions
     # on the current directory.
@@ -871,14 +1047,30 @@ class IsolateSandbox(SandboxBase):
         # range [0, 10) for other uses (command-line scripts like cmsMake or
         # direct console users of isolate). Inside each range ids are assigned
         # sequentially, with a wrap-around.
+        # Workers running more than one job at a time instead have a
+        # range for each of their slots (see SandboxSlot).
+        # Boxes of a slot already initialized, and released by the
+        # previous sandboxes, are reused (see SandboxSlot).
         # FIXME This is the only use of FileCacher.service, and it's an
         # improper use! Avoid it!
-        if file_cacher is not None and file_cacher.service is not None:
+        lease_start = monotonic_time()
+        slot = SandboxSlot.current()
+        leased_box = slot.lease_box() if slot is not None else None
+        if leased_box is not None:
+            box_id, self._box_path = leased_box
+        elif slot is not None:
+            box_id = slot.next_box_id()
+        elif file_cacher is not None and file_cacher.service is not None:
             box_id = ((file_cacher.service.shard + 1) * 10
                       + (IsolateSandbox.next_id % 10)) % 1000
         else:
             box_id = IsolateSandbox.next_id % 10
         IsolateSandbox.next_id += 1
+        # The slot the box is returned to when the sandbox is deleted,
+        # if any.
+        self._slot = slot
+        # CPU core the sandboxed processes are pinned to, if any.
+        self.cpu = slot.cpu if slot is not None else None
 
         # We create a directory "home" inside the outer temporary directory,
         # that will be bind-mounted to "/tmp" inside the sandbox (some
@@ -936,12 +1128,17 @@ class IsolateSandbox(SandboxBase):
         # symlink to one out of many alternatives.
         self.maybe_add_mapped_directory("/etc/alternatives")
 
-        # Tell isolate to get the sandbox ready. We do our best to cleanup
-        # after ourselves, but we might have missed something if a previous
-        # worker was interrupted in the middle of an execution, so we issue an
-        # idempotent cleanup.
-        self.cleanup()
-        self.initialize_isolate()
+        # Tell isolate to get the sandbox ready, unless the box is
+        # already. We do our best to cleanup after ourselves, but we might
+        # have missed something if a previous worker was interrupted in the
+        # middle of an execution, so we issue an idempotent cleanup.
+        if leased_box is None:
+            self._box_path = None
+            self.cleanup()
+            self.initialize_isolate()
+        if slot is not None:
+            slot.record_lease(monotonic_time() - lease_start,
+                              leased_box is not None)
 
     def add_mapped_directory(self, src, dest=None, options=None,
                              ignore_if_not_existing=False):
@@ -969,10 +1166,14 @@ class IsolateSandbox(SandboxBase):
     def allow_writing_all(self):
         """Set permissions in such a way that any operation is allowed.
 
+        Read-only files (see create_file_from_storage) are left as they
+        are, as they might share their permissions with the cache.
+
         """
         os.chmod(self._home, 0o777)
         for filename in os.listdir(self._home):
-            os.chmod(os.path.join(self._home, filename), 0o777)
+            if filename not in self.readonly_files:
+                os.chmod(os.path.join(self._home, filename), 0o777)
 
     def allow_writing_none(self):
         """Set permissions in such a way that the user cannot write anything.
@@ -980,7 +1181,20 @@ class IsolateSandbox(SandboxBase):
         """
         os.chmod(self._home, 0o755)
         for filename in os.listdir(self._home):
-            os.chmod(os.path.join(self._home, filename), 0o755)
+            if filename not in self.readonly_files:
+                os.chmod(os.path.join(self._home, filename), 0o755)
+
+    def _make_private(self, rel_path):
+        """Replace a read-only file with a private copy.
+
+        rel_path (str): relative path of the file inside the home.
+
+        """
+        path = os.path.join(self._home, rel_path)
+        temp_path = path + ".private"
+        shutil.copyfile(path, temp_path)
+        os.rename(temp_path, path)
+        self.readonly_files.discard(rel_path)
 
     def allow_writing_only(self, inner_paths):
         """Set permissions in so that the user can write only some paths.
@@ -1011,8 +1225,12 @@ class IsolateSandbox(SandboxBase):
             outer_paths.append(outer_path)
 
         # If one of the specified file do not exists, we touch it to
-        # assign the correct permissions.
+        # assign the correct permissions. If it is read-only, it might
+        # be shared with the cache, so we replace it with a copy.
         for path in outer_paths:
+            rel_path = os.path.relpath(path, self._home)
+            if rel_path in self.readonly_files:
+                self._make_private(rel_path)
             if not os.path.exists(path):
                 io.open(path, "wb").close()
 
@@ -1335,10 +1553,14 @@ class IsolateSandbox(SandboxBase):
         with io.open(self.cmd_file, 'at') as commands:
             commands.write("%s\n" % (pretty_print_cmdline(args)))
         os.chmod(self._home, prev_permissions)
+        # Isolate and the processes it runs inherit the CPU affinity.
+        preexec_fn = None
+        if self.cpu is not None:
+            preexec_fn = partial(os.sched_setaffinity, 0, [self.cpu])
         try:
             p = subprocess.Popen(args,
                                  stdin=stdin, stdout=stdout, stderr=stderr,
-                                 close_fds=close_fds)
+                                 preexec_fn=preexec_fn, close_fds=close_fds)
         except OSError:
             logger.critical("Failed to execute program in sandbox "
                             "with command: %s", pretty_print_cmdline(args),
@@ -1413,14 +1635,78 @@ class IsolateSandbox(SandboxBase):
             [self.box_exec]
             + (["--cg"] if self.cgroup else [])
             + ["--box-id=%d" % self.box_id, "--init"])
-        ret = subprocess.call(init_cmd)
+        popen = subprocess.Popen(init_cmd, stdout=subprocess.PIPE)
+        stdout, _ = popen.communicate()
+        ret = popen.returncode
         if ret != 0:
             raise SandboxInterfaceException(
                 "Failed to initialize sandbox with command: %s "
                 "(error %d)" % (pretty_print_cmdline(init_cmd), ret))
+        # Isolate prints the directory of the box, that contains the
+        # one the sandboxed processes see as their root.
+        self._box_path = os.path.join(
+            stdout.decode("utf-8").strip(), "box")
+
+    def _clear_box(self):
+        """Delete the files the sandboxed processes left in the box
+        directory, that is kept by isolate across executions.
+
+        raise (OSError): if some files cannot be deleted.
+
+        """
+        if self._box_path is None:
+            return
+        for filename in os.listdir(self._box_path):
+            path = os.path.join(self._box_path, filename)
+            if os.path.isdir(path) and not os.path.islink(path):
+                rmtree(path)
+            else:
+                os.remove(path)
+
+    def clear(self, keep=()):
+        """See SandboxBase.clear."""
+        super(IsolateSandbox, self).clear(keep)
+        self._clear_box()
+
+    def _recycle(self):
+        """Delete the files of the sandbox and return its box to the
+        pool of the slot, without cleaning it up with isolate.
+
+        The box keeps its cgroup and its mounts; only the files left
+        in it and in the home of the sandbox are removed. Isolate gives
+        them back to our user after each execution, so we can usually
+        delete them; if we cannot, the box is not reused.
+
+        return (bool): whether the box was returned to the pool.
+
+        """
+        if self._slot is None or self._box_path is None:
+            return False
+        try:
+            rmtree(self._outer_dir)
+            self._clear_box()
+        except (IOError, OSError):
+            logger.debug("Cannot recycle box %d, cleaning it up.",
+                         self.box_id, exc_info=True)
+            # Recreate what we might have deleted, for the cleanup.
+            if not os.path.isdir(self._home):
+                os.makedirs(self._home)
+            return False
+        logger.debug("Deleted sandbox in %s, box %d returned to the pool.",
+                     self._outer_dir, self.box_id)
+        self._slot.return_box(self.box_id, self._box_path)
+        self._slot = None
+        return True
 
     def cleanup(self, delete=False):
         """See Sandbox.cleanup()."""
+        # If the sandbox is deleted, its box can be reused by the next
+        # sandbox of the slot. If not (the job failed, or the admin
+        # asked to keep it), the box is cleaned up, and the next
+        # sandbox using its id will initialize it again.
+        if delete and self._recycle():
+            return
+
         # The user isolate assigns within the sandbox might have created
         # subdirectories and files therein, making the user outside the sandbox
         # unable to delete the whole tree. If the caller asked us to delete the
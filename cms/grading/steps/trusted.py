@@ -229,9 +229,10 @@ def checker_step(sandbox, checker_digest, input_digest, correct_output_digest,
                                      executable=True)
 
     # Copy input and correct output in the sandbox.
-    sandbox.create_file_from_storage(CHECKER_INPUT_FILENAME, input_digest)
+    sandbox.create_file_from_storage(CHECKER_INPUT_FILENAME, input_digest,
+                                     readonly=True)
     sandbox.create_file_from_storage(CHECKER_CORRECT_OUTPUT_FILENAME,
-                                     correct_output_digest)
+                                     correct_output_digest, readonly=True)
 
     # Execute the checker and ensure success, or log an error.
     command = ["./%s" % CHECKER_FILENAME,
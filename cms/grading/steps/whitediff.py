@@ -33,7 +33,9 @@ from __future__ import unicode_literals
 from future.builtins.disabled import *  # noqa
 from future.builtins import *  # noqa
 
+import io
 import logging
+import os
 
 from .evaluation import EVALUATION_MESSAGES
 
@@ -47,34 +49,72 @@ logger = logging.getLogger(__name__)
 _WHITES = [b' ', b'\t', b'\n', b'\x0b', b'\x0c', b'\r']
 
 
-def _white_diff_canonicalize(string):
-    """Convert the input string to a canonical form for the white diff
-    algorithm; that is, the strings a and b are mapped to the same
-    string by _white_diff_canonicalize() if and only if they have to be
-    considered equivalent for the purposes of the white-diff
-    algorithm.
+# Size of the chunks in which the files are read and compared.
+_CHUNK_SIZE = 2 ** 20
 
-    More specifically, this function strips all the leading and
-    trailing whitespaces from s and collapse all the runs of
-    consecutive whitespaces into just one copy of one specific
-    whitespace.
+# Translation table mapping every whitespace except the newline to a
+# space, so that a chunk can be tokenized with a few passes of
+# bytes.translate and bytes.replace, without looping in Python over
+# its lines or tokens.
+_TO_SPACES = bytes.maketrans(b'\t\x0b\x0c\r', b'    ')
 
-    string (str): the string to canonicalize.
-    return (str): the canonicalized string.
+
+def _white_diff_canonical_chunks(fobj):
+    """Yield, in pieces, the canonical form of a file for the white
+    diff algorithm; that is, two files are equivalent for the purposes
+    of the white-diff algorithm if and only if the concatenations of
+    the pieces yielded for them are equal.
+
+    More specifically, in the canonical form all the runs of
+    consecutive whitespaces within a line are collapsed into a single
+    space, the whitespaces at the beginning and at the end of each
+    line are removed, and so are the newlines at the end of the file.
+
+    The file is read in chunks of _CHUNK_SIZE bytes, and only the state
+    needed to join a chunk with the next one is kept between them: the
+    whitespaces at the end of a chunk (that may become a space or
+    disappear depending on what follows) and the newlines at the end
+    of what was yielded so far (that are dropped if nothing follows).
+
+    fobj (fileobj): the file to canonicalize, opened in binary mode.
+
+    yield (bytes): the pieces of the canonical form, never empty.
 
     """
-    # Replace all the whitespaces with copies of " ", making the rest
-    # of the algorithm simpler
-    for char in _WHITES[1:]:
-        string = string.replace(char, _WHITES[0])
+    # Whether the last byte processed was a newline (or none was).
+    at_line_start = True
+    # Whether the last chunk ended with a run of whitespaces.
+    space = False
+    # Number of newlines held back.
+    newlines = 0
 
-    # Split the string according to " ", filter out empty tokens and
-    # join again the string using just one copy of the first
-    # whitespace; this way, runs of more than one whitespaces are
-    # collapsed into just one copy.
-    string = _WHITES[0].join([x for x in string.split(_WHITES[0])
-                              if len(x) > 0])
-    return string
+    while True:
+        chunk = fobj.read(_CHUNK_SIZE)
+        if len(chunk) == 0:
+            return
+
+        data = chunk.translate(_TO_SPACES)
+        if space:
+            data = b' ' + data
+        # Each pass halves the runs of spaces.
+        while b'  ' in data:
+            data = data.replace(b'  ', b' ')
+        stripped = data.rstrip(b' ')
+        space = len(stripped) < len(data)
+        # Runs are now single spaces, so at most one is next to each
+        # newline.
+        data = stripped.replace(b' \n', b'\n').replace(b'\n ', b'\n')
+        if at_line_start and data.startswith(b' '):
+            data = data[1:]
+        if len(data) == 0:
+            continue
+
+        at_line_start = data.endswith(b'\n')
+        stripped = data.rstrip(b'\n')
+        if len(stripped) > 0:
+            yield b'\n' * newlines + stripped
+            newlines = 0
+        newlines += len(data) - len(stripped)
 
 
 def _white_diff(output, res):
@@ -88,34 +128,75 @@ def _white_diff(output, res):
     'sequence of characters ending with \n or EOF and beginning right
     after BOF or \n'. In particular, every line has *at most* one \n.
 
+    The comparison is done on the canonical forms of the files (see
+    _white_diff_canonical_chunks), reading both a chunk at a time, so
+    that it stops at the first difference and its memory usage does
+    not depend on the length of the files or of their lines.
+
     output (file): the first file to compare.
     res (file): the second file to compare.
     return (bool): True if the two file are equal as explained above.
 
     """
+    output_chunks = _white_diff_canonical_chunks(output)
+    res_chunks = _white_diff_canonical_chunks(res)
+    lout = lres = b''
 
     while True:
-        lout = output.readline()
-        lres = res.readline()
+        if len(lout) == 0:
+            lout = next(output_chunks, b'')
+        if len(lres) == 0:
+            lres = next(res_chunks, b'')
+
+        # At least one file finished: since the pieces are never
+        # empty, the comparison succeeded if and only if both did.
+        if len(lout) == 0 or len(lres) == 0:
+            return len(lout) == len(lres)
+
+        # Compare the common part, and keep the rest for later.
+        length = min(len(lout), len(lres))
+        if lout[:length] != lres[:length]:
+            return False
+        lout = lout[length:]
+        lres = lres[length:]
+
+
+def _exact_match(output, res):
+    """Return whether the two files are byte-for-byte identical, in
+    which case they are also equal for _white_diff.
+
+    This is a fast path for the most common case, a correct output
+    written exactly as the reference one: the sizes are compared
+    first, and only if they match are the contents compared, a chunk
+    at a time. If the files are not identical they are rewound, to be
+    compared again with _white_diff. Files whose size cannot be known
+    or that cannot be rewound (for example, those not backed by a
+    file descriptor) are never considered identical.
 
-        # Both files finished: comparison succeded
-        if len(lres) == 0 and len(lout) == 0:
-            return True
+    output (file): the first file to compare.
+    res (file): the second file to compare.
+    return (bool): True if the two files are identical.
 
-        # Only one file finished: ok if the other contains only blanks
-        elif len(lres) == 0 or len(lout) == 0:
-            lout = lout.strip(b''.join(_WHITES))
-            lres = lres.strip(b''.join(_WHITES))
-            if len(lout) > 0 or len(lres) > 0:
-                return False
+    """
+    try:
+        output_start = output.tell()
+        res_start = res.tell()
+        output_size = os.fstat(output.fileno()).st_size - output_start
+        res_size = os.fstat(res.fileno()).st_size - res_start
+    except (AttributeError, EnvironmentError, io.UnsupportedOperation):
+        return False
+    if output_size != res_size:
+        return False
 
-        # Both file still have lines to go: ok if they agree except
-        # for the number of whitespaces
-        else:
-            lout = _white_diff_canonicalize(lout)
-            lres = _white_diff_canonicalize(lres)
-            if lout != lres:
-                return False
+    while True:
+        lout = output.read(_CHUNK_SIZE)
+        lres = res.read(_CHUNK_SIZE)
+        if lout != lres:
+            output.seek(output_start)
+            res.seek(res_start)
+            return False
+        if len(lout) == 0:
+            return True
 
 
 def white_diff_fobj_step(output_fobj, correct_output_fobj):
@@ -132,7 +213,8 @@ def white_diff_fobj_step(output_fobj, correct_output_fobj):
     return ((float, [str])): the outcome as above and a description text.
 
     """
-    if _white_diff(output_fobj, correct_output_fobj):
+    if _exact_match(output_fobj, correct_output_fobj) \
+            or _white_diff(output_fobj, correct_output_fobj):
         return 1.0, [EVALUATION_MESSAGES.get("success").message]
     else:
         return 0.0, [EVALUATION_MESSAGES.get("wrong").message]
@@ -31,15 +31,18 @@ from six import iterkeys, iteritems
 
 import logging
 
+from cms import config
 from cms.grading.steps import compilation_step, evaluation_step,\
     human_evaluation_message
 from cms.grading.languagemanager import LANGUAGES, get_language
 from cms.grading.ParameterTypes import ParameterTypeCollection, \
     ParameterTypeChoice, ParameterTypeString
+from cms.grading.Sandbox import SandboxSlot
 from cms.db import Executable
 from . import TaskType, \
     check_executables_number, check_files_number, check_manager_present, \
-    create_sandbox, delete_sandbox, eval_output, is_manager_for_compilation
+    create_sandbox, delete_sandbox, eval_output, eval_output_in_background, \
+    is_manager_for_compilation
 
 
 logger = logging.getLogger(__name__)
@@ -256,9 +259,128 @@ class Batch(TaskType):
 
     def evaluate(self, job, file_cacher):
         """See TaskType.evaluate."""
-        if not check_executables_number(job, 1):
-            return
+        self.evaluate_many([job], file_cacher)
+
+    def evaluate_many(self, jobs, file_cacher):
+        """See TaskType.evaluate_many.
+
+        Consecutive jobs with the same executable (typically, on
+        different testcases of a submission) are run in the same
+        sandbox, where the executable is put only once; before each
+        job, all the other files are deleted from the sandbox. The
+        sandbox is not reused after a job that failed or that asked to
+        keep it. If an error interrupts the evaluation, the jobs not
+        evaluated yet are left with success None.
+
+        If the slot of the worker has a checker slot, the checker of a
+        job runs there while the next job runs (and, possibly, while
+        the checker of the next job starts). A job whose checker fails
+        does not keep its evaluation sandbox then, as that is already
+        in use by the next job.
+
+        """
+        sandbox = None
+        sandbox_executable = None
+
+        slot = SandboxSlot.current()
+        checker_slot = slot.checker_slot \
+            if slot is not None and self._uses_checker() else None
+        # The last job whose output is being checked, and the greenlet
+        # checking it.
+        checking = None
+
+        try:
+            for job in jobs:
+                if not check_executables_number(job, 1):
+                    continue
+                executable_filename = next(iterkeys(job.executables))
+                executable = (executable_filename,
+                              job.executables[executable_filename].digest,
+                              job.language)
+
+                if sandbox is not None and executable != sandbox_executable:
+                    delete_sandbox(sandbox)
+                    sandbox = None
+                if sandbox is not None:
+                    try:
+                        sandbox.clear(keep=[executable_filename])
+                    except (IOError, OSError):
+                        logger.warning("Couldn't clear sandbox, creating a "
+                                       "new one.", exc_info=True)
+                        delete_sandbox(sandbox)
+                        sandbox = None
+                if sandbox is None:
+                    sandbox = create_sandbox(file_cacher, name="evaluate")
+                    sandbox.create_file_from_storage(
+                        executable_filename, executable[1], executable=True)
+                    sandbox_executable = executable
+                job.sandboxes.append(sandbox.get_root_path())
+
+                check = self._evaluate_in_sandbox(
+                    job, file_cacher, sandbox, checker_slot)
+                previous = checking
+                checking = (job, check) if check is not None else None
+                if previous is not None:
+                    Batch._finish_check(*previous)
+
+                if not job.success or job.keep_sandbox or config.keep_sandbox:
+                    delete_sandbox(sandbox, job.success, job.keep_sandbox)
+                    sandbox = None
+
+            if checking is not None:
+                last, checking = checking, None
+                Batch._finish_check(*last)
+        finally:
+            # If the evaluation was interrupted, still wait for the
+            # pending checker, so that its sandbox is deleted and its
+            # results are kept, and free the box of our sandbox.
+            if checking is not None:
+                checking[1].join()
+                if checking[1].successful():
+                    Batch._finish_check(*checking)
+                else:
+                    checking[0].success = None
+            if sandbox is not None:
+                delete_sandbox(sandbox)
+
+    @staticmethod
+    def _finish_check(job, check):
+        """Wait for the checker of a job, and fill in its results.
+
+        If the checker failed, the job is left without results (with
+        success None), and the error is raised.
+
+        job (EvaluationJob): the job.
+        check (Greenlet): the greenlet running the checker, as returned
+            by eval_output_in_background.
+
+        """
+        try:
+            box_success, outcome, text = check.get()
+        except Exception:
+            # The job has no results after all.
+            job.success = None
+            raise
+        job.success = box_success
+        job.outcome = str(outcome) if outcome is not None else None
+        job.text = text
+
+    def _evaluate_in_sandbox(self, job, file_cacher, sandbox,
+                             checker_slot=None):
+        """Evaluate a job in a sandbox already holding its executable.
+
+        job (EvaluationJob): the job to evaluate, see evaluate().
+        file_cacher (FileCacher): the file cacher to use.
+        sandbox (Sandbox): the sandbox to use, containing only the
+            executable of the job.
+        checker_slot (SandboxSlot|None): if not None, the slot where to
+            run the checker in the background.
 
+        return (Greenlet|None): the greenlet running the checker, if it
+            was started in the background; the outcome and the text of
+            the job are then to be filled with _finish_check.
+
+        """
         # Prepare the execution
         executable_filename = next(iterkeys(job.executables))
         language = get_language(job.language)
@@ -266,12 +388,6 @@ class Batch(TaskType):
             if self._uses_grader() else executable_filename
         commands = language.get_evaluation_commands(
             executable_filename, main=main)
-        executables_to_get = {
-            executable_filename: job.executables[executable_filename].digest
-        }
-        files_to_get = {
-            self._actual_input: job.input
-        }
 
         # Check which redirect we need to perform, and in case we don't
         # manage the output via redirect, the submission needs to be able
@@ -286,15 +402,9 @@ class Batch(TaskType):
         else:
             files_allowing_write.append(self._actual_output)
 
-        # Create the sandbox
-        sandbox = create_sandbox(file_cacher, name="evaluate")
-        job.sandboxes.append(sandbox.get_root_path())
-
-        # Put the required files into the sandbox
-        for filename, digest in iteritems(executables_to_get):
-            sandbox.create_file_from_storage(filename, digest, executable=True)
-        for filename, digest in iteritems(files_to_get):
-            sandbox.create_file_from_storage(filename, digest)
+        # Put the input file into the sandbox
+        sandbox.create_file_from_storage(
+            self._actual_input, job.input, readonly=True)
 
         # Actually performs the execution
         box_success, evaluation_success, stats = evaluation_step(
@@ -345,7 +455,19 @@ class Batch(TaskType):
                     outcome = 0.0
                     text = [N_("Execution completed successfully")]
 
-                # Otherwise evaluate the output file.
+                # Otherwise evaluate the output file, in the background
+                # if possible.
+                elif checker_slot is not None:
+                    check = eval_output_in_background(
+                        file_cacher, job, self.CHECKER_CODENAME,
+                        user_output_path=sandbox.relative_path(
+                            self._actual_output),
+                        user_output_filename=self.output_filename,
+                        slot=checker_slot)
+                    job.success = box_success
+                    job.plus = stats
+                    return check
+
                 else:
                     box_success, outcome, text = eval_output(
                         file_cacher, job,
@@ -360,5 +482,3 @@ class Batch(TaskType):
         job.outcome = str(outcome) if outcome is not None else None
         job.text = text
         job.plus = stats
-
-        delete_sandbox(sandbox, job.success, job.keep_sandbox)
@@ -285,7 +285,7 @@ class Communication(TaskType):
         sandbox_mgr.create_file_from_storage(
             self.MANAGER_FILENAME, manager_digest, executable=True)
         sandbox_mgr.create_file_from_storage(
-            self.INPUT_FILENAME, job.input)
+            self.INPUT_FILENAME, job.input, readonly=True)
 
         # Create the user sandbox(es) and copy the executable.
         sandbox_user = [create_sandbox(file_cacher, name="user_evaluate")
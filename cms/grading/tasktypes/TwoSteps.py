@@ -251,7 +251,8 @@ class TwoSteps(TaskType):
                                                    digest,
                                                    executable=True)
         for filename, digest in iteritems(first_files_to_get):
-            first_sandbox.create_file_from_storage(filename, digest)
+            first_sandbox.create_file_from_storage(filename, digest,
+                                                   readonly=True)
 
         first = evaluation_step_before_run(
             first_sandbox,
@@ -35,7 +35,7 @@ from .abc import TaskType
 from .util import create_sandbox, delete_sandbox, \
     is_manager_for_compilation, set_configuration_error, \
     check_executables_number, check_files_number, check_manager_present, \
-    eval_output
+    eval_output, eval_output_in_background
 
 
 logger = logging.getLogger(__name__)
@@ -49,7 +49,7 @@ __all__ = [
     "create_sandbox", "delete_sandbox",
     "is_manager_for_compilation", "set_configuration_error",
     "check_executables_number", "check_files_number", "check_manager_present",
-    "eval_output",
+    "eval_output", "eval_output_in_background",
 ]
 
 
@@ -226,6 +226,23 @@ class TaskType(with_metaclass(ABCMeta, object)):
         """
         pass
 
+    def evaluate_many(self, jobs, file_cacher):
+        """Try to evaluate the given EvaluationJobs.
+
+        The result must be the same as calling evaluate() on each job;
+        task types can override this to share work amongst the jobs
+        (for example, the sandbox and the executables, for jobs on
+        different testcases of the same submission), as long as each
+        evaluation stays independent from the others.
+
+        jobs ([EvaluationJob]): the jobs to evaluate, see evaluate().
+        file_cacher (FileCacher): the file cacher to use, see
+                                  evaluate().
+
+        """
+        for job in jobs:
+            self.evaluate(job, file_cacher)
+
     def execute_job(self, job, file_cacher):
         """Call compile() or execute() depending on the job passed
         when constructing the TaskType.
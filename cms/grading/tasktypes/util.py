@@ -42,6 +42,8 @@ import logging
 import os
 import shutil
 
+import gevent
+
 from cms import config
 from cms.grading import JobException
 from cms.grading.Sandbox import Sandbox
@@ -231,6 +233,53 @@ def eval_output(file_cacher, job, checker_codename,
         able to check the solution successfully), outcome and text (both None
         if success is False).
 
+    """
+    return _start_eval_output(
+        file_cacher, job, checker_codename, user_output_path,
+        user_output_digest, user_output_filename)()
+
+
+def eval_output_in_background(file_cacher, job, checker_codename,
+                              user_output_path=None, user_output_digest=None,
+                              user_output_filename="", slot=None):
+    """Like eval_output, but run the checker in a new greenlet.
+
+    The user output is copied in the sandbox of the checker before
+    returning, so the caller can reuse its sandbox while the checker
+    runs. White diffs are computed before returning, as they would not
+    run concurrently anyway.
+
+    slot (SandboxSlot|None): the slot in which to create the sandbox of
+        the checker, or None for the slot of the current greenlet.
+
+    See eval_output for the remaining arguments.
+
+    return (Greenlet): a greenlet whose value (see get()) is the one
+        eval_output would return.
+
+    """
+    if slot is None:
+        finish = _start_eval_output(
+            file_cacher, job, checker_codename, user_output_path,
+            user_output_digest, user_output_filename)
+    else:
+        with slot.use():
+            finish = _start_eval_output(
+                file_cacher, job, checker_codename, user_output_path,
+                user_output_digest, user_output_filename)
+    return gevent.spawn(finish)
+
+
+def _start_eval_output(file_cacher, job, checker_codename,
+                       user_output_path, user_output_digest,
+                       user_output_filename):
+    """Do the part of eval_output that needs the user output.
+
+    See eval_output for the arguments.
+
+    return (function): a function without arguments doing the rest of
+        the work and returning the value of eval_output.
+
     """
     if (user_output_path is None) == (user_output_digest is None):
         raise ValueError(
@@ -242,12 +291,13 @@ def eval_output(file_cacher, job, checker_codename,
         # as if the file did not exist.
         if not os.path.exists(user_output_path) \
                 or os.path.islink(user_output_path):
-            return True, 0.0, [EVALUATION_MESSAGES.get("nooutput").message,
-                               user_output_filename]
+            return lambda: (
+                True, 0.0, [EVALUATION_MESSAGES.get("nooutput").message,
+                            user_output_filename])
 
     if checker_codename is not None:
         if not check_manager_present(job, checker_codename):
-            return False, None, None
+            return lambda: (False, None, None)
 
         # Create a brand-new sandbox just for checking.
         sandbox = create_sandbox(file_cacher, name="check")
@@ -263,14 +313,23 @@ def eval_output(file_cacher, job, checker_codename,
 
         checker_digest = job.managers[checker_codename].digest \
             if checker_codename in job.managers else None
-        success, outcome, text = checker_step(
-            sandbox, checker_digest, job.input, job.output,
-            EVAL_USER_OUTPUT_FILENAME)
 
-        delete_sandbox(sandbox, success, job.keep_sandbox)
-        return success, outcome, text
+        def run_checker():
+            success, outcome, text = checker_step(
+                sandbox, checker_digest, job.input, job.output,
+                EVAL_USER_OUTPUT_FILENAME)
+            delete_sandbox(sandbox, success, job.keep_sandbox)
+            return success, outcome, text
+
+        return run_checker
 
     else:
+        # Files in the storage are identified by the digest of their
+        # content, so there is no need to read an identical output.
+        if user_output_digest == job.output:
+            return lambda: (
+                True, 1.0, [EVALUATION_MESSAGES.get("success").message])
+
         if user_output_path is not None:
             user_output_fobj = io.open(user_output_path, "rb")
         else:
@@ -279,4 +338,4 @@ def eval_output(file_cacher, job, checker_codename,
             with file_cacher.get_file(job.output) as correct_output_fobj:
                 outcome, text = white_diff_fobj_step(
                     user_output_fobj, correct_output_fobj)
-        return True, outcome, text
+        return lambda: (True, outcome, text)
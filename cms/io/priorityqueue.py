@@ -47,6 +47,8 @@ from future.builtins.disabled import *  # noqa
 from future.builtins import *  # noqa
 from six import iteritems
 
+import heapq
+
 from gevent.event import Event
 
 from functools import total_ordering
@@ -62,6 +64,9 @@ class QueueItem(object):
 
     """
 
+    # Allow subclasses to use __slots__.
+    __slots__ = ()
+
     def to_dict(self):
         """Return a dict() representation of the object."""
         return self.__dict__
@@ -74,6 +79,8 @@ class QueueEntry(object):
 
     """
 
+    __slots__ = ("item", "priority", "timestamp", "index")
+
     def __init__(self, item, priority, timestamp, index):
         """Create a QueueEntry object.
 
@@ -83,8 +90,6 @@ class QueueEntry(object):
         index (int): used to enforce strict ordering.
 
         """
-        # TODO: item is not actually necessary, as we store the whole
-        # item in the reverse lookup array.
         self.item = item
         self.priority = priority
         self.timestamp = timestamp
@@ -108,9 +113,13 @@ class PriorityQueue(object):
     It is greenlet-safe, and offers the ability of changing priorities
     and removing arbitrary items.
 
-    The queue is implemented as a custom min-heap. The priority is a
-    mix of a discrete priority level and of the timestamp. The
-    elements of the queue are QueueItems.
+    The queue is implemented as a min-heap (managed by heapq) of
+    tuples (priority, timestamp, index, entry), so that comparisons
+    between elements happen on tuples of builtin types. Removals and
+    changes of priority are lazy: the entry in the heap is left there
+    and ignored when it reaches the top (a changed priority is pushed
+    as a new tuple), and the heap is rebuilt when most of it is made
+    of such stale tuples.
 
     """
 
@@ -120,15 +129,19 @@ class PriorityQueue(object):
     PRIORITY_LOW = 3
     PRIORITY_EXTRA_LOW = 4
 
+    # Minimum number of stale tuples in the heap before considering a
+    # rebuild (for small queues it is not worth it).
+    MIN_STALE_TO_REBUILD = 1024
+
     def __init__(self):
         """Create a priority queue."""
         # The queue: a min-heap whose elements are of the form
-        # (priority, timestamp, item), where item is the actual data.
-        self._queue = []
+        # (priority, timestamp, index, entry), some of which might be
+        # stale (see _is_live).
+        self._heap = []
 
-        # Reverse lookup for the items in the queue: a dictionary
-        # associating the index in the queue to each item.
-        self._reverse = {}
+        # The current entry of each item in the queue.
+        self._entries = {}
 
         # Event to signal that there are items in the queue.
         self._event = Event()
@@ -137,7 +150,7 @@ class PriorityQueue(object):
         self._next_index = 0
 
     def __len__(self):
-        return len(self._queue)
+        return len(self._entries)
 
     def _verify(self):
         """Make sure that the internal state of the queue is consistent.
@@ -145,16 +158,25 @@ class PriorityQueue(object):
         This is used only for testing.
 
         """
-        if len(self._queue) != len(self._reverse):
+        live = [element[3] for element in self._heap
+                if self._is_live(element)]
+        if len(live) != len(self._entries):
             return False
-        if len(self._queue) != self.length():
+        if len(self._entries) != self.length():
             return False
         if self.empty() != (self.length() == 0):
             return False
         if self._event.isSet() == self.empty():
             return False
-        for item, idx in iteritems(self._reverse):
-            if self._queue[idx].item != item:
+        for item, entry in iteritems(self._entries):
+            if entry.item != item:
+                return False
+        for element in self._heap:
+            if element[:3] != (element[3].priority, element[3].timestamp,
+                               element[3].index):
+                return False
+        for idx in range(1, len(self._heap)):
+            if self._heap[idx][:3] < self._heap[(idx - 1) // 2][:3]:
                 return False
         return True
 
@@ -166,72 +188,55 @@ class PriorityQueue(object):
         return (bool): True if item is in the queue.
 
         """
-        return item in self._reverse
+        return item in self._entries
 
-    def _swap(self, idx1, idx2):
-        """Swap two elements in the queue, keeping their reverse
-        indices up to date.
+    def _is_live(self, element):
+        """Return whether an element of the heap is still valid.
 
-        idx1 (int): the index of the first element.
-        idx2 (int): the index of the second element.
+        element ((int, datetime, int, QueueEntry)): an element of the
+            heap.
 
-        """
-        self._queue[idx1], self._queue[idx2] = \
-            self._queue[idx2], self._queue[idx1]
-        self._reverse[self._queue[idx1].item] = idx1
-        self._reverse[self._queue[idx2].item] = idx2
-
-    def _up_heap(self, idx):
-        """Take the element in position idx up in the heap until its
-        position is the right one.
-
-        idx (int): the index of the element to lift.
-
-        return (int): the new index of the element.
+        return (bool): whether the entry is the current one for its
+            item (that is, it was not removed or superseded).
 
         """
-        while idx > 0:
-            parent = (idx - 1) // 2
-            if self._queue[idx] < self._queue[parent]:
-                self._swap(parent, idx)
-                idx = parent
-            else:
-                break
-        return idx
+        entry = element[3]
+        return self._entries.get(entry.item) is entry
 
-    def _down_heap(self, idx):
-        """Take the element in position idx down in the heap until its
-        position is the right one.
+    def _new_entry(self, item, priority, timestamp):
+        """Create an entry for an item and make it the current one.
 
-        idx (int): the index of the element to lower.
+        item (QueueItem): the item.
+        priority (int): the priority.
+        timestamp (datetime): the timestamp.
 
-        return (int): the new index of the element.
+        return ((int, datetime, int, QueueEntry)): the element to add
+            to the heap.
 
         """
-        last = len(self._queue) - 1
-        while 2 * idx + 1 <= last:
-            child = 2 * idx + 1
-            if 2 * idx + 2 <= last and \
-                    self._queue[2 * idx + 2] < self._queue[child]:
-                child = 2 * idx + 2
-            if self._queue[child] < self._queue[idx]:
-                self._swap(child, idx)
-                idx = child
-            else:
-                break
-        return idx
-
-    def _updown_heap(self, idx):
-        """Perform both operations of up_heap and down_heap on an
-        element.
-
-        idx (int): the index of the element to lift.
-
-        return (int): the new index of the element.
+        index = self._next_index
+        self._next_index += 1
+        entry = QueueEntry(item, priority, timestamp, index)
+        self._entries[item] = entry
+        return (priority, timestamp, index, entry)
 
-        """
-        idx = self._up_heap(idx)
-        return self._down_heap(idx)
+    def _discard_stale_top(self):
+        """Pop the stale elements at the top of the heap."""
+        while len(self._heap) > 0 and not self._is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+
+    def _removed(self):
+        """Update the state after an entry stopped being current."""
+        if self.empty():
+            # Signal that there is nothing left for listeners.
+            self._event.clear()
+            self._heap = []
+        elif len(self._heap) - len(self._entries) > \
+                max(len(self._entries),
+                    PriorityQueue.MIN_STALE_TO_REBUILD):
+            self._heap = [element for element in self._heap
+                          if self._is_live(element)]
+            heapq.heapify(self._heap)
 
     def push(self, item, priority=None, timestamp=None):
         """Push an item in the queue. If timestamp is not specified,
@@ -247,7 +252,7 @@ class PriorityQueue(object):
             and was not pushed again, true otherwise..
 
         """
-        if item in self._reverse:
+        if item in self._entries:
             return False
 
         if priority is None:
@@ -255,19 +260,56 @@ class PriorityQueue(object):
         if timestamp is None:
             timestamp = make_datetime()
 
-        index = self._next_index
-        self._next_index += 1
-
-        self._queue.append(QueueEntry(item, priority, timestamp, index))
-        last = len(self._queue) - 1
-        self._reverse[item] = last
-        self._up_heap(last)
+        heapq.heappush(self._heap, self._new_entry(item, priority, timestamp))
 
         # Signal to listener greenlets that there might be something.
         self._event.set()
 
         return True
 
+    def push_many(self, items):
+        """Push many items in the queue.
+
+        This is equivalent to calling push on each item, but faster
+        when many items are pushed at once (for example, the heap is
+        rebuilt in linear time if it is smaller than the new items).
+
+        items ([(QueueItem, int|None, datetime|None)]): the items to
+            add to the queue, with their priority and timestamp (see
+            push for the meaning of None).
+
+        return ([QueueEntry]): the entries of the items added, that
+            is, those that were not already in the queue.
+
+        """
+        now = None
+        elements = []
+        for item, priority, timestamp in items:
+            if item in self._entries:
+                continue
+            if priority is None:
+                priority = PriorityQueue.PRIORITY_MEDIUM
+            if timestamp is None:
+                if now is None:
+                    now = make_datetime()
+                timestamp = now
+            elements.append(self._new_entry(item, priority, timestamp))
+
+        if len(elements) == 0:
+            return []
+
+        if len(elements) > len(self._heap):
+            self._heap.extend(elements)
+            heapq.heapify(self._heap)
+        else:
+            for element in elements:
+                heapq.heappush(self._heap, element)
+
+        # Signal to listener greenlets that there might be something.
+        self._event.set()
+
+        return [element[3] for element in elements]
+
     def top(self, wait=False):
         """Return the first element in the queue without extracting it.
 
@@ -278,17 +320,12 @@ class PriorityQueue(object):
         raise (LookupError): on empty queue if wait was false.
 
         """
-        if not self.empty():
-            return self._queue[0]
-        else:
+        while self.empty():
             if not wait:
                 raise LookupError("Empty queue.")
-            else:
-                while True:
-                    if self.empty():
-                        self._event.wait()
-                        continue
-                    return self._queue[0]
+            self._event.wait()
+        self._discard_stale_top()
+        return self._heap[0][3]
 
     def pop(self, wait=False):
         """Extract (and return) the first element in the queue.
@@ -301,18 +338,9 @@ class PriorityQueue(object):
 
         """
         top = self.top(wait)
-        last = len(self._queue) - 1
-        self._swap(0, last)
-
-        del self._reverse[top.item]
-        del self._queue[last]
-
-        # last is 0 when the queue becomes empty.
-        if last > 0:
-            self._down_heap(0)
-        else:
-            # Signal that there is nothing left for listeners.
-            self._event.clear()
+        heapq.heappop(self._heap)
+        del self._entries[top.item]
+        self._removed()
         return top
 
     def remove(self, item):
@@ -325,20 +353,8 @@ class PriorityQueue(object):
         raise (KeyError): if item not present.
 
         """
-        pos = self._reverse[item]
-        entry = self._queue[pos]
-
-        last = len(self._queue) - 1
-        self._swap(pos, last)
-
-        del self._reverse[item]
-        del self._queue[last]
-        if pos != last:
-            self._updown_heap(pos)
-
-        if self.empty():
-            self._event.clear()
-
+        entry = self._entries.pop(item)
+        self._removed()
         return entry
 
     def set_priority(self, item, priority):
@@ -351,9 +367,15 @@ class PriorityQueue(object):
         raise (LookupError): if item not present.
 
         """
-        pos = self._reverse[item]
-        self._queue[pos].priority = priority
-        self._updown_heap(pos)
+        old_entry = self._entries[item]
+        if old_entry.priority == priority:
+            return
+        entry = QueueEntry(item, priority, old_entry.timestamp,
+                           old_entry.index)
+        self._entries[item] = entry
+        heapq.heappush(self._heap,
+                       (priority, entry.timestamp, entry.index, entry))
+        self._removed()
 
     def length(self):
         """Return the number of elements in the queue.
@@ -361,7 +383,7 @@ class PriorityQueue(object):
         return (int): length of the queue
 
         """
-        return len(self._queue)
+        return len(self._entries)
 
     def empty(self):
         """Return if the queue is empty.
@@ -380,10 +402,11 @@ class PriorityQueue(object):
             timestamp.
 
         """
-        return [{'item': entry.item.to_dict(),
-                 'priority': entry.priority,
-                 'timestamp': make_timestamp(entry.timestamp)}
-                for entry in self._queue]
+        self._discard_stale_top()
+        return [{'item': element[3].item.to_dict(),
+                 'priority': element[3].priority,
+                 'timestamp': make_timestamp(element[3].timestamp)}
+                for element in self._heap if self._is_live(element)]
 
 
 # Fake objects for testing follow.
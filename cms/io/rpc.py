@@ -32,6 +32,7 @@ import functools
 import json
 import logging
 import socket
+import struct
 import traceback
 import uuid
 from weakref import WeakSet
@@ -40,6 +41,10 @@ import gevent
 import gevent.lock
 import gevent.socket
 import gevent.event
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 from cms import Address, get_service_address
 
@@ -47,6 +52,117 @@ from cms import Address, get_service_address
 logger = logging.getLogger(__name__)
 
 
+# Name of the pseudo-method that a client calls, with its first
+# message, to agree with the server on the transport to use. Servers
+# that do not know about it reply with an error (as no service has
+# such a method), and the connection keeps the original transport.
+NEGOTIATION_METHOD = "__negotiate_transport"
+
+# Ways of delimiting messages on the socket: the original one, where
+# each message is a line terminated by "\r\n", and one where messages
+# are split in length-prefixed binary frames.
+FRAMING_LINE = "line"
+FRAMING_BINARY = "binary"
+
+# Ways of serializing messages into bytes.
+SERIALIZATION_JSON = "json"
+SERIALIZATION_MSGPACK = "msgpack"
+
+# Header of binary frames: the ID of the message the frame is part of
+# (so that frames of different messages can be interleaved), the
+# length of the payload that follows and some flags.
+FRAME_HEADER = struct.Struct("!IIB")
+# Flag marking the last frame of a message.
+FRAME_LAST = 0x01
+
+
+def supported_serializations():
+    """Return the serializations available, most preferred first.
+
+    return ([str]): the serializations this process can handle.
+
+    """
+    if msgpack is not None:
+        return [SERIALIZATION_MSGPACK, SERIALIZATION_JSON]
+    return [SERIALIZATION_JSON]
+
+
+def encode(message, serialization):
+    """Serialize a message.
+
+    All serializations give the message the semantics of JSON: the
+    receiver gets the keys of dictionaries as strings and bytes (which
+    must be UTF-8) as text.
+
+    message (object): the message, made only of JSON-compatible types.
+    serialization (str): the serialization to use.
+
+    return (bytes): the serialized message.
+
+    raise (TypeError|ValueError): if the message cannot be serialized.
+
+    """
+    if serialization == SERIALIZATION_MSGPACK:
+        # Pack bytes as strings, to unpack them as text.
+        return msgpack.packb(message, use_bin_type=False)
+    return json.dumps(message, default=_json_default).encode('utf-8')
+
+
+def decode(data, serialization):
+    """Deserialize a message.
+
+    data (bytes): the serialized message.
+    serialization (str): the serialization used.
+
+    return (object): the message.
+
+    raise (ValueError): if the data is not a valid message.
+
+    """
+    if serialization == SERIALIZATION_MSGPACK:
+        try:
+            return msgpack.unpackb(data, **_MSGPACK_UNPACK_OPTIONS)
+        except Exception as error:
+            raise ValueError("Invalid msgpack data: %s" % error)
+    return json.loads(data.decode('utf-8'))
+
+
+def _json_default(obj):
+    """Encode as JSON the bytes, as Python 2 does, and nothing else.
+
+    obj (object): an object the JSON encoder does not support.
+
+    return (unicode): the bytes decoded as UTF-8.
+
+    raise (TypeError): if obj is not bytes.
+
+    """
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+def _json_object(pairs):
+    """Build a dictionary from msgpack as JSON would have.
+
+    pairs ([(object, object)]): the keys and values of the dictionary.
+
+    return ({unicode: object}): the dictionary, with the keys that are
+        not strings converted as JSON converts them.
+
+    """
+    return dict((key if isinstance(key, str) else str(json.dumps(key)),
+                 value) for key, value in pairs)
+
+
+if msgpack is not None:
+    _MSGPACK_UNPACK_OPTIONS = {"raw": False,
+                               "object_pairs_hook": _json_object}
+    # Newer versions only accept string keys by default.
+    if msgpack.version >= (0, 6, 1):
+        _MSGPACK_UNPACK_OPTIONS["strict_map_key"] = False
+
+
 class RPCError(Exception):
     """Generic error during RPC communication."""
     pass
@@ -83,9 +199,21 @@ class RemoteServiceBase(object):
 
     """
     # Incoming messages larger than 1 MiB are dropped to avoid DOS
-    # attacks. XXX Check that this size is sensible.
+    # attacks. XXX Check that this size is sensible. With the binary
+    # framing this bounds each frame, not the whole message.
     MAX_MESSAGE_SIZE = 1024 * 1024
 
+    # With the binary framing, limits on what the frames of incomplete
+    # messages can hold: the size of each message, the size of all of
+    # them, and their number.
+    MAX_PARTIAL_MESSAGE_SIZE = 64 * MAX_MESSAGE_SIZE
+    MAX_PARTIAL_MESSAGES_SIZE = 128 * MAX_MESSAGE_SIZE
+    MAX_PARTIAL_MESSAGES = 64
+
+    # Size of the payload of the frames into which messages are split
+    # when using the binary framing.
+    FRAME_SIZE = 256 * 1024
+
     def __init__(self, remote_address):
         """Prepare to handle a connection with the given remote address.
 
@@ -107,6 +235,16 @@ class RemoteServiceBase(object):
         self._read_lock = gevent.lock.RLock()
         self._write_lock = gevent.lock.RLock()
 
+        # The transport in use on the current connection.
+        self._framing = FRAMING_LINE
+        self._serialization = SERIALIZATION_JSON
+        # Frames received for messages not yet complete, by message ID,
+        # with their total size and their size by message ID.
+        self._partial_messages = dict()
+        self._partial_sizes = dict()
+        self._partial_size = 0
+        self._next_message_id = 0
+
     @property
     def connected(self):
         """Return whether we're connected to the other endpoint.
@@ -158,6 +296,16 @@ class RemoteServiceBase(object):
             raise RuntimeError("Already connected.")
 
         self._socket = sock
+        # Each message (or frame) is written with a single flush, so
+        # there is nothing to gain from Nagle's algorithm; instead, it
+        # would delay a request sent while a previous one is still
+        # unanswered (hence unacknowledged) by up to the delayed ACK
+        # timeout of the other end.
+        try:
+            self._socket.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            pass
         self._reader = self._socket.makefile('rb')
         self._writer = self._socket.makefile('wb')
         self._connection_event.set()
@@ -191,6 +339,11 @@ class RemoteServiceBase(object):
         self._reader = None
         self._writer = None
         self._local_address = None
+        self._framing = FRAMING_LINE
+        self._serialization = SERIALIZATION_JSON
+        self._partial_messages.clear()
+        self._partial_sizes.clear()
+        self._partial_size = 0
         self._connection_event.clear()
 
         logger.info("Terminated connection with %s (local address: %s): %s",
@@ -218,13 +371,32 @@ class RemoteServiceBase(object):
             self.finalize(reason=reason)
         return True
 
+    def _encode(self, message):
+        """Serialize a message for the current connection.
+
+        See encode.
+
+        """
+        return encode(message, self._serialization)
+
+    def _decode(self, data):
+        """Deserialize a message received on the current connection.
+
+        See decode.
+
+        """
+        return decode(data, self._serialization)
+
     def _read(self):
         """Receive a message from the socket.
 
-        Read from the socket until a "\\r\\n" is found. That is what we
-        consider a "message" in the communication protocol.
+        With the line framing, read from the socket until a "\\r\\n" is
+        found. With the binary framing, read frames until the last one
+        of a message is found. That is what we consider a "message" in
+        the communication protocol.
 
-        return (bytes): the retrieved message.
+        return (bytes): the retrieved message, or b"" if the connection
+            has been closed.
 
         raise (IOError): if reading fails.
 
@@ -236,17 +408,10 @@ class RemoteServiceBase(object):
             with self._read_lock:
                 if not self.connected:
                     raise IOError("Not connected.")
-                data = self._reader.readline(self.MAX_MESSAGE_SIZE)
-                # If there weren't a "\r\n" between the last message
-                # and the EOF we would have a false positive here.
-                # Luckily there is one.
-                if len(data) > 0 and not data.endswith(b"\r\n"):
-                    logger.error(
-                        "The client sent a message larger than %d bytes (that "
-                        "is MAX_MESSAGE_SIZE). Consider raising that value if "
-                        "the message seemed legit.", self.MAX_MESSAGE_SIZE)
-                    self.finalize("Client misbehaving.")
-                    raise IOError("Message too long.")
+                if self._framing == FRAMING_BINARY:
+                    data = self._read_frames()
+                else:
+                    data = self._read_line()
         except socket.error as error:
             if self.connected:
                 logger.warning("Failed reading from socket: %s.", error)
@@ -259,10 +424,102 @@ class RemoteServiceBase(object):
 
         return data
 
+    def _read_line(self):
+        """Read a message using the line framing.
+
+        See _read.
+
+        """
+        data = self._reader.readline(self.MAX_MESSAGE_SIZE)
+        # If there weren't a "\r\n" between the last message and the
+        # EOF we would have a false positive here. Luckily there is one.
+        if len(data) > 0 and not data.endswith(b"\r\n"):
+            logger.error(
+                "The client sent a message larger than %d bytes (that "
+                "is MAX_MESSAGE_SIZE). Consider raising that value if "
+                "the message seemed legit.", self.MAX_MESSAGE_SIZE)
+            self.finalize("Client misbehaving.")
+            raise IOError("Message too long.")
+        return data
+
+    def _read_frames(self):
+        """Read a message using the binary framing.
+
+        Frames of other messages found in the meantime are kept aside
+        until their message is complete. See _read.
+
+        """
+        while True:
+            header = self._reader.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return b""
+            message_id, length, flags = FRAME_HEADER.unpack(header)
+            if length > self.MAX_MESSAGE_SIZE:
+                logger.error(
+                    "The client sent a frame larger than %d bytes (that "
+                    "is MAX_MESSAGE_SIZE).", self.MAX_MESSAGE_SIZE)
+                self.finalize("Client misbehaving.")
+                raise IOError("Frame too long.")
+            payload = self._reader.read(length)
+            if len(payload) < length:
+                return b""
+
+            if not flags & FRAME_LAST:
+                self._buffer_frame(message_id, payload)
+                continue
+            chunks = self._partial_messages.pop(message_id, None)
+            if chunks is None:
+                return payload
+            self._partial_size -= self._partial_sizes.pop(message_id)
+            chunks.append(payload)
+            return b"".join(chunks)
+
+    def _buffer_frame(self, message_id, payload):
+        """Keep aside a frame of a message not yet complete.
+
+        message_id (int): the ID of the message.
+        payload (bytes): the content of the frame.
+
+        raise (IOError): if the frames kept aside would exceed one of
+            the MAX_PARTIAL_* limits.
+
+        """
+        if message_id not in self._partial_messages \
+                and len(self._partial_messages) \
+                >= self.MAX_PARTIAL_MESSAGES:
+            logger.error(
+                "The client sent frames for more than %d incomplete "
+                "messages (that is MAX_PARTIAL_MESSAGES).",
+                self.MAX_PARTIAL_MESSAGES)
+            self.finalize("Client misbehaving.")
+            raise IOError("Too many incomplete messages.")
+        size = self._partial_sizes.get(message_id, 0) + len(payload)
+        if size > self.MAX_PARTIAL_MESSAGE_SIZE:
+            logger.error(
+                "The client sent a message larger than %d bytes (that "
+                "is MAX_PARTIAL_MESSAGE_SIZE).",
+                self.MAX_PARTIAL_MESSAGE_SIZE)
+            self.finalize("Client misbehaving.")
+            raise IOError("Message too long.")
+        if self._partial_size + len(payload) \
+                > self.MAX_PARTIAL_MESSAGES_SIZE:
+            logger.error(
+                "The client sent incomplete messages larger than %d "
+                "bytes in total (that is MAX_PARTIAL_MESSAGES_SIZE).",
+                self.MAX_PARTIAL_MESSAGES_SIZE)
+            self.finalize("Client misbehaving.")
+            raise IOError("Incomplete messages too long.")
+
+        self._partial_messages.setdefault(message_id, []).append(payload)
+        self._partial_sizes[message_id] = size
+        self._partial_size += len(payload)
+
     def _write(self, data):
         """Send a message to the socket.
 
-        Automatically append "\\r\\n" to make it a correct message.
+        With the line framing, automatically append "\\r\\n" to make it a
+        correct message. With the binary framing, split it in frames,
+        which frames of other messages can be interleaved with.
 
         data (bytes): the message to transmit.
 
@@ -272,7 +529,8 @@ class RemoteServiceBase(object):
         if not self.connected:
             raise IOError("Not connected.")
 
-        if len(data + b'\r\n') > self.MAX_MESSAGE_SIZE:
+        if self._framing == FRAMING_LINE \
+                and len(data) + 2 > self.MAX_MESSAGE_SIZE:
             logger.error(
                 "A message wasn't sent to %r because it was larger than %d "
                 "bytes (that is MAX_MESSAGE_SIZE). Consider raising that "
@@ -282,17 +540,47 @@ class RemoteServiceBase(object):
             raise IOError("Message too long.")
 
         try:
-            with self._write_lock:
-                if not self.connected:
-                    raise IOError("Not connected.")
-                # Does the same as self._socket.sendall.
-                self._writer.write(data + b'\r\n')
-                self._writer.flush()
+            if self._framing == FRAMING_BINARY:
+                self._write_frames(data)
+            else:
+                with self._write_lock:
+                    if not self.connected:
+                        raise IOError("Not connected.")
+                    # Does the same as self._socket.sendall.
+                    self._writer.write(data + b'\r\n')
+                    self._writer.flush()
         except socket.error as error:
             self.finalize("Write failed.")
             logger.warning("Failed writing to socket: %s.", error)
             raise error
 
+    def _write_frames(self, data):
+        """Send a message using the binary framing.
+
+        See _write.
+
+        """
+        message_id = self._next_message_id
+        self._next_message_id = (message_id + 1) % 2 ** 32
+
+        view = memoryview(data)
+        start = 0
+        while True:
+            chunk = view[start:start + self.FRAME_SIZE]
+            start += len(chunk)
+            last = start >= len(view)
+            with self._write_lock:
+                if not self.connected:
+                    raise IOError("Not connected.")
+                self._writer.write(FRAME_HEADER.pack(
+                    message_id, len(chunk), FRAME_LAST if last else 0))
+                self._writer.write(chunk)
+                self._writer.flush()
+            if last:
+                break
+            # Give other messages the chance to be sent in between.
+            gevent.sleep(0)
+
 
 class RemoteServiceServer(RemoteServiceBase):
     """The server side of a RPC communication.
@@ -339,7 +627,11 @@ class RemoteServiceServer(RemoteServiceBase):
         This method won't return as long as there's something to read,
         it's therefore advisable to spawn a greenlet to call it.
 
+        The first message may be a request to negotiate the transport,
+        which is handled before reading any further.
+
         """
+        first = True
         while True:
             try:
                 data = self._read()
@@ -350,12 +642,67 @@ class RemoteServiceServer(RemoteServiceBase):
                 self.finalize("Connection closed.")
                 break
 
+            if first:
+                first = False
+                if self.negotiate(data):
+                    continue
+
             gevent.spawn(self.process_data, data)
 
+    def negotiate(self, data):
+        """Handle the message if it is a negotiation request.
+
+        Choose the first framing and the first serialization, among
+        those offered by the client, that we support, reply (still with
+        the original transport) and switch to them.
+
+        data (bytes): the first message read from the socket.
+
+        return (bool): whether the message was a negotiation request,
+            and has therefore been handled.
+
+        """
+        try:
+            request = json.loads(data.decode('utf-8'))
+            if request["__method"] != NEGOTIATION_METHOD:
+                return False
+            id_ = request["__id"]
+            framings = list(request["__data"]["framings"])
+            serializations = list(request["__data"]["serializations"])
+        except (ValueError, KeyError, TypeError):
+            # Not for us to complain, process_data will.
+            return False
+
+        response = {"__id": id_,
+                    "__data": None,
+                    "__error": None}
+
+        framing = next((f for f in framings
+                        if f in (FRAMING_BINARY, FRAMING_LINE)), None)
+        serialization = next((s for s in serializations
+                              if s in supported_serializations()), None)
+        if framing is None or serialization is None:
+            response["__error"] = "No common transport."
+        else:
+            response["__data"] = {"framing": framing,
+                                  "serialization": serialization}
+
+        try:
+            self._write(json.dumps(response).encode('utf-8'))
+        except IOError:
+            return True
+
+        if response["__error"] is None:
+            self._framing = framing
+            self._serialization = serialization
+            logger.debug("Using %s framing and %s serialization with %s.",
+                         framing, serialization, self._repr_remote())
+        return True
+
     def process_data(self, data):
         """Handle the message.
 
-        JSON-decode it and forward it to process_incoming_request
+        Decode it and forward it to process_incoming_request
         (unconditionally!).
 
         data (bytes): the message read from the socket.
@@ -363,7 +710,7 @@ class RemoteServiceServer(RemoteServiceBase):
         """
         # Decode the incoming data.
         try:
-            message = json.loads(data.decode('utf-8'))
+            message = self._decode(data)
         except ValueError:
             self.disconnect("Bad request received")
             logger.warning("Cannot parse incoming message, discarding.")
@@ -416,9 +763,9 @@ class RemoteServiceServer(RemoteServiceBase):
 
         # Encode it.
         try:
-            data = json.dumps(response).encode('utf-8')
-        except (TypeError, ValueError):
-            logger.warning("JSON encoding failed.", exc_info=True)
+            data = self._encode(response)
+        except (TypeError, ValueError, OverflowError):
+            logger.warning("Encoding failed.", exc_info=True)
             return
 
         # Send it.
@@ -443,6 +790,9 @@ class RemoteServiceClient(RemoteServiceBase):
     the reader loop should be started by calling run.
 
     """
+    # Seconds to wait for the server to reply to the negotiation.
+    NEGOTIATION_TIMEOUT = 10.0
+
     def __init__(self, remote_service_coord, auto_retry=None):
         """Create a caller for the service at the given coords.
 
@@ -484,7 +834,8 @@ class RemoteServiceClient(RemoteServiceBase):
         self.pending_outgoing_requests_results.clear()
 
     def _connect(self):
-        """Establish a connection and initialize that socket.
+        """Establish a connection, negotiate its transport and
+        initialize that socket.
 
         """
         try:
@@ -493,8 +844,72 @@ class RemoteServiceClient(RemoteServiceBase):
         except socket.error as error:
             logger.debug("Couldn't connect to %s: %s.",
                          self._repr_remote(), error)
-        else:
-            self.initialize(sock, self.remote_service_coord)
+            return
+
+        try:
+            with gevent.Timeout(self.NEGOTIATION_TIMEOUT,
+                                IOError("Timed out.")):
+                framing, serialization = self._negotiate(sock)
+        except (IOError, socket.error) as error:
+            logger.warning("Couldn't negotiate transport with %s: %s.",
+                           self._repr_remote(), error)
+            sock.close()
+            return
+
+        self._framing = framing
+        self._serialization = serialization
+        self.initialize(sock, self.remote_service_coord)
+        logger.debug("Using %s framing and %s serialization with %s.",
+                     framing, serialization, self._repr_remote())
+
+    def _negotiate(self, sock):
+        """Agree with the server on the transport to use.
+
+        Send, with the original transport, a request for the
+        negotiation pseudo-method offering all the transports we
+        support, and read the choice of the server. Servers predating
+        the negotiation reply with an error, in which case we keep the
+        original transport.
+
+        sock (socket): the newly connected socket.
+
+        return ((str, str)): the framing and the serialization to use.
+
+        raise (IOError): if the negotiation fails.
+
+        """
+        request = {"__id": uuid.uuid4().hex,
+                   "__method": NEGOTIATION_METHOD,
+                   "__data": {"framings": [FRAMING_BINARY, FRAMING_LINE],
+                              "serializations": supported_serializations()}}
+
+        reader = sock.makefile('rb')
+        writer = sock.makefile('wb')
+        try:
+            writer.write(json.dumps(request).encode('utf-8') + b'\r\n')
+            writer.flush()
+            data = reader.readline(self.MAX_MESSAGE_SIZE)
+        finally:
+            reader.close()
+            writer.close()
+
+        if not data.endswith(b"\r\n"):
+            raise IOError("Connection closed.")
+        try:
+            response = json.loads(data.decode('utf-8'))
+            if response["__id"] != request["__id"]:
+                raise ValueError("Unexpected response.")
+            if response["__error"] is not None:
+                return FRAMING_LINE, SERIALIZATION_JSON
+            framing = response["__data"]["framing"]
+            serialization = response["__data"]["serialization"]
+        except (ValueError, KeyError, TypeError):
+            raise IOError("Bad negotiation response.")
+
+        if framing not in request["__data"]["framings"] \
+                or serialization not in request["__data"]["serializations"]:
+            raise IOError("Unsupported transport chosen.")
+        return framing, serialization
 
     def _run(self):
         """Maintain the connection up, if required.
@@ -548,7 +963,7 @@ class RemoteServiceClient(RemoteServiceBase):
     def process_data(self, data):
         """Handle the message.
 
-        JSON-decode it and forward it to process_incoming_response
+        Decode it and forward it to process_incoming_response
         (unconditionally!).
 
         data (bytes): the message read from the socket.
@@ -556,7 +971,7 @@ class RemoteServiceClient(RemoteServiceBase):
         """
         # Decode the incoming data.
         try:
-            message = json.loads(data.decode('utf-8'))
+            message = self._decode(data)
         except ValueError:
             self.disconnect("Bad response received")
             logger.warning("Cannot parse incoming message, discarding.")
@@ -621,10 +1036,10 @@ class RemoteServiceClient(RemoteServiceBase):
 
         # Encode it.
         try:
-            data = json.dumps(request).encode('utf-8')
-        except (TypeError, ValueError):
-            logger.error("JSON encoding failed.", exc_info=True)
-            result.set_exception(RPCError("JSON encoding failed."))
+            data = self._encode(request)
+        except (TypeError, ValueError, OverflowError):
+            logger.error("Encoding failed.", exc_info=True)
+            result.set_exception(RPCError("Encoding failed."))
             return result
 
         # Send it.
@@ -104,6 +104,18 @@ class Executor(with_metaclass(ABCMeta, object)):  # pylint: disable=R0921
         """
         return self._operation_queue.push(item, priority, timestamp)
 
+    def enqueue_many(self, items):
+        """Add many items to the queue.
+
+        items ([(QueueItem, int|None, datetime|None)]): the items to
+            add, with their priority and timestamp (see enqueue).
+
+        return ([QueueEntry]): the entries of the items successfully
+            enqueued.
+
+        """
+        return self._operation_queue.push_many(items)
+
     def dequeue(self, item):
         """Remove an item from the queue.
 
@@ -129,7 +141,9 @@ class Executor(with_metaclass(ABCMeta, object)):  # pylint: disable=R0921
                 max_operations = self.max_operations_per_batch()
                 while not self._operation_queue.empty() and (
                         max_operations == 0 or
-                        len(to_execute) < max_operations):
+                        len(to_execute) < max_operations) and \
+                        self.fits_in_batch(to_execute,
+                                           self._operation_queue.top()):
                     to_execute.append(self._operation_queue.pop())
 
             assert len(to_execute) > 0, "Expected at least one element."
@@ -172,6 +186,22 @@ class Executor(with_metaclass(ABCMeta, object)):  # pylint: disable=R0921
         """
         return 0
 
+    def fits_in_batch(self, entries, entry):
+        """Return whether an entry can be added to a batch.
+
+        If the service has batch executions, this method is called
+        before extracting each entry from the queue after the first,
+        and the batch is closed as soon as it returns False. This
+        allows to limit batches in terms other than their length.
+
+        entries ([QueueEntry]): the entries already in the batch.
+        entry (QueueEntry): the entry at the top of the queue.
+
+        return (bool): whether to add entry to the batch.
+
+        """
+        return True
+
     @abstractmethod
     def execute(self, entry):
         """Perform a single operation.
@@ -236,6 +266,9 @@ class TriggeredService(Service):
         self._sweeper_event = Event()
         self._sweeper_started = False
         self._sweeper_timeout = None
+        # Whether the next sweep must be a full one (the first one
+        # always is).
+        self._full_sweep_requested = True
 
     def add_executor(self, executor):
         """Add an executor for the service.
@@ -273,6 +306,26 @@ class TriggeredService(Service):
                 ret += 1
         return ret
 
+    def enqueue_many(self, operations):
+        """Add many operations to the queue of each executor.
+
+        operations ([(QueueItem, int|None, datetime|None)]): the
+            operations to enqueue, with their priority and timestamp
+            (see enqueue).
+
+        return ([QueueItem]): the operations successfully added to the
+            queue of at least one executor.
+
+        """
+        ret = []
+        added = set()
+        for executor in self._executors:
+            for entry in executor.enqueue_many(operations):
+                if entry.item not in added:
+                    added.add(entry.item)
+                    ret.append(entry.item)
+        return ret
+
     def dequeue(self, operation):
         """Remove an operation from the queue of each executor.
 
@@ -331,9 +384,15 @@ class TriggeredService(Service):
 
     def _sweep(self):
         """Check for missed operations."""
-        logger.info("Start looking for missing operations.")
+        full = self._full_sweep_requested
+        self._full_sweep_requested = False
+        logger.info("Start looking for missing operations (%s sweep).",
+                    "full" if full else "incremental")
         start_time = time.time()
-        counter = self._missing_operations()
+        if full:
+            counter = self._missing_operations()
+        else:
+            counter = self._missing_operations_incremental()
         logger.info("Found %d missed operation(s) in %d ms.",
                     counter, (time.time() - start_time) * 1000)
 
@@ -348,9 +407,24 @@ class TriggeredService(Service):
         """
         return 0
 
+    def _missing_operations_incremental(self):
+        """Enqueue missed operations, looking only at recent changes.
+
+        Services for which a full search of missed operations is
+        expensive can override this to look only at what changed
+        since the previous sweep. It is used for the periodic sweeps
+        except the first one, while full sweeps are run when
+        explicitly requested.
+
+        return (int): the number of operations enqueued.
+
+        """
+        return self._missing_operations()
+
     @rpc_method
     def search_operations_not_done(self):
-        """Make the sweeper loop fire the sweeper as soon as possible."""
+        """Make the sweeper loop fire a full sweep as soon as possible."""
+        self._full_sweep_requested = True
         self._sweeper_event.set()
 
     @rpc_method
@@ -293,8 +293,8 @@ class ActivateDatasetHandler(BaseHandler):
             # unloved, but are now part of an autojudged taskset.
             self.service\
                 .evaluation_service.search_operations_not_done()
-            self.service\
-                .scoring_service.search_operations_not_done()
+            for scoring_service in self.service.scoring_services:
+                scoring_service.search_operations_not_done()
 
         # Now send notifications to contestants.
         datetime = make_datetime()
@@ -338,8 +338,8 @@ class ToggleAutojudgeDatasetHandler(BaseHandler):
             # unloved, but are now part of an autojudged taskset.
             self.service\
                 .evaluation_service.search_operations_not_done()
-            self.service\
-                .scoring_service.search_operations_not_done()
+            for scoring_service in self.service.scoring_services:
+                scoring_service.search_operations_not_done()
 
         self.write("./%d" % dataset.task_id)
 
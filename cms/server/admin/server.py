@@ -84,8 +84,9 @@ class AdminWebServer(WebService):
             ServiceCoord("AdminWebServer", 0))
         self.evaluation_service = self.connect_to(
             ServiceCoord("EvaluationService", 0))
-        self.scoring_service = self.connect_to(
-            ServiceCoord("ScoringService", 0))
+        self.scoring_services = [
+            self.connect_to(ServiceCoord("ScoringService", i))
+            for i in range(get_service_shards("ScoringService"))]
 
         ranking_enabled = len(config.rankings) > 0
         self.proxy_service = self.connect_to(
@@ -40,27 +40,35 @@ from future.builtins import *  # noqa
 from six import iterkeys, itervalues, iteritems
 
 import logging
+import os
 
 from collections import defaultdict
 from datetime import timedelta
 from functools import wraps
 
 import gevent.lock
-from sqlalchemy import func
+from sqlalchemy import func, tuple_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 
-from cms import ServiceCoord, get_service_shards
+from cms import ServiceCoord, config, get_service_shards
 from cms.io import Executor, TriggeredService, rpc_method
 from cms.db import SessionGen, Digest, Dataset, Evaluation, Submission, \
-    SubmissionResult, Testcase, UserTest, UserTestResult, get_submissions, \
-    get_submission_results, get_datasets_to_judge
-from cms.grading.Job import JobGroup
+    SubmissionResult, Task, Testcase, UserTest, UserTestResult, \
+    get_submissions, get_submission_results, get_datasets_to_judge
+from cms.grading.Job import Job, JobGroup
+from cmscommon.datetime import make_timestamp, monotonic_time
 
 from .esoperations import ESOperation, get_relevant_operations, \
-    get_submissions_operations, get_user_tests_operations, \
+    get_submissions_high_water_mark, get_submissions_operations, \
+    get_user_tests_high_water_mark, get_user_tests_operations, \
     submission_get_operations, submission_to_evaluate, \
     user_test_get_operations
+from .costestimator import OperationCostEstimator
+from .evaluationmemo import EvaluationMemo
 from .flushingdict import FlushingDict
+from .queuejournal import QueueJournal
+from .scoringoperations import get_scoring_shard
 from .workerpool import WorkerPool
 
 
@@ -69,8 +77,20 @@ logger = logging.getLogger(__name__)
 
 class EvaluationExecutor(Executor):
 
-    # Real maximum number of operations to be sent to a worker.
-    MAX_OPERATIONS_PER_BATCH = 25
+    # Real maximum number of operations to be sent to each slot of a
+    # worker.
+    MAX_OPERATIONS_PER_BATCH = 100
+
+    # Estimated time (in seconds) that each slot of a worker should
+    # spend on a batch; operations are added to a batch until this is
+    # reached, but each slot gets at least one, however expensive.
+    TARGET_BATCH_TIME = 2.0
+
+    # Estimated time (in seconds) of operations never seen before,
+    # and estimated time spent by a worker on each operation besides
+    # the wall time of the sandboxes it reports.
+    DEFAULT_OPERATION_COST = 1.0
+    OPERATION_OVERHEAD = 0.05
 
     def __init__(self, evaluation_service):
         """Create the single executor for ES.
@@ -90,6 +110,19 @@ class EvaluationExecutor(Executor):
         # Lock used to guard the currently executing operations
         self._current_execution_lock = gevent.lock.RLock()
 
+        # Number of operations to send to each slot of a worker, as
+        # last computed by max_operations_per_batch.
+        self._operations_per_slot = 1
+
+        # Estimate of the cost of operations, from the results of the
+        # past ones.
+        self.cost_estimator = OperationCostEstimator(
+            EvaluationExecutor.DEFAULT_OPERATION_COST,
+            overhead=EvaluationExecutor.OPERATION_OVERHEAD)
+        # Estimated cost of the batch being built, kept up to date by
+        # fits_in_batch.
+        self._batch_cost = 0.0
+
         for i in range(get_service_shards("Worker")):
             worker = ServiceCoord("Worker", i)
             self.pool.add_worker(worker)
@@ -111,28 +144,92 @@ class EvaluationExecutor(Executor):
     def max_operations_per_batch(self):
         """Return the maximum number of operations per batch.
 
-        We derive the number from the length of the queue divided by
-        the number of workers, with a cap at MAX_OPERATIONS_PER_BATCH.
+        We derive the number of operations for each slot from the
+        length of the queue divided by the number of slots over all
+        workers, with a cap at MAX_OPERATIONS_PER_BATCH. A batch is
+        large enough for the worker with most slots; workers with
+        fewer slots receive only part of it (see execute).
 
         """
-        # TODO: len(self.pool) is the total number of workers,
-        # included those that are disabled.
-        ratio = len(self._operation_queue) // len(self.pool) + 1
-        ret = min(max(ratio, 1), EvaluationExecutor.MAX_OPERATIONS_PER_BATCH)
-        logger.info("Ratio is %d, executing %d operations together.",
-                    ratio, ret)
+        ratio = len(self._operation_queue) \
+            // max(self.pool.total_slots(), 1) + 1
+        self._operations_per_slot = \
+            min(max(ratio, 1), EvaluationExecutor.MAX_OPERATIONS_PER_BATCH)
+        ret = self._operations_per_slot * self.pool.max_slots()
+        logger.info("Ratio is %d, executing at most %d operations "
+                    "together.", ratio, ret)
         return ret
 
+    def fits_in_batch(self, entries, entry):
+        """Return whether an entry can be added to a batch.
+
+        The batch must not exceed TARGET_BATCH_TIME for each slot of
+        the worker with most slots. The cost of the batch is kept
+        across calls, as the batch grows by one entry (the one just
+        accepted) at a time, and starts again from its first entry.
+
+        """
+        if len(entries) == 1:
+            self._batch_cost = self.cost_estimator.estimate(entries[0].item)
+        entry_cost = self.cost_estimator.estimate(entry.item)
+        if not self._fits(len(entries), self._batch_cost, entry_cost,
+                          self.pool.max_slots()):
+            return False
+        self._batch_cost += entry_cost
+        return True
+
+    def _batch_length(self, operations, slots):
+        """Return how many operations to give to a worker.
+
+        operations ([ESOperation]): the operations to execute.
+        slots (int): the number of slots of the worker.
+
+        return (int): the length of the longest prefix of operations
+            with at most _operations_per_slot operations for each slot
+            and not exceeding TARGET_BATCH_TIME for each slot.
+
+        """
+        max_length = self._operations_per_slot * slots
+        length = 0
+        cost = 0.0
+        for operation in operations[:max_length]:
+            operation_cost = self.cost_estimator.estimate(operation)
+            if not self._fits(length, cost, operation_cost, slots):
+                break
+            length += 1
+            cost += operation_cost
+        return length
+
+    @staticmethod
+    def _fits(length, cost, operation_cost, slots):
+        """Return whether an operation can be added to a batch.
+
+        length (int): the number of operations in the batch.
+        cost (float): the estimated cost of the batch.
+        operation_cost (float): the estimated cost of the operation.
+        slots (int): the number of slots of the worker.
+
+        return (bool): whether the operation fits.
+
+        """
+        budget = EvaluationExecutor.TARGET_BATCH_TIME * slots
+        return length < slots or cost + operation_cost <= budget
+
     def execute(self, entries):
         """Execute a batch of operations in the queue.
 
         The operations might not be executed immediately because of
-        lack of workers.
+        lack of workers, and might be split among several workers
+        depending on their number of slots. Workers on hosts that
+        recently used the dataset of the operations (and therefore
+        probably have its files in cache) are preferred.
 
         entries ([QueueEntry]): entries containing the operations to
             perform.
 
         """
+        if self.evaluation_service.evaluation_memo is not None:
+            entries = self.evaluation_service.execute_from_memo(entries)
         with self._current_execution_lock:
             self._currently_executing = []
             for entry in entries:
@@ -148,10 +245,23 @@ class EvaluationExecutor(Executor):
             with self._current_execution_lock:
                 if len(self._currently_executing) == 0:
                     break
-                res = self.pool.acquire_worker(self._currently_executing)
+                res = self.pool.acquire_worker(
+                    self._currently_executing,
+                    batch_length=self._batch_length,
+                    preferred_hosts=self.pool.warm_hosts(
+                        self._currently_executing[0].dataset_id))
                 if res is not None:
-                    self._currently_executing = []
-                    break
+                    dispatched = [
+                        operation
+                        for operation in self._currently_executing
+                        if operation in self.pool]
+                    self._currently_executing = [
+                        operation
+                        for operation in self._currently_executing
+                        if operation not in self.pool]
+                    journal = self.evaluation_service.journal
+                    if journal is not None:
+                        journal.dispatched(dispatched, res)
 
     def dequeue(self, operation):
         """Remove an item from the queue.
@@ -223,6 +333,10 @@ class EvaluationService(TriggeredService):
     # The maximum time since the last result before processing.
     MAX_FLUSHING_TIME_SECONDS = 2
 
+    # How often the periodic sweep looks at all submissions and user
+    # tests, instead of only at those that changed.
+    FULL_SWEEP_INTERVAL = timedelta(hours=1)
+
     def __init__(self, shard, contest_id=None):
         super(EvaluationService, self).__init__(shard)
 
@@ -258,10 +372,30 @@ class EvaluationService(TriggeredService):
         # operations in state 4.
         self.post_finish_lock = gevent.lock.RLock()
 
-        self.scoring_service = self.connect_to(
-            ServiceCoord("ScoringService", 0))
-
+        # The highest ids of submission and user test seen by the
+        # last full sweep, and when that started (None if it never
+        # ran); incremental sweeps look only at newer objects and at
+        # those with results still to compile or evaluate.
+        self._submissions_high_water_mark = None
+        self._user_tests_high_water_mark = None
+        self._last_full_sweep = None
+
+        # The shards of ScoringService; see get_scoring_shard.
+        self.scoring_services = [
+            self.connect_to(ServiceCoord("ScoringService", i))
+            for i in range(get_service_shards("ScoringService"))]
+
+        # Results of earlier evaluations, to fill those with the same
+        # inputs without sending them to a worker (None if disabled).
+        self.evaluation_memo = None
+        if config.es_evaluation_memo_size > 0:
+            self.evaluation_memo = EvaluationMemo(
+                config.es_evaluation_memo_size)
+
+        self.journal = None
         self.add_executor(EvaluationExecutor(self))
+        if config.es_queue_journal:
+            self._load_journal()
         self.start_sweeper(117.0)
 
         self.add_timeout(self.check_workers_timeout, None,
@@ -273,6 +407,139 @@ class EvaluationService(TriggeredService):
                          .total_seconds(),
                          immediately=False)
 
+    def _load_journal(self):
+        """Put back in the queue the operations in the journal.
+
+        The operations that were assigned to a worker are enqueued
+        again, as their results would be sent to the previous
+        instance. If the journal has the high-water marks of a full
+        sweep, and the next one is not due yet, the first sweep is
+        incremental: it then only checks the consistency of the
+        journal with the database. Otherwise, since what changed while
+        we were not running is unknown, it is a full one.
+
+        """
+        self.journal = QueueJournal(
+            os.path.join(config.data_dir,
+                         "%s-%d-journal" % (self.name, self.shard)),
+            self.contest_id)
+        entries = self.journal.load()
+        to_do = self._operations_to_do(
+            [operation for operation, _, _, _ in entries])
+        self.journal.completed(
+            [operation for operation, _, _, _ in entries
+             if operation not in to_do])
+        logger.info("Restoring %d operations from the queue journal "
+                    "(%d no longer to do).", len(to_do),
+                    len(entries) - len(to_do))
+        with self.post_finish_lock:
+            for operation, priority, timestamp, _ in entries:
+                if operation in to_do:
+                    self.enqueue(operation, priority, timestamp)
+            if self.journal.high_water_marks is not None \
+                    and self.journal.full_sweep_time is not None:
+                elapsed = make_timestamp() - self.journal.full_sweep_time
+                if 0 <= elapsed < \
+                        EvaluationService.FULL_SWEEP_INTERVAL.total_seconds():
+                    self._submissions_high_water_mark, \
+                        self._user_tests_high_water_mark = \
+                        self.journal.high_water_marks
+                    self._last_full_sweep = monotonic_time() - elapsed
+                    self._full_sweep_requested = False
+
+    def _operations_to_do(self, operations):
+        """Return which of the given operations are still to do.
+
+        An operation is still to do if it would be enqueued now for
+        its submission or user test (see submission_enqueue_operations
+        and user_test_enqueue_operations). The objects involved are
+        loaded with a few queries, and then checked in memory.
+
+        operations ([ESOperation]): the operations to check.
+
+        return ({ESOperation}): the operations still to do.
+
+        """
+        to_do = set()
+        if len(operations) == 0:
+            return to_do
+
+        dataset_ids = set(operation.dataset_id for operation in operations)
+        submission_keys = set((operation.object_id, operation.dataset_id)
+                              for operation in operations
+                              if operation.for_submission())
+        user_test_keys = set((operation.object_id, operation.dataset_id)
+                             for operation in operations
+                             if not operation.for_submission())
+
+        with SessionGen() as session:
+            datasets = dict(
+                (dataset.id, dataset) for dataset in session.query(Dataset)
+                .options(joinedload(Dataset.task),
+                         selectinload(Dataset.testcases))
+                .filter(Dataset.id.in_(dataset_ids)))
+            # The ids of the datasets to judge, by task.
+            judged = dict()
+
+            def to_judge(obj, dataset_id):
+                dataset = datasets.get(dataset_id)
+                if obj is None or dataset is None \
+                        or obj.task_id != dataset.task_id:
+                    return None
+                if dataset.task_id not in judged:
+                    judged[dataset.task_id] = set(
+                        d.id for d in get_datasets_to_judge(dataset.task))
+                if dataset_id not in judged[dataset.task_id]:
+                    return None
+                return dataset
+
+            if len(submission_keys) > 0:
+                submissions = dict(
+                    (submission.id, submission)
+                    for submission in session.query(Submission)
+                    .filter(Submission.id.in_(
+                        set(object_id for object_id, _ in submission_keys))))
+                results = dict(
+                    ((result.submission_id, result.dataset_id), result)
+                    for result in session.query(SubmissionResult)
+                    .options(selectinload(SubmissionResult.evaluations))
+                    .filter(tuple_(SubmissionResult.submission_id,
+                                   SubmissionResult.dataset_id)
+                            .in_(submission_keys)))
+                for key in submission_keys:
+                    submission = submissions.get(key[0])
+                    dataset = to_judge(submission, key[1])
+                    if dataset is None:
+                        continue
+                    to_do.update(
+                        operation for operation, _, _
+                        in submission_get_operations(
+                            results.get(key), submission, dataset))
+
+            if len(user_test_keys) > 0:
+                user_tests = dict(
+                    (user_test.id, user_test)
+                    for user_test in session.query(UserTest)
+                    .filter(UserTest.id.in_(
+                        set(object_id for object_id, _ in user_test_keys))))
+                results = dict(
+                    ((result.user_test_id, result.dataset_id), result)
+                    for result in session.query(UserTestResult)
+                    .filter(tuple_(UserTestResult.user_test_id,
+                                   UserTestResult.dataset_id)
+                            .in_(user_test_keys)))
+                for key in user_test_keys:
+                    user_test = user_tests.get(key[0])
+                    dataset = to_judge(user_test, key[1])
+                    if dataset is None:
+                        continue
+                    to_do.update(
+                        operation for operation, _, _
+                        in user_test_get_operations(
+                            results.get(key), user_test, dataset))
+
+        return to_do.intersection(operations)
+
     def submission_enqueue_operations(self, submission):
         """Push in queue the operations required by a submission.
 
@@ -315,7 +582,7 @@ class EvaluationService(TriggeredService):
         new_operations = 0
         for dataset in get_datasets_to_judge(user_test.task):
             for operation, priority, timestamp in user_test_get_operations(
-                    user_test, dataset):
+                    user_test.get_result(dataset), user_test, dataset):
                 if self.enqueue(operation, priority, timestamp):
                     new_operations += 1
 
@@ -328,18 +595,64 @@ class EvaluationService(TriggeredService):
         the queue.
 
         """
-        counter = 0
-        with SessionGen() as session:
+        return self._search_missing_operations(full=True)
+
+    @with_post_finish_lock
+    def _missing_operations_incremental(self):
+        """Like _missing_operations, but look only at the submissions
+        and user tests created after the last full sweep, or with
+        results still to compile or evaluate.
 
-            for operation, timestamp, priority in \
-                    get_submissions_operations(session, self.contest_id):
-                if self.enqueue(operation, timestamp, priority):
-                    counter += 1
+        A full sweep is still done if there was none in the last
+        FULL_SWEEP_INTERVAL, to catch other kinds of missed operations
+        (for example, those for datasets enabled for judging without
+        notifying us).
 
-            for operation, timestamp, priority in \
-                    get_user_tests_operations(session, self.contest_id):
-                if self.enqueue(operation, timestamp, priority):
-                    counter += 1
+        """
+        full = self._last_full_sweep is None or \
+            monotonic_time() - self._last_full_sweep > \
+            EvaluationService.FULL_SWEEP_INTERVAL.total_seconds()
+        return self._search_missing_operations(full=full)
+
+    def _search_missing_operations(self, full):
+        """Put in the queue the missing operations.
+
+        full (bool): whether to look at all submissions and user tests
+            or only at those that changed since the last full sweep.
+
+        return (int): the number of operations enqueued.
+
+        """
+        counter = 0
+        with SessionGen() as session:
+            if full:
+                # Read the marks before searching, so that objects
+                # created during the search are looked at again.
+                self._last_full_sweep = monotonic_time()
+                sweep_time = make_timestamp()
+                submissions_high_water_mark = \
+                    get_submissions_high_water_mark(session)
+                user_tests_high_water_mark = \
+                    get_user_tests_high_water_mark(session)
+
+            counter += len(self.enqueue_many(
+                get_submissions_operations(
+                    session, self.contest_id,
+                    None if full else self._submissions_high_water_mark)))
+
+            counter += len(self.enqueue_many(
+                get_user_tests_operations(
+                    session, self.contest_id,
+                    None if full else self._user_tests_high_water_mark)))
+
+            if full:
+                self._submissions_high_water_mark = \
+                    submissions_high_water_mark
+                self._user_tests_high_water_mark = user_tests_high_water_mark
+                if self.journal is not None:
+                    self.journal.set_high_water_marks(
+                        submissions_high_water_mark,
+                        user_tests_high_water_mark, sweep_time)
 
         return counter
 
@@ -398,8 +711,40 @@ class EvaluationService(TriggeredService):
             return False
 
         # enqueue() returns the number of successful pushes.
-        return super(EvaluationService, self).enqueue(
-            operation, priority, timestamp) > 0
+        if super(EvaluationService, self).enqueue(
+                operation, priority, timestamp) == 0:
+            return False
+        if self.journal is not None:
+            self.journal.enqueued(operation, priority, timestamp)
+        return True
+
+    @with_post_finish_lock
+    def enqueue_many(self, operations):
+        """Push many operations in the queue.
+
+        Like enqueue, but faster for many operations.
+
+        operations ([(ESOperation, int, datetime)]): the operations to
+            put in the queue, with their priority and the time of the
+            submission.
+
+        return ([ESOperation]): the operations pushed.
+
+        """
+        executor = self.get_executor()
+        operations = [
+            (operation, priority, timestamp)
+            for operation, priority, timestamp in operations
+            if operation not in executor
+            and operation not in self.result_cache]
+
+        pushed = super(EvaluationService, self).enqueue_many(operations)
+        if self.journal is not None and len(pushed) > 0:
+            pushed_set = set(pushed)
+            for operation, priority, timestamp in operations:
+                if operation in pushed_set:
+                    self.journal.enqueued(operation, priority, timestamp)
+        return pushed
 
     @with_post_finish_lock
     def action_finished(self, data, shard, error=None):
@@ -441,6 +786,7 @@ class EvaluationService(TriggeredService):
         if job_group_success:
             for job in job_group.jobs:
                 operation = job.operation
+                self._update_cost_estimate(job)
                 if job.success:
                     logger.info("`%s' succeeded.", operation)
                 else:
@@ -450,8 +796,104 @@ class EvaluationService(TriggeredService):
                 if isinstance(to_ignore, list) and operation in to_ignore:
                     logger.info("`%s' result ignored as requested", operation)
                 else:
+                    if self.evaluation_memo is not None:
+                        self.evaluation_memo.store(job)
                     self.result_cache.add(operation, Result(job, job.success))
 
+    def execute_from_memo(self, entries):
+        """Fill the results of operations from the evaluation memo.
+
+        The operations whose results are in the memo are handled as if
+        a worker had just executed them; the others are returned, to be
+        sent to the workers. The jobs to look up are built from objects
+        loaded with a few queries, before taking the lock.
+
+        entries ([QueueEntry]): entries extracted from the queue.
+
+        return ([QueueEntry]): the entries not found in the memo.
+
+        """
+        operations = [entry.item for entry in entries
+                      if entry.item.type_ == ESOperation.EVALUATION]
+        if len(operations) == 0:
+            return entries
+
+        missing = []
+        with SessionGen() as session:
+            jobs = EvaluationService._memo_jobs(session, operations)
+            # The jobs only use the objects already loaded, so the lock
+            # is not held while talking to the DB.
+            with self.post_finish_lock:
+                for entry in entries:
+                    operation = entry.item
+                    job = jobs.get(operation)
+                    if job is None or not self.evaluation_memo.lookup(job):
+                        missing.append(entry)
+                        continue
+                    logger.info("`%s' result taken from the evaluation "
+                                "memo.", operation)
+                    self._update_cost_estimate(job)
+                    self.result_cache.add(operation, Result(job, True))
+        return missing
+
+    @staticmethod
+    def _memo_jobs(session, operations):
+        """Build the jobs of evaluations, to look them up in the memo.
+
+        session (Session): the DB session to use.
+        operations ([ESOperation]): EVALUATION operations.
+
+        return ({ESOperation: Job}): the jobs of the operations whose
+            submission, dataset, result and testcase exist.
+
+        """
+        keys = set((operation.object_id, operation.dataset_id)
+                   for operation in operations)
+        datasets = dict(
+            (dataset.id, dataset) for dataset in session.query(Dataset)
+            .options(joinedload(Dataset.task).joinedload(Task.contest),
+                     selectinload(Dataset.testcases),
+                     selectinload(Dataset.managers))
+            .filter(Dataset.id.in_(
+                set(dataset_id for _, dataset_id in keys))))
+        submissions = dict(
+            (submission.id, submission)
+            for submission in session.query(Submission)
+            .options(selectinload(Submission.files))
+            .filter(Submission.id.in_(
+                set(object_id for object_id, _ in keys))))
+        results = dict(
+            ((result.submission_id, result.dataset_id), result)
+            for result in session.query(SubmissionResult)
+            .options(selectinload(SubmissionResult.executables))
+            .filter(tuple_(SubmissionResult.submission_id,
+                           SubmissionResult.dataset_id).in_(keys)))
+
+        jobs = dict()
+        for operation in operations:
+            submission = submissions.get(operation.object_id)
+            dataset = datasets.get(operation.dataset_id)
+            if submission is None or dataset is None \
+                    or (operation.object_id, operation.dataset_id) \
+                    not in results \
+                    or operation.testcase_codename not in dataset.testcases:
+                continue
+            jobs[operation] = Job.from_operation(
+                operation, submission, dataset)
+        return jobs
+
+    def _update_cost_estimate(self, job):
+        """Tell the cost estimator how long the operation of a job took.
+
+        job (Job): a job, with its results.
+
+        """
+        wall_time = job.plus.get("execution_wall_clock_time") \
+            if job.plus is not None else None
+        if wall_time is not None:
+            self.get_executor().cost_estimator.update(
+                job.operation, wall_time)
+
     @with_post_finish_lock
     def write_results(self, items):
         """Receive worker results from the cache and writes them to the DB.
@@ -477,6 +919,13 @@ class EvaluationService(TriggeredService):
             by_object_and_type[t].append((operation, result))
 
         with SessionGen() as session:
+            # Load all the objects we need with a few queries; the
+            # lookups by id below then hit the session's identity map.
+            # We keep references to the objects to keep them there.
+            prefetched, testcases = EvaluationService._prefetch_objects(
+                session, iterkeys(by_object_and_type))
+
+            evaluations = []
             for key, operation_results in iteritems(by_object_and_type):
                 type_, object_id, dataset_id = key
 
@@ -502,24 +951,31 @@ class EvaluationService(TriggeredService):
                         continue
                     object_result = object_.get_result_or_create(dataset)
 
-                self.write_results_one_object_and_type(
+                evaluations += self.write_results_one_object_and_type(
                     session, object_result, operation_results)
 
+            self.write_evaluations(session, evaluations, testcases)
+
             logger.info("Committing evaluations...")
             session.commit()
 
-            num_testcases_per_dataset = dict()
-            for type_, object_id, dataset_id in iterkeys(by_object_and_type):
-                if type_ == ESOperation.EVALUATION:
-                    if dataset_id not in num_testcases_per_dataset:
-                        num_testcases_per_dataset[dataset_id] = session\
-                            .query(func.count(Testcase.id))\
-                            .filter(Testcase.dataset_id == dataset_id).scalar()
-                    num_evaluations = session\
-                        .query(func.count(Evaluation.id)) \
-                        .filter(Evaluation.dataset_id == dataset_id) \
-                        .filter(Evaluation.submission_id == object_id).scalar()
-                    if num_evaluations == num_testcases_per_dataset[dataset_id]:
+            # Count the evaluations of all the submission results we
+            # evaluated, to find which ones are now complete.
+            evaluated = [(object_id, dataset_id)
+                         for type_, object_id, dataset_id
+                         in iterkeys(by_object_and_type)
+                         if type_ == ESOperation.EVALUATION]
+            if len(evaluated) > 0:
+                num_evaluations = session.query(
+                    Evaluation.submission_id, Evaluation.dataset_id,
+                    func.count(Evaluation.id))\
+                    .filter(tuple_(Evaluation.submission_id,
+                                   Evaluation.dataset_id).in_(evaluated))\
+                    .group_by(Evaluation.submission_id,
+                              Evaluation.dataset_id)\
+                    .all()
+                for object_id, dataset_id, count in num_evaluations:
+                    if count == len(testcases.get(dataset_id, ())):
                         submission_result = SubmissionResult.get_from_id(
                             (object_id, dataset_id), session)
                         submission_result.set_evaluation_outcome()
@@ -527,6 +983,11 @@ class EvaluationService(TriggeredService):
             logger.info("Committing evaluation outcomes...")
             session.commit()
 
+            # Before ending the operations, as that might enqueue some
+            # of them again.
+            if self.journal is not None:
+                self.journal.completed(operation for operation, _ in items)
+
             logger.info("Ending operations for %s objects...",
                         len(by_object_and_type))
             for type_, object_id, dataset_id in iterkeys(by_object_and_type):
@@ -548,12 +1009,74 @@ class EvaluationService(TriggeredService):
                         (object_id, dataset_id), session)
                     self.user_test_evaluation_ended(user_test_result)
 
+            del prefetched
+
         logger.info("Done")
 
+    @staticmethod
+    def _prefetch_objects(session, keys):
+        """Load the objects needed to write a batch of results.
+
+        session (Session): the DB session to use.
+        keys ([(unicode, int, int)]): the type, object id and dataset
+            id of each group of results.
+
+        return (([Base], {int: {unicode: int}})): the objects loaded
+            (datasets, submissions, user tests and their results) and,
+            for each dataset, the ids of its testcases by codename.
+
+        """
+        dataset_ids = set()
+        submission_keys = set()
+        user_test_keys = set()
+        for type_, object_id, dataset_id in keys:
+            dataset_ids.add(dataset_id)
+            if type_ in [ESOperation.COMPILATION, ESOperation.EVALUATION]:
+                submission_keys.add((object_id, dataset_id))
+            else:
+                user_test_keys.add((object_id, dataset_id))
+
+        prefetched = []
+        if len(dataset_ids) > 0:
+            prefetched += session.query(Dataset)\
+                .filter(Dataset.id.in_(dataset_ids)).all()
+        if len(submission_keys) > 0:
+            prefetched += session.query(Submission)\
+                .filter(Submission.id.in_(
+                    set(object_id for object_id, _ in submission_keys)))\
+                .all()
+            prefetched += session.query(SubmissionResult)\
+                .filter(tuple_(SubmissionResult.submission_id,
+                               SubmissionResult.dataset_id)
+                        .in_(submission_keys))\
+                .all()
+        if len(user_test_keys) > 0:
+            prefetched += session.query(UserTest)\
+                .filter(UserTest.id.in_(
+                    set(object_id for object_id, _ in user_test_keys)))\
+                .all()
+            prefetched += session.query(UserTestResult)\
+                .filter(tuple_(UserTestResult.user_test_id,
+                               UserTestResult.dataset_id)
+                        .in_(user_test_keys))\
+                .all()
+
+        testcases = defaultdict(dict)
+        if len(dataset_ids) > 0:
+            for dataset_id, codename, testcase_id in session.query(
+                    Testcase.dataset_id, Testcase.codename, Testcase.id)\
+                    .filter(Testcase.dataset_id.in_(dataset_ids)):
+                testcases[dataset_id][codename] = testcase_id
+
+        return prefetched, testcases
+
     def write_results_one_object_and_type(
             self, session, object_result, operation_results):
         """Write to the DB the results for one object and type.
 
+        Successful evaluations of submissions are not written, but
+        returned to be written together by write_evaluations.
+
         session (Session): the DB session to use.
         object_result (SubmissionResult|UserTestResult): the DB object
             for the result referred to all the ESOperations.
@@ -561,25 +1084,100 @@ class EvaluationService(TriggeredService):
             operations and corresponding worker results we have
             received for the given object_result
 
+        return ([(SubmissionResult, ESOperation, WorkerResult)]): the
+            evaluations left to write.
+
         """
+        evaluations = []
         for operation, result in operation_results:
-            logger.info("Writing result to db for %s", operation)
-            try:
-                with session.begin_nested():
-                    self.write_results_one_row(
-                        session, object_result, operation, result)
-            except IntegrityError:
-                logger.warning(
-                    "Integrity error while inserting worker result.",
-                    exc_info=True)
-            except Exception:
-                # Defend against any exception. A poisonous results that fails
-                # here is attempted again without limits, thus can enter in
-                # all batches to write. Without the catch-all, it will prevent
-                # the whole batch to be written over and over. See issue #888.
-                logger.error(
-                    "Unexpected exception while inserting worker result.",
-                    exc_info=True)
+            if operation.type_ == ESOperation.EVALUATION and \
+                    result.job_success:
+                evaluations.append((object_result, operation, result))
+            else:
+                self.write_results_one_row_safely(
+                    session, object_result, operation, result)
+        return evaluations
+
+    def write_evaluations(self, session, evaluations, testcases):
+        """Write to the DB the successful evaluations of submissions.
+
+        The evaluations are inserted with a single statement; if that
+        fails, for example because some of them are already in the
+        DB, they are written one at a time.
+
+        session (Session): the DB session to use.
+        evaluations ([(SubmissionResult, ESOperation, WorkerResult)]):
+            the evaluations to write.
+        testcases ({int: {unicode: int}}): for each dataset, the ids
+            of its testcases by codename.
+
+        """
+        if len(evaluations) == 0:
+            return
+
+        rows = []
+        for object_result, operation, result in evaluations:
+            testcase_id = testcases.get(operation.dataset_id, {}).get(
+                operation.testcase_codename)
+            if testcase_id is None:
+                # Let the slow path deal with (and report) it.
+                self.write_results_one_row_safely(
+                    session, object_result, operation, result)
+                continue
+            row = result.job.evaluation_values()
+            row["submission_id"] = object_result.submission_id
+            row["dataset_id"] = object_result.dataset_id
+            row["testcase_id"] = testcase_id
+            rows.append((row, object_result, operation, result))
+
+        if len(rows) == 0:
+            return
+
+        logger.info("Writing %d evaluations to db.", len(rows))
+        # Submission results created in this session must be inserted
+        # before their evaluations.
+        session.flush()
+        try:
+            with session.begin_nested():
+                session.execute(Evaluation.__table__.insert(),
+                                [row for row, _, _, _ in rows])
+        except Exception:
+            logger.warning("Could not insert the evaluations together, "
+                           "inserting them one at a time.", exc_info=True)
+            for _, object_result, operation, result in rows:
+                self.write_results_one_row_safely(
+                    session, object_result, operation, result)
+
+    def write_results_one_row_safely(
+            self, session, object_result, operation, result):
+        """Write to the DB a single result, in its own savepoint.
+
+        Errors are logged and the result is discarded.
+
+        session (Session): the DB session to use.
+        object_result (SubmissionResult|UserTestResult): the DB object
+            for the operation (and for the result).
+        operation (ESOperation): the operation for which we have the result.
+        result (WorkerResult): the result from the worker.
+
+        """
+        logger.info("Writing result to db for %s", operation)
+        try:
+            with session.begin_nested():
+                self.write_results_one_row(
+                    session, object_result, operation, result)
+        except IntegrityError:
+            logger.warning(
+                "Integrity error while inserting worker result.",
+                exc_info=True)
+        except Exception:
+            # Defend against any exception. A poisonous results that fails
+            # here is attempted again without limits, thus can enter in
+            # all batches to write. Without the catch-all, it will prevent
+            # the whole batch to be written over and over. See issue #888.
+            logger.error(
+                "Unexpected exception while inserting worker result.",
+                exc_info=True)
 
     def write_results_one_row(self, session, object_result, operation, result):
         """Write to the DB a single result.
@@ -634,6 +1232,17 @@ class EvaluationService(TriggeredService):
         else:
             logger.error("Invalid operation type %r.", operation.type_)
 
+    def get_scoring_service(self, submission):
+        """Return the shard of ScoringService scoring a submission.
+
+        submission (Submission): the submission.
+
+        return (RemoteServiceClient): the ScoringService shard.
+
+        """
+        return self.scoring_services[get_scoring_shard(
+            submission.participation_id, len(self.scoring_services))]
+
     def compilation_ended(self, submission_result):
         """Actions to be performed when we have a submission that has
         ended compilation. In particular: we queue evaluation if
@@ -659,7 +1268,7 @@ class EvaluationService(TriggeredService):
             logger.info("Submission %d(%d) did not compile.",
                         submission_result.submission_id,
                         submission_result.dataset_id)
-            self.scoring_service.new_evaluation(
+            self.get_scoring_service(submission).new_evaluation(
                 submission_id=submission_result.submission_id,
                 dataset_id=submission_result.dataset_id)
 
@@ -702,7 +1311,7 @@ class EvaluationService(TriggeredService):
             logger.info("Submission %d(%d) was evaluated successfully.",
                         submission_result.submission_id,
                         submission_result.dataset_id)
-            self.scoring_service.new_evaluation(
+            self.get_scoring_service(submission).new_evaluation(
                 submission_id=submission_result.submission_id,
                 dataset_id=submission_result.dataset_id)
 
@@ -916,6 +1525,8 @@ class EvaluationService(TriggeredService):
                     self.get_executor().pool.ignore_operation(operation)
                 except LookupError:
                     pass  # Ok, the operation wasn't in the pool.
+            if self.journal is not None:
+                self.journal.completed(operations)
 
             # Then we find all existing results in the database, and
             # we remove them.
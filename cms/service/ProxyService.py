@@ -469,21 +469,55 @@ class ProxyService(TriggeredService):
                              "unexistent submission id %s.", submission_id)
                 raise KeyError("Submission not found.")
 
-            if submission.participation.hidden:
-                logger.info("[submission_scored] Score for submission %d "
-                            "not sent because the participation is hidden.",
-                            submission_id)
-                return
+            self._submission_scored(submission)
 
-            if not submission.official:
-                logger.info("[submission_scored] Score for submission %d "
-                            "not sent because the submission is not official.",
-                            submission_id)
-                return
+    @rpc_method
+    def submissions_scored(self, submission_ids):
+        """Notice that some submissions have been scored.
 
-            # Update RWS.
-            for operation in self.operations_for_score(submission):
-                self.enqueue(operation)
+        Like submission_scored, but for many submissions at once (for
+        example, all those scored by ScoringService in a batch), which
+        are retrieved with a single query. Unexistent submissions are
+        reported and skipped.
+
+        submission_ids ([int]): the ids of the submissions that
+            changed.
+
+        """
+        with SessionGen() as session:
+            submissions = session.query(Submission)\
+                .filter(Submission.id.in_(submission_ids))\
+                .all()
+
+            missing = set(submission_ids) - set(s.id for s in submissions)
+            for submission_id in sorted(missing):
+                logger.error("[submission_scored] Received score request for "
+                             "unexistent submission id %s.", submission_id)
+
+            for submission in submissions:
+                self._submission_scored(submission)
+
+    def _submission_scored(self, submission):
+        """Send to the rankings the score of a submission, if needed.
+
+        submission (Submission): the submission that changed.
+
+        """
+        if submission.participation.hidden:
+            logger.info("[submission_scored] Score for submission %d "
+                        "not sent because the participation is hidden.",
+                        submission.id)
+            return
+
+        if not submission.official:
+            logger.info("[submission_scored] Score for submission %d "
+                        "not sent because the submission is not official.",
+                        submission.id)
+            return
+
+        # Update RWS.
+        for operation in self.operations_for_score(submission):
+            self.enqueue(operation)
 
     @rpc_method
     def submission_tokened(self, submission_id):
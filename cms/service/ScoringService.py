@@ -35,91 +35,188 @@ from future.builtins import *  # noqa
 
 import logging
 
-from cms import ServiceCoord, config
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload, subqueryload
+
+from cms import ServiceCoord, config, get_service_shards
 from cms.io import Executor, TriggeredService, rpc_method
-from cms.db import SessionGen, Submission, Dataset, get_submission_results
+from cms.db import SessionGen, Submission, SubmissionResult, Dataset, \
+    get_submission_results
 
 from cmscommon.datetime import make_datetime
 
-from .scoringoperations import ScoringOperation, get_operations
+from .scoringoperations import ScoringOperation, filter_scoring_shard, \
+    get_operations
 
 
 logger = logging.getLogger(__name__)
 
 
 class ScoringExecutor(Executor):
+
+    # Maximum number of submission results scored in a single
+    # transaction.
+    MAX_OPERATIONS_PER_BATCH = 100
+
     def __init__(self, proxy_service):
-        super(ScoringExecutor, self).__init__()
+        super(ScoringExecutor, self).__init__(batch_executions=True)
         self.proxy_service = proxy_service
 
-    def execute(self, entry):
-        """Assign a score to a submission result.
+    def max_operations_per_batch(self):
+        """See Executor.max_operations_per_batch."""
+        return ScoringExecutor.MAX_OPERATIONS_PER_BATCH
+
+    def execute(self, entries):
+        """Assign a score to some submission results.
 
-        This is the core of ScoringService: here we retrieve the result
-        from the database, check if it is in the correct status,
-        instantiate its ScoreType, compute its score, store it back in
-        the database and tell ProxyService to update RWS if needed.
+        This is the core of ScoringService: here we retrieve the
+        results from the database, check if they are in the correct
+        status, instantiate their ScoreType, compute their score, store
+        them back in the database and tell ProxyService to update RWS
+        if needed.
 
-        entry (QueueEntry): entry containing the operation to perform.
+        All the objects needed are loaded with a few queries, each
+        ScoreType is instantiated once per dataset, the scores are
+        committed together and ProxyService is notified once. Each
+        operation runs in its own savepoint, so that an error with it
+        (including one while flushing) is logged and rolled back
+        without affecting the others.
+
+        entries ([QueueEntry]): entries containing the operations to
+            perform.
 
         """
-        operation = entry.item
+        operations = [entry.item for entry in entries]
+        to_notify = []
         with SessionGen() as session:
-            # Obtain submission.
-            submission = Submission.get_from_id(operation.submission_id,
-                                                session)
-            if submission is None:
-                raise ValueError("Submission %d not found in the database." %
-                                 operation.submission_id)
-
-            # Obtain dataset.
-            dataset = Dataset.get_from_id(operation.dataset_id, session)
-            if dataset is None:
-                raise ValueError("Dataset %d not found in the database." %
-                                 operation.dataset_id)
-
-            # Obtain submission result.
-            submission_result = submission.get_result(dataset)
-
-            # It means it was not even compiled (for some reason).
-            if submission_result is None:
-                raise ValueError("Submission result %d(%d) was not found." %
-                                 (operation.submission_id,
-                                  operation.dataset_id))
-
-            # Check if it's ready to be scored.
-            if not submission_result.needs_scoring():
-                if submission_result.scored():
-                    logger.info("Submission result %d(%d) is already scored.",
-                                operation.submission_id, operation.dataset_id)
-                    return
-                else:
-                    raise ValueError("The state of the submission result "
-                                     "%d(%d) doesn't allow scoring." %
-                                     (operation.submission_id,
-                                      operation.dataset_id))
-
-            # Instantiate the score type.
-            score_type = dataset.score_type_object
-
-            # Compute score and fill it in the database.
-            submission_result.score, \
-                submission_result.score_details, \
-                submission_result.public_score, \
-                submission_result.public_score_details, \
-                submission_result.ranking_score_details = \
-                score_type.compute_score(submission_result)
-
-            # Store it.
+            # Load all the objects we need; the lookups by id below
+            # then hit the session's identity map. We keep references
+            # to the objects to keep them there.
+            prefetched = ScoringExecutor._prefetch_objects(
+                session, operations)
+
+            score_types = {}
+            for operation in operations:
+                try:
+                    with session.begin_nested():
+                        submission = self._score(
+                            session, operation, score_types)
+                except Exception:
+                    logger.error("Unexpected error when scoring `%s'.",
+                                 operation, exc_info=True)
+                    continue
+                if submission is not None:
+                    to_notify.append(submission)
+
+            # Store them.
             session.commit()
 
-            # If dataset is the active one, update RWS.
-            if dataset is submission.task.active_dataset:
+            now = make_datetime()
+            for submission in to_notify:
                 logger.info(
                     "Submission scored %.1f seconds after submission",
-                    (make_datetime() - submission.timestamp).total_seconds())
-                self.proxy_service.submission_scored(
-                    submission_id=submission.id)
+                    (now - submission.timestamp).total_seconds())
+            submission_ids = [submission.id for submission in to_notify]
+
+            del prefetched
+
+        # Update RWS.
+        if len(submission_ids) > 0:
+            self.proxy_service.submissions_scored(
+                submission_ids=submission_ids)
+
+    @staticmethod
+    def _prefetch_objects(session, operations):
+        """Load in the session the objects needed by some operations.
+
+        session (Session): the session to use.
+        operations ([ScoringOperation]): the operations.
+
+        return ([Base]): the objects loaded.
+
+        """
+        submission_ids = set(op.submission_id for op in operations)
+        dataset_ids = set(op.dataset_id for op in operations)
+        keys = set((op.submission_id, op.dataset_id) for op in operations)
+        return session.query(Submission)\
+            .filter(Submission.id.in_(submission_ids))\
+            .options(joinedload(Submission.task))\
+            .all() + \
+            session.query(Dataset)\
+            .filter(Dataset.id.in_(dataset_ids))\
+            .all() + \
+            session.query(SubmissionResult)\
+            .filter(tuple_(SubmissionResult.submission_id,
+                           SubmissionResult.dataset_id).in_(keys))\
+            .options(subqueryload(SubmissionResult.evaluations))\
+            .all()
+
+    @staticmethod
+    def _score(session, operation, score_types):
+        """Assign a score to a submission result, without committing.
+
+        session (Session): the session to use.
+        operation (ScoringOperation): the operation to perform.
+        score_types ({int: ScoreType}): the score types already
+            instantiated, by dataset id; updated with new ones.
+
+        return (Submission|None): the submission, if RWS has to be
+            updated with its new score.
+
+        raise (ValueError): if the submission result cannot be scored.
+
+        """
+        # Obtain submission.
+        submission = Submission.get_from_id(operation.submission_id,
+                                            session)
+        if submission is None:
+            raise ValueError("Submission %d not found in the database." %
+                             operation.submission_id)
+
+        # Obtain dataset.
+        dataset = Dataset.get_from_id(operation.dataset_id, session)
+        if dataset is None:
+            raise ValueError("Dataset %d not found in the database." %
+                             operation.dataset_id)
+
+        # Obtain submission result.
+        submission_result = submission.get_result(dataset)
+
+        # It means it was not even compiled (for some reason).
+        if submission_result is None:
+            raise ValueError("Submission result %d(%d) was not found." %
+                             (operation.submission_id,
+                              operation.dataset_id))
+
+        # Check if it's ready to be scored.
+        if not submission_result.needs_scoring():
+            if submission_result.scored():
+                logger.info("Submission result %d(%d) is already scored.",
+                            operation.submission_id, operation.dataset_id)
+                return None
+            else:
+                raise ValueError("The state of the submission result "
+                                 "%d(%d) doesn't allow scoring." %
+                                 (operation.submission_id,
+                                  operation.dataset_id))
+
+        # Instantiate the score type.
+        if dataset.id not in score_types:
+            score_types[dataset.id] = dataset.score_type_object
+        score_type = score_types[dataset.id]
+
+        # Compute score and fill it in the database.
+        submission_result.score, \
+            submission_result.score_details, \
+            submission_result.public_score, \
+            submission_result.public_score_details, \
+            submission_result.ranking_score_details = \
+            score_type.compute_score(submission_result)
+
+        # If dataset is the active one, RWS needs to be updated.
+        if dataset is submission.task.active_dataset:
+            return submission
+        return None
 
 
 class ScoringService(TriggeredService):
@@ -133,6 +230,10 @@ class ScoringService(TriggeredService):
     Scoring is done by the compute_score method of the ScoreType
     defined by the dataset of the result.
 
+    There can be several shards of ScoringService: each scores the
+    submission results of the participations assigned to it by
+    get_scoring_shard.
+
     """
 
     def __init__(self, shard):
@@ -141,6 +242,13 @@ class ScoringService(TriggeredService):
         """
         super(ScoringService, self).__init__(shard)
 
+        # Set up communication with the other shards, to forward them
+        # invalidation requests.
+        self.shards = get_service_shards("ScoringService")
+        self.other_shards = [
+            self.connect_to(ServiceCoord("ScoringService", i))
+            for i in range(self.shards) if i != shard]
+
         # Set up communication with ProxyService.
         ranking_enabled = len(config.rankings) > 0
         self.proxy_service = self.connect_to(
@@ -153,14 +261,15 @@ class ScoringService(TriggeredService):
     def _missing_operations(self):
         """Return a generator of unscored submission results.
 
-        Obtain a list of all the submission results in the database,
-        check each of them to see if it's still unscored and if so
-        enqueue them.
+        Obtain a list of all the submission results in the database
+        assigned to this shard, check each of them to see if it's
+        still unscored and if so enqueue them.
 
         """
         counter = 0
         with SessionGen() as session:
-            for operation, timestamp in get_operations(session):
+            for operation, timestamp in get_operations(
+                    session, self.shard, self.shards):
                 self.enqueue(operation, timestamp=timestamp)
                 counter += 1
         return counter
@@ -182,7 +291,7 @@ class ScoringService(TriggeredService):
     @rpc_method
     def invalidate_submission(self, submission_id=None, dataset_id=None,
                               participation_id=None, task_id=None,
-                              contest_id=None):
+                              contest_id=None, forward=True):
         """Invalidate (and re-score) some submission results.
 
         Invalidate the scores of the submission results that:
@@ -204,20 +313,33 @@ class ScoringService(TriggeredService):
             invalidated, or None.
         contest_id (int|None): id of the contest whose results should
             be invalidated, or None.
+        forward (bool): whether to forward the request to the other
+            shards; each shard invalidates only the results assigned
+            to it.
 
         """
         logger.info("Invalidation request received.")
 
+        if forward:
+            for service in self.other_shards:
+                service.invalidate_submission(
+                    submission_id=submission_id, dataset_id=dataset_id,
+                    participation_id=participation_id, task_id=task_id,
+                    contest_id=contest_id, forward=False)
+
         # We can put results in the scorer queue only after they have
         # been invalidated (and committed to the database). Therefore
         # we temporarily save them somewhere else.
         temp_queue = list()
 
         with SessionGen() as session:
-            submission_results = \
-                get_submission_results(session, contest_id,
-                                       participation_id, task_id,
-                                       submission_id, dataset_id).all()
+            query = get_submission_results(session, contest_id,
+                                           participation_id, task_id,
+                                           submission_id, dataset_id)
+            if self.shards > 1:
+                query = query.filter(
+                    filter_scoring_shard(self.shard, self.shards))
+            submission_results = query.all()
 
             for sr in submission_results:
                 if sr.scored():
@@ -31,18 +31,25 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from future.builtins.disabled import *  # noqa
 from future.builtins import *  # noqa
+from six import iteritems
 
 import logging
+import os
 import time
 
+import gevent
 import gevent.lock
+import gevent.queue
 
+from cms import ConfigError, ServiceCoord, config
 from cms.io import Service, rpc_method
 from cms.db import SessionGen, Contest, enumerate_files
 from cms.db.filecacher import FileCacher, TombstoneError
 from cms.grading import JobException
+from cms.grading.Sandbox import SandboxSlot
 from cms.grading.tasktypes import get_task_type
 from cms.grading.Job import CompilationJob, EvaluationJob, JobGroup
+from cms.service.compilationcache import CompilationCache
 
 
 logger = logging.getLogger(__name__)
@@ -59,11 +66,17 @@ class Worker(Service):
     JOB_TYPE_COMPILATION = "compile"
     JOB_TYPE_EVALUATION = "evaluate"
 
+    # How often (in number of files) to log the progress of precaching.
+    PRECACHE_PROGRESS_INTERVAL = 100
+
     def __init__(self, shard, fake_worker_time=None):
         Service.__init__(self, shard)
         self.file_cacher = FileCacher(self)
 
         self.work_lock = gevent.lock.RLock()
+        self.slots = Worker._create_slots(shard)
+        self.compilation_cache = CompilationCache(
+            config.worker_compilation_cache_size)
         self._last_end_time = None
         self._total_free_time = 0
         self._total_busy_time = 0
@@ -71,6 +84,97 @@ class Worker(Service):
 
         self._fake_worker_time = fake_worker_time
 
+    @staticmethod
+    def _local_workers(shard):
+        """Return the position of a worker among those on its host.
+
+        shard (int): the shard of the worker.
+
+        return ((int, int)): the index of the worker among the workers
+            configured on the same host, and their number. If the
+            worker is not configured, its shard and one more than it.
+
+        """
+        services = config.async_config.core_services
+        coord = ServiceCoord("Worker", shard)
+        if coord not in services:
+            return shard, shard + 1
+        local_shards = sorted(
+            other.shard for other in services
+            if other.name == "Worker"
+            and services[other].ip == services[coord].ip)
+        return local_shards.index(shard), len(local_shards)
+
+    @staticmethod
+    def _create_slots(shard):
+        """Create the execution slots of the worker with the given shard.
+
+        Slots get consecutive ranges of box ids and, if pinned,
+        consecutive CPU cores, after those of the workers with a lower
+        shard on the same host; hence, workers on the same host need
+        the same number of slots for their ranges not to overlap. If
+        checkers are pipelined, each slot has a checker slot with its
+        own range and, if pinned, its own core.
+
+        shard (int): the shard of the worker.
+
+        return ([SandboxSlot]): the slots, as many as configured.
+
+        raise (ConfigError): if the box ids of the slots of the workers
+            on the host do not fit in the ones available.
+
+        """
+        if hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = None
+
+        pipelined = config.worker_pipelined_checker
+        n_slots = config.worker_slots
+        if n_slots == 0:
+            n_slots = len(cpus) if cpus is not None else 1
+            if pipelined:
+                n_slots = max(n_slots // 2, 1)
+        n_cores = 2 * n_slots if pipelined else n_slots
+        local_index, n_local = Worker._local_workers(shard)
+        first_core = local_index * n_cores
+
+        # Isolate's box ids are at most 999, and [0, 10) is reserved.
+        if (first_core + n_cores + 1) * SandboxSlot.BOX_IDS_PER_SLOT > 1000:
+            raise ConfigError(
+                "Not enough isolate box ids for %d slots in each of the %d "
+                "workers of the host." % (n_cores, n_local))
+
+        pin = n_local * n_cores > 1 and config.worker_pin_slots
+        if pin and cpus is None:
+            logger.warning("Cannot pin slots to CPU cores on this platform.")
+            pin = False
+        elif pin and n_local * n_cores > len(cpus):
+            logger.warning("There are more slots (%d) than CPU cores (%d) "
+                           "on this host, some slots will share a core.",
+                           n_local * n_cores, len(cpus))
+
+        def create_slot(index):
+            first_box_id = (first_core + index + 1) \
+                * SandboxSlot.BOX_IDS_PER_SLOT
+            cpu = cpus[(first_core + index) % len(cpus)] if pin else None
+            return SandboxSlot(index, first_box_id, cpu)
+
+        slots = [create_slot(index) for index in range(n_slots)]
+        if pipelined:
+            for slot in slots:
+                slot.checker_slot = create_slot(n_slots + slot.index)
+        return slots
+
+    @rpc_method
+    def get_slots(self):
+        """RPC to ask the worker how many jobs it can execute at once.
+
+        return (int): the number of execution slots.
+
+        """
+        return len(self.slots)
+
     @rpc_method
     def precache_files(self, contest_id):
         """RPC to ask the worker to precache of files in the contest.
@@ -87,20 +191,29 @@ class Worker(Service):
             contest = Contest.get_from_id(contest_id, session)
             files = enumerate_files(session, contest, skip_submissions=True,
                                     skip_user_tests=True, skip_print_jobs=True)
-        for digest in files:
-            try:
-                self.file_cacher.load(digest, if_needed=True)
-            except KeyError:
-                # No problem (at this stage) if we cannot find the
-                # file
-                pass
 
-        logger.info("Precaching finished.")
+        def log_progress(processed, total):
+            if processed % Worker.PRECACHE_PROGRESS_INTERVAL == 0 \
+                    or processed == total:
+                logger.info("Precached %d files out of %d.",
+                            processed, total)
+
+        errors = self.file_cacher.load_many(
+            files, concurrency=config.precache_concurrency,
+            progress_callback=log_progress)
+        for digest, error in iteritems(errors):
+            # No problem (at this stage) if we cannot find the file.
+            if not isinstance(error, KeyError):
+                logger.warning("Could not precache file %s: %r.",
+                               digest, error)
+
+        logger.info("Precaching finished (%d files not found or failed).",
+                    len(errors))
 
     @rpc_method
     def execute_job_group(self, job_group_dict):
-        """Receive a group of jobs in a list format and executes them one by
-        one.
+        """Receive a group of jobs in a list format and executes them, one
+        by one or, if the worker has more than one slot, concurrently.
 
         job_group_dict ({}): a JobGroup exported to dict.
 
@@ -114,26 +227,11 @@ class Worker(Service):
         if self.work_lock.acquire(False):
             try:
                 logger.info("Starting job group.")
-                for job in job_group.jobs:
-                    logger.info("Starting job.",
-                                extra={"operation": job.info})
-
-                    job.shard = self.shard
-
-                    if self._fake_worker_time is None:
-                        task_type = get_task_type(job.task_type,
-                                                  job.task_type_parameters)
-                        try:
-                            task_type.execute_job(job, self.file_cacher)
-                        except TombstoneError:
-                            job.success = False
-                            job.plus = {"tombstone": True}
-                    else:
-                        self._fake_work(job)
-
-                    logger.info("Finished job.",
-                                extra={"operation": job.info})
-
+                # The outputs are saved in the storage while the other
+                # jobs run, but they must all be there before we return
+                # their digests.
+                with self.file_cacher.background_saves():
+                    self._execute_jobs(job_group.jobs)
                 logger.info("Finished job group.")
                 return job_group.export_to_dict()
 
@@ -155,6 +253,135 @@ class Worker(Service):
             self._finalize(start_time)
             raise JobException(err_msg)
 
+    def _execute_jobs(self, jobs):
+        """Execute the jobs, each group in the first slot available.
+
+        Jobs are grouped as explained in _group_jobs. With a single
+        slot the groups are executed in order. Otherwise they are
+        executed concurrently, and if one raises an exception the
+        others are killed and the exception is propagated.
+
+        jobs ([Job]): the jobs to execute.
+
+        """
+        if len(self.slots) == 1:
+            with self.slots[0].use():
+                for group in Worker._group_jobs(jobs, len(jobs)):
+                    self._execute_group(group)
+            return
+
+        free_slots = gevent.queue.Queue()
+        for slot in self.slots:
+            free_slots.put(slot)
+
+        def execute_in_slot(group):
+            slot = free_slots.get()
+            try:
+                with slot.use():
+                    self._execute_group(group)
+            finally:
+                free_slots.put(slot)
+
+        # Keep all the slots busy, even if the jobs could all be in one
+        # group.
+        max_group_size = -(-len(jobs) // len(self.slots))
+        greenlets = [gevent.spawn(execute_in_slot, group)
+                     for group in Worker._group_jobs(jobs, max_group_size)]
+        try:
+            gevent.joinall(greenlets, raise_error=True)
+        finally:
+            gevent.killall(greenlets)
+
+    @staticmethod
+    def _group_jobs(jobs, max_group_size):
+        """Split the jobs in groups to be executed together.
+
+        Consecutive evaluation jobs with the same task type and
+        parameters form a group, that the task type evaluates at once
+        (see TaskType.evaluate_many); any other job is alone in its
+        group.
+
+        jobs ([Job]): the jobs to split.
+        max_group_size (int): the maximum number of jobs in a group.
+
+        return ([[Job]]): the groups, in order.
+
+        """
+        groups = []
+        for job in jobs:
+            if len(groups) > 0 \
+                    and len(groups[-1]) < max_group_size \
+                    and isinstance(job, EvaluationJob) \
+                    and isinstance(groups[-1][0], EvaluationJob) \
+                    and job.task_type == groups[-1][0].task_type \
+                    and job.task_type_parameters \
+                    == groups[-1][0].task_type_parameters:
+                groups[-1].append(job)
+            else:
+                groups.append([job])
+        return groups
+
+    def _execute_group(self, jobs):
+        """Execute a group of jobs (see _group_jobs), storing the
+        results in them.
+
+        jobs ([Job]): the jobs to execute.
+
+        """
+        if len(jobs) == 1 or self._fake_worker_time is not None:
+            for job in jobs:
+                self._execute_job(job)
+            return
+
+        for job in jobs:
+            logger.info("Starting job.", extra={"operation": job.info})
+            job.shard = self.shard
+
+        task_type = get_task_type(jobs[0].task_type,
+                                  jobs[0].task_type_parameters)
+        try:
+            task_type.evaluate_many(jobs, self.file_cacher)
+        except TombstoneError:
+            # Find out which of the jobs not evaluated yet need the
+            # tombstone, evaluating them one by one.
+            for job in jobs:
+                if job.success is None:
+                    job.sandboxes = []
+                    self._execute_job(job)
+                else:
+                    logger.info("Finished job.",
+                                extra={"operation": job.info})
+            return
+
+        for job in jobs:
+            logger.info("Finished job.", extra={"operation": job.info})
+
+    def _execute_job(self, job):
+        """Execute a single job, storing the results in it.
+
+        job (Job): the job to execute.
+
+        """
+        logger.info("Starting job.", extra={"operation": job.info})
+
+        job.shard = self.shard
+
+        if self._fake_worker_time is None:
+            task_type = get_task_type(job.task_type,
+                                      job.task_type_parameters)
+            try:
+                if not self.compilation_cache.lookup(
+                        job, task_type, self.file_cacher):
+                    task_type.execute_job(job, self.file_cacher)
+                    self.compilation_cache.store(job, task_type)
+            except TombstoneError:
+                job.success = False
+                job.plus = {"tombstone": True}
+        else:
+            self._fake_work(job)
+
+        logger.info("Finished job.", extra={"operation": job.info})
+
     def _fake_work(self, job):
         """Fill the job with fake success data after waiting for some time."""
         time.sleep(self._fake_worker_time)
@@ -192,3 +419,18 @@ class Worker(Service):
                     "busyness is %.1lf%%; avg free time is %.3lf "
                     "avg busy time is %.3lf ",
                     busy_time, free_time, ratio, avg_free_time, avg_busy_time)
+
+        slots = self.slots + [slot.checker_slot for slot in self.slots
+                              if slot.checker_slot is not None]
+        leases = sum(slot.leases for slot in slots)
+        if leases > 0:
+            logger.info("Leased %d sandbox boxes, %d reused from the pool; "
+                        "avg lease time is %.3lf",
+                        leases,
+                        sum(slot.reused_leases for slot in slots),
+                        sum(slot.lease_time for slot in slots) / leases)
+
+        if self.compilation_cache.hits + self.compilation_cache.misses > 0:
+            logger.info("Compilation cache: %d hits, %d misses.",
+                        self.compilation_cache.hits,
+                        self.compilation_cache.misses)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of the results of the compilations done by a Worker.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+from six import iteritems
+
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+
+try:
+    from shutil import which
+except ImportError:
+    # Python 2.
+    from distutils.spawn import find_executable as which
+
+from cms.db import Executable
+from cms.grading.Job import CompilationJob
+
+
+logger = logging.getLogger(__name__)
+
+
+class CompilationCache(object):
+    """Remember the executables produced by successful compilations.
+
+    Compilations are deterministic enough that running again one with
+    the same inputs is a waste: this happens for resubmissions of the
+    same source, for the evaluation of a submission on a cloned
+    dataset, or for the same grader in different datasets. The key of
+    a compilation is the digest of everything that can change its
+    result: task type and parameters, language, compilation commands,
+    the compiler executables (identified by path, size and
+    modification time) and the digests of the sources and of the
+    managers. What the compiler executables use in turn (compiler
+    passes, headers, libraries, or what a script runs) is not part
+    of the key, so the cache is disabled unless configured, and it is
+    to be emptied (by restarting the Worker) when upgrading them.
+
+    Only successful compilations are cached, and the executables stay
+    in the storage, so the cache holds just their digests, and the
+    text and statistics of the compilation. The least recently used
+    entries are evicted when the cache is full.
+
+    """
+
+    def __init__(self, size):
+        """Create an empty cache.
+
+        size (int): the maximum number of compilations to remember; 0
+            disables the cache.
+
+        """
+        self.size = size
+        # Type: {str: ([(str, str)], [str], dict|None)}
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _compiler_identity(command):
+        """Return what identifies the compiler run by a command.
+
+        command ([str]): a compilation command.
+
+        return ([str, int, float]|None): the path of the executable,
+            its size and modification time, or None if not found.
+
+        """
+        path = which(command[0]) if len(command) > 0 else None
+        if path is None:
+            return None
+        path = os.path.realpath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [path, st.st_size, st.st_mtime]
+
+    def _key(self, job, task_type):
+        """Return the key of the compilation of a job.
+
+        job (CompilationJob): the job.
+        task_type (TaskType): the task type of the job.
+
+        return (str): the key.
+
+        """
+        commands = (task_type.get_compilation_commands(sorted(job.files))
+                    or {}).get(job.language) or []
+        data = [
+            job.task_type,
+            job.task_type_parameters,
+            job.language,
+            job.multithreaded_sandbox,
+            commands,
+            [CompilationCache._compiler_identity(command)
+             for command in commands],
+            sorted((codename, file_.digest)
+                   for codename, file_ in iteritems(job.files)),
+            sorted((filename, manager.digest)
+                   for filename, manager in iteritems(job.managers)),
+        ]
+        return hashlib.sha1(
+            json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _cacheable(self, job):
+        """Return whether the job can be looked up in the cache."""
+        return self.size > 0 and isinstance(job, CompilationJob) \
+            and not job.keep_sandbox
+
+    def lookup(self, job, task_type, file_cacher):
+        """Fill the results of the job from the cache, if possible.
+
+        job (Job): the job.
+        task_type (TaskType): the task type of the job.
+        file_cacher (FileCacher): the file cacher of the Worker, used
+            to check that the executables are still in the storage.
+
+        return (bool): whether the job was filled (and thus must not be
+            executed).
+
+        """
+        if not self._cacheable(job):
+            return False
+        key = self._key(job, task_type)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            executables, text, plus = entry
+            try:
+                for _, digest in executables:
+                    file_cacher.load(digest, if_needed=True)
+            except KeyError:
+                logger.info("Cached executable not found anymore.")
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return False
+
+        self._entries[key] = entry
+        self.hits += 1
+        logger.info("Compilation found in the cache.",
+                    extra={"operation": job.info})
+        job.success = True
+        job.compilation_success = True
+        job.text = list(text)
+        job.plus = dict(plus) if plus is not None else None
+        for filename, digest in executables:
+            job.executables[filename] = Executable(filename, digest)
+        return True
+
+    def store(self, job, task_type):
+        """Remember the results of the job, if it is a successful
+        compilation.
+
+        job (Job): the job, already executed.
+        task_type (TaskType): the task type of the job.
+
+        """
+        if not self._cacheable(job) \
+                or not job.success or not job.compilation_success:
+            return
+        self._entries[self._key(job, task_type)] = (
+            [(filename, executable.digest)
+             for filename, executable in iteritems(job.executables)],
+            list(job.text) if job.text is not None else [],
+            dict(job.plus) if job.plus is not None else None)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Estimate of the time needed by a worker to execute an operation.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+
+class OperationCostEstimator(object):
+    """Keep a moving estimate of the wall time of operations.
+
+    Operations are grouped by type, dataset and testcase (that is, all
+    evaluations of the same testcase are assumed to cost the same, and
+    likewise all compilations for the same dataset). The estimate for
+    each group is an exponential moving average of the wall times
+    reported by the workers; for groups without reports we use the
+    average of the estimates for the other groups of the same type and
+    dataset, if any, or a default.
+
+    """
+
+    def __init__(self, default_cost, smoothing=0.3, overhead=0.0):
+        """Create an estimator.
+
+        default_cost (float): the cost, in seconds, of operations we
+            know nothing about.
+        smoothing (float): the weight, between 0 and 1, of a new
+            report in the moving average.
+        overhead (float): the time, in seconds, that a worker spends
+            on each operation in addition to the wall time it reports.
+
+        """
+        self.default_cost = default_cost
+        self.smoothing = smoothing
+        self.overhead = overhead
+
+        # Type: {(unicode, int, unicode|None): float}
+        self._estimates = {}
+        # Sum and number of the estimates for each type and dataset.
+        # Type: {(unicode, int): [float, int]}
+        self._totals = {}
+
+    @staticmethod
+    def _key(operation):
+        return (operation.type_, operation.dataset_id,
+                operation.testcase_codename)
+
+    def update(self, operation, wall_time):
+        """Account for a new report of the wall time of an operation.
+
+        operation (ESOperation): the operation executed.
+        wall_time (float): the wall time it took, in seconds.
+
+        """
+        key = OperationCostEstimator._key(operation)
+        totals = self._totals.setdefault(key[:2], [0.0, 0])
+        cost = wall_time + self.overhead
+        if key in self._estimates:
+            old = self._estimates[key]
+            cost = old + self.smoothing * (cost - old)
+            totals[0] += cost - old
+        else:
+            totals[0] += cost
+            totals[1] += 1
+        self._estimates[key] = cost
+
+    def estimate(self, operation):
+        """Return the estimated cost of an operation.
+
+        operation (ESOperation): the operation to estimate.
+
+        return (float): the estimated wall time, in seconds.
+
+        """
+        key = OperationCostEstimator._key(operation)
+        try:
+            return self._estimates[key]
+        except KeyError:
+            pass
+        totals = self._totals.get(key[:2])
+        if totals is not None:
+            return totals[0] / totals[1]
+        return self.default_cost
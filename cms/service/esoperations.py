@@ -37,7 +37,7 @@ from six import iterkeys
 
 import logging
 
-from sqlalchemy import case, literal
+from sqlalchemy import case, func, literal
 
 from cms.io import PriorityQueue, QueueItem
 from cms.db import Dataset, Evaluation, Submission, SubmissionResult, \
@@ -207,19 +207,19 @@ def submission_get_operations(submission_result, submission, dataset):
                     submission.timestamp
 
 
-def user_test_get_operations(user_test, dataset):
+def user_test_get_operations(user_test_result, user_test, dataset):
     """Generate all operations originating from a user test for a given
     dataset.
 
-    user_test (UserTest): a user test;
-    dataset (Dataset): a dataset.
+    user_test_result (UserTestResult|None): a user test result.
+    user_test (UserTest): the user test for user_test_result.
+    dataset (Dataset): the dataset for user_test_result.
 
     yield (ESOperation, int, datetime): an iterator providing triplets
         consisting of a ESOperation for a certain operation to
         perform, its priority and its timestamp.
 
     """
-    user_test_result = user_test.get_result(dataset)
     if user_test_to_compile(user_test_result):
         if not dataset.active:
             priority = PriorityQueue.PRIORITY_EXTRA_LOW
@@ -292,12 +292,39 @@ def get_relevant_operations(level, submissions, dataset_id=None):
     return operations
 
 
-def get_submissions_operations(session, contest_id=None):
+def get_submissions_high_water_mark(session):
+    """Return the highest id of a submission.
+
+    session (Session): the database session to use.
+
+    return (int): the id, or 0 if there are no submissions.
+
+    """
+    return session.query(func.max(Submission.id)).scalar() or 0
+
+
+def get_user_tests_high_water_mark(session):
+    """Return the highest id of a user test.
+
+    session (Session): the database session to use.
+
+    return (int): the id, or 0 if there are no user tests.
+
+    """
+    return session.query(func.max(UserTest.id)).scalar() or 0
+
+
+def get_submissions_operations(session, contest_id=None,
+                               high_water_mark=None):
     """Return all the operations to do for submissions in the contest.
 
     session (Session): the database session to use.
     contest_id (int|None): the contest for which we want the operations.
         If none, get operations for any contest.
+    high_water_mark (int|None): if not None, look only at submissions
+        with a greater id and at those with a result still to compile
+        or evaluate; operations for other submissions (for example,
+        for a dataset just enabled for judging) are not returned.
 
     return ([ESOperation, float, int]): a list of operation, timestamp
         and priority.
@@ -310,6 +337,15 @@ def get_submissions_operations(session, contest_id=None):
     else:
         contest_filter = Task.contest_id == contest_id
 
+    if high_water_mark is None:
+        changed_filter = literal(True)
+    else:
+        pending = session.query(SubmissionResult.submission_id)\
+            .filter(FILTER_SUBMISSION_RESULTS_TO_COMPILE |
+                    FILTER_SUBMISSION_RESULTS_TO_EVALUATE)
+        changed_filter = (Submission.id > high_water_mark) | \
+            Submission.id.in_(pending)
+
     # Retrieve the compilation operations for all submissions without
     # the corresponding result for a dataset to judge. Since we have
     # no SubmissionResult, we cannot join regularly with dataset;
@@ -322,7 +358,7 @@ def get_submissions_operations(session, contest_id=None):
                    (Dataset.id == SubmissionResult.dataset_id) &
                    (Submission.id == SubmissionResult.submission_id))\
         .filter(
-            contest_filter &
+            contest_filter & changed_filter &
             (FILTER_SUBMISSION_DATASETS_TO_JUDGE) &
             (SubmissionResult.dataset_id.is_(None)))\
         .with_entities(Submission.id, Dataset.id,
@@ -340,7 +376,7 @@ def get_submissions_operations(session, contest_id=None):
         .join(Submission.results)\
         .join(SubmissionResult.dataset)\
         .filter(
-            contest_filter &
+            contest_filter & changed_filter &
             (FILTER_SUBMISSION_DATASETS_TO_JUDGE) &
             (FILTER_SUBMISSION_RESULTS_TO_COMPILE))\
         .with_entities(Submission.id, Dataset.id,
@@ -374,7 +410,7 @@ def get_submissions_operations(session, contest_id=None):
                    (Evaluation.dataset_id == Dataset.id) &
                    (Evaluation.testcase_id == Testcase.id))\
         .filter(
-            contest_filter &
+            contest_filter & changed_filter &
             (FILTER_SUBMISSION_DATASETS_TO_JUDGE) &
             (FILTER_SUBMISSION_RESULTS_TO_EVALUATE) &
             (Evaluation.id.is_(None)))\
@@ -399,12 +435,16 @@ def get_submissions_operations(session, contest_id=None):
     return operations
 
 
-def get_user_tests_operations(session, contest_id=None):
+def get_user_tests_operations(session, contest_id=None,
+                              high_water_mark=None):
     """Return all the operations to do for user tests in the contest.
 
     session (Session): the database session to use.
     contest_id (int|None): the contest for which we want the operations.
         If none, get operations for any contest.
+    high_water_mark (int|None): if not None, look only at user tests
+        with a greater id and at those with a result still to compile
+        or evaluate.
 
     return ([ESOperation, float, int]): a list of operation, timestamp
         and priority.
@@ -417,6 +457,15 @@ def get_user_tests_operations(session, contest_id=None):
     else:
         contest_filter = Task.contest_id == contest_id
 
+    if high_water_mark is None:
+        changed_filter = literal(True)
+    else:
+        pending = session.query(UserTestResult.user_test_id)\
+            .filter(FILTER_USER_TEST_RESULTS_TO_COMPILE |
+                    FILTER_USER_TEST_RESULTS_TO_EVALUATE)
+        changed_filter = (UserTest.id > high_water_mark) | \
+            UserTest.id.in_(pending)
+
     # Retrieve the compilation operations for all user tests without
     # the corresponding result for a dataset to judge. Since we have
     # no UserTestResult, we cannot join regularly with dataset;
@@ -429,7 +478,7 @@ def get_user_tests_operations(session, contest_id=None):
                    (Dataset.id == UserTestResult.dataset_id) &
                    (UserTest.id == UserTestResult.user_test_id))\
         .filter(
-            contest_filter &
+            contest_filter & changed_filter &
             (FILTER_USER_TEST_DATASETS_TO_JUDGE) &
             (UserTestResult.dataset_id.is_(None)))\
         .with_entities(UserTest.id, Dataset.id,
@@ -447,7 +496,7 @@ def get_user_tests_operations(session, contest_id=None):
         .join(UserTest.results)\
         .join(UserTestResult.dataset)\
         .filter(
-            contest_filter &
+            contest_filter & changed_filter &
             (FILTER_USER_TEST_DATASETS_TO_JUDGE) &
             (FILTER_USER_TEST_RESULTS_TO_COMPILE))\
         .with_entities(UserTest.id, Dataset.id,
@@ -475,7 +524,7 @@ def get_user_tests_operations(session, contest_id=None):
         .join(UserTest.results)\
         .join(UserTestResult.dataset)\
         .filter(
-            contest_filter &
+            contest_filter & changed_filter &
             (FILTER_USER_TEST_DATASETS_TO_JUDGE) &
             (FILTER_USER_TEST_RESULTS_TO_EVALUATE))\
         .with_entities(UserTest.id, Dataset.id,
@@ -499,18 +548,43 @@ def get_user_tests_operations(session, contest_id=None):
 
 
 class ESOperation(QueueItem):
+    """An operation of EvaluationService.
+
+    Operations are immutable values, identified by their type, the id
+    of the submission or user test, the id of the dataset and, for
+    evaluations, the codename of the testcase; their hash is computed
+    once. The only attribute that can be changed is side_data, which
+    is not part of the value and can be used to attach information to
+    a specific instance.
+
+    """
 
     COMPILATION = "compile"
     EVALUATION = "evaluate"
     USER_TEST_COMPILATION = "compile_test"
     USER_TEST_EVALUATION = "evaluate_test"
 
+    __slots__ = ("type_", "object_id", "dataset_id", "testcase_codename",
+                 "_hash", "side_data")
+
     # Testcase codename is only needed for EVALUATION type of operation
     def __init__(self, type_, object_id, dataset_id, testcase_codename=None):
-        self.type_ = type_
-        self.object_id = object_id
-        self.dataset_id = dataset_id
-        self.testcase_codename = testcase_codename
+        setattr_ = object.__setattr__
+        setattr_(self, "type_", type_)
+        setattr_(self, "object_id", object_id)
+        setattr_(self, "dataset_id", dataset_id)
+        setattr_(self, "testcase_codename", testcase_codename)
+        setattr_(self, "_hash",
+                 hash((type_, object_id, dataset_id, testcase_codename)))
+        setattr_(self, "side_data", None)
+
+    def __setattr__(self, name, value):
+        if name != "side_data":
+            raise AttributeError("ESOperation is immutable.")
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError("ESOperation is immutable.")
 
     @staticmethod
     def from_dict(d):
@@ -520,19 +594,24 @@ class ESOperation(QueueItem):
                            d["testcase_codename"])
 
     def __eq__(self, other):
+        if self is other:
+            return True
         # We may receive a non-ESOperation other when comparing with
         # operations in the worker pool (as these may also be unicode or
         # None)
         if self.__class__ != other.__class__:
             return False
-        return self.type_ == other.type_ \
+        return self._hash == other._hash \
             and self.object_id == other.object_id \
             and self.dataset_id == other.dataset_id \
+            and self.type_ == other.type_ \
             and self.testcase_codename == other.testcase_codename
 
+    def __ne__(self, other):
+        return not self == other
+
     def __hash__(self):
-        return hash((self.type_, self.object_id, self.dataset_id,
-                     self.testcase_codename))
+        return self._hash
 
     def __str__(self):
         if self.type_ == ESOperation.EVALUATION:
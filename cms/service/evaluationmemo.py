@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Memo of the results of the evaluations done by the Workers.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+from six import iteritems
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+from cms.grading.Job import EvaluationJob
+
+from .esoperations import ESOperation
+
+
+logger = logging.getLogger(__name__)
+
+
+class EvaluationMemo(object):
+    """Remember the results of the evaluations of submissions.
+
+    An evaluation with the same inputs as an earlier one gives the
+    same result, up to the noise in the measured resources: this
+    happens for example when evaluating submissions on a dataset
+    cloned just to change the score type, or when re-evaluating after
+    a change that does not affect the execution. The key of an
+    evaluation is the digest of everything the Worker receives: task
+    type and parameters, language, the digests of the sources, of the
+    managers (the checker among them) and of the executables, the
+    digests of input and correct output, and the limits.
+
+    Only successful evaluations are remembered; the least recently
+    used entries are evicted when the memo is full.
+
+    """
+
+    def __init__(self, size):
+        """Create an empty memo.
+
+        size (int): the maximum number of evaluations to remember.
+
+        """
+        self.size = size
+        # Type: {str: (unicode, [unicode], dict|None, int|None,
+        #              [unicode])}
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(job):
+        """Return the key of the evaluation of a job.
+
+        job (EvaluationJob): the job.
+
+        return (str): the key.
+
+        """
+        data = [
+            job.task_type,
+            job.task_type_parameters,
+            job.language,
+            job.multithreaded_sandbox,
+            sorted((codename, file_.digest)
+                   for codename, file_ in iteritems(job.files)),
+            sorted((filename, manager.digest)
+                   for filename, manager in iteritems(job.managers)),
+            sorted((filename, executable.digest)
+                   for filename, executable in iteritems(job.executables)),
+            job.input,
+            job.output,
+            job.time_limit,
+            job.memory_limit,
+        ]
+        return hashlib.sha1(
+            json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _memoizable(job):
+        """Return whether the job can be looked up in the memo.
+
+        Only evaluations of submissions qualify: user tests need the
+        output of the user program, which we do not remember.
+
+        """
+        return isinstance(job, EvaluationJob) \
+            and job.operation is not None \
+            and job.operation.type_ == ESOperation.EVALUATION \
+            and not job.keep_sandbox
+
+    def lookup(self, job):
+        """Fill the results of the job from the memo, if possible.
+
+        job (Job): the job.
+
+        return (bool): whether the job was filled (and thus must not be
+            sent to a worker).
+
+        """
+        if not self._memoizable(job):
+            return False
+        key = self._key(job)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return False
+
+        self._entries[key] = entry
+        self.hits += 1
+        outcome, text, plus, shard, sandboxes = entry
+        job.success = True
+        job.outcome = outcome
+        job.text = list(text)
+        job.plus = dict(plus) if plus is not None else {}
+        job.shard = shard
+        job.sandboxes = list(sandboxes)
+        return True
+
+    def store(self, job):
+        """Remember the results of the job, if it is a successful
+        evaluation of a submission.
+
+        job (Job): the job, already executed.
+
+        """
+        if not self._memoizable(job) or not job.success:
+            return
+        self._entries[self._key(job)] = (
+            job.outcome,
+            list(job.text) if job.text is not None else [],
+            dict(job.plus) if job.plus is not None else None,
+            job.shard,
+            list(job.sandboxes))
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""On-disk journal of the operations of EvaluationService.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+from six import iteritems, itervalues
+
+import io
+import json
+import logging
+import os
+
+from cmscommon.datetime import make_datetime, make_timestamp
+
+from .esoperations import ESOperation
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueJournal(object):
+    """Keep on disk the operations that EvaluationService has to do.
+
+    The journal is made of a snapshot of the operations enqueued but
+    not yet completed (with their priority and timestamp, and the
+    worker they were assigned to, if any), and of a log of the changes
+    since then. Each change is appended to the log as a JSON line;
+    when the log grows too much it is compacted into a new snapshot.
+    Replaying the log is idempotent, so a crash at any point leaves a
+    journal that can be loaded.
+
+    The journal also stores the high-water marks of the last full
+    sweep and when it started, so that the first sweep after a restart
+    can be incremental if the next full one is not due yet.
+
+    """
+
+    # Number of records in the log after which we write a snapshot.
+    SNAPSHOT_THRESHOLD = 10000
+
+    ENQUEUE = "enqueue"
+    DISPATCH = "dispatch"
+    DONE = "done"
+    MARKS = "marks"
+
+    def __init__(self, directory, contest_id):
+        """Create a journal, without reading or writing anything yet.
+
+        directory (str): the directory holding the journal.
+        contest_id (int|None): the contest of the service; journals
+            written for a different contest are discarded.
+
+        """
+        self.contest_id = contest_id
+        self._directory = directory
+        self._log_path = os.path.join(directory, "journal.log")
+        self._snapshot_path = os.path.join(directory, "snapshot.json")
+
+        # The operations not yet completed, with their serialized data.
+        # Type: {ESOperation: dict}
+        self._operations = {}
+        # Type: (int, int)|None
+        self.high_water_marks = None
+        # POSIX timestamp of the start of the sweep that computed the
+        # marks, if known.
+        # Type: float|None
+        self.full_sweep_time = None
+
+        self._log = None
+        self._records = 0
+
+    def load(self):
+        """Read the journal from disk and start a new log.
+
+        return ([(ESOperation, int|None, datetime|None, int|None)]):
+            the operations not completed, with their priority,
+            timestamp and the worker they were assigned to.
+
+        """
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        try:
+            with io.open(self._snapshot_path, "rt", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except IOError:
+            snapshot = None
+        except ValueError:
+            logger.warning("Discarding corrupted queue journal snapshot.",
+                           exc_info=True)
+            snapshot = None
+
+        if snapshot is not None and \
+                snapshot["contest_id"] != self.contest_id:
+            logger.warning("Discarding queue journal of contest %s.",
+                           snapshot["contest_id"])
+        else:
+            if snapshot is not None:
+                self.high_water_marks = snapshot["marks"]
+                self.full_sweep_time = snapshot.get("sweep_time")
+                for entry in snapshot["operations"]:
+                    self._operations[
+                        ESOperation.from_dict(entry["operation"])] = entry
+            self._replay_log()
+
+        # Compact what we loaded; this also starts a new log.
+        self.snapshot()
+
+        ret = []
+        for operation, entry in iteritems(self._operations):
+            timestamp = entry["timestamp"]
+            ret.append((
+                operation,
+                entry["priority"],
+                make_datetime(timestamp) if timestamp is not None else None,
+                entry["shard"]))
+        return ret
+
+    def _replay_log(self):
+        """Apply the records of the log to the loaded snapshot."""
+        try:
+            f = io.open(self._log_path, "rt", encoding="utf-8")
+        except IOError:
+            return
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A write was interrupted; nothing can follow it.
+                    logger.warning("Queue journal truncated, ignoring "
+                                   "the last record.")
+                    break
+                self._apply(record)
+
+    def _apply(self, record):
+        """Apply a record to the state in memory.
+
+        record (dict): the record.
+
+        """
+        type_ = record["type"]
+        if type_ == QueueJournal.MARKS:
+            self.high_water_marks = record["marks"]
+            self.full_sweep_time = record.get("sweep_time")
+            return
+
+        key = ESOperation.from_dict(record["operation"])
+        if type_ == QueueJournal.ENQUEUE:
+            self._operations[key] = {
+                "operation": record["operation"],
+                "priority": record["priority"],
+                "timestamp": record["timestamp"],
+                "shard": None,
+            }
+        elif type_ == QueueJournal.DISPATCH:
+            if key in self._operations:
+                self._operations[key]["shard"] = record["shard"]
+        elif type_ == QueueJournal.DONE:
+            self._operations.pop(key, None)
+        else:
+            logger.error("Unknown queue journal record %r.", type_)
+
+    def _write(self, record):
+        """Apply a record and append it to the log.
+
+        record (dict): the record.
+
+        """
+        self._apply(record)
+        self._log.write(QueueJournal._dump(record) + b"\n")
+        self._log.flush()
+        self._records += 1
+        if self._records >= QueueJournal.SNAPSHOT_THRESHOLD:
+            self.snapshot()
+
+    @staticmethod
+    def _dump(data):
+        """Serialize some data for the journal.
+
+        The journal is written in binary mode, since json.dumps returns
+        bytes on Python 2 and unicode on Python 3.
+
+        data (object): the data to serialize.
+
+        return (bytes): the data as JSON, encoded in UTF-8.
+
+        """
+        return json.dumps(data).encode("utf-8")
+
+    def snapshot(self):
+        """Write the state to a new snapshot, and truncate the log."""
+        temp_path = self._snapshot_path + ".tmp"
+        with io.open(temp_path, "wb") as f:
+            f.write(QueueJournal._dump({
+                "contest_id": self.contest_id,
+                "marks": self.high_water_marks,
+                "sweep_time": self.full_sweep_time,
+                "operations": list(itervalues(self._operations)),
+            }))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self._snapshot_path)
+
+        if self._log is not None:
+            self._log.close()
+        self._log = io.open(self._log_path, "wb")
+        self._records = 0
+
+    def close(self):
+        """Close the log."""
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def enqueued(self, operation, priority, timestamp):
+        """Record that an operation was put in the queue.
+
+        operation (ESOperation): the operation.
+        priority (int|None): its priority.
+        timestamp (datetime|None): its timestamp.
+
+        """
+        self._write({
+            "type": QueueJournal.ENQUEUE,
+            "operation": operation.to_dict(),
+            "priority": priority,
+            "timestamp": make_timestamp(timestamp)
+            if timestamp is not None else None,
+        })
+
+    def dispatched(self, operations, shard):
+        """Record that some operations were assigned to a worker.
+
+        operations ([ESOperation]): the operations.
+        shard (int): the shard of the worker.
+
+        """
+        for operation in operations:
+            self._write({
+                "type": QueueJournal.DISPATCH,
+                "operation": operation.to_dict(),
+                "shard": shard,
+            })
+
+    def completed(self, operations):
+        """Record that some operations do not need to be done anymore.
+
+        Operations not in the journal are ignored.
+
+        operations ([ESOperation]): the operations.
+
+        """
+        for operation in operations:
+            if operation in self._operations:
+                self._write({
+                    "type": QueueJournal.DONE,
+                    "operation": operation.to_dict(),
+                })
+
+    def set_high_water_marks(self, submissions, user_tests, sweep_time):
+        """Record the high-water marks of a full sweep.
+
+        submissions (int): the highest id of a submission.
+        user_tests (int): the highest id of a user test.
+        sweep_time (float): the POSIX timestamp of the start of the
+            sweep.
+
+        """
+        self._write({
+            "type": QueueJournal.MARKS,
+            "marks": [submissions, user_tests],
+            "sweep_time": sweep_time,
+        })
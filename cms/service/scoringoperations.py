@@ -54,10 +54,41 @@ FILTER_SUBMISSION_RESULTS_TO_SCORE = (
 )
 
 
-def get_operations(session):
+def get_scoring_shard(participation_id, shards):
+    """Return the shard of ScoringService in charge of a participation.
+
+    The submission results of each participation are all scored by
+    the same shard.
+
+    participation_id (int): the id of the participation.
+    shards (int): the number of shards of ScoringService.
+
+    return (int): the shard.
+
+    """
+    return participation_id % shards
+
+
+def filter_scoring_shard(shard, shards):
+    """Return a filter for the submissions of a ScoringService shard.
+
+    shard (int): the shard.
+    shards (int): the number of shards of ScoringService.
+
+    return (ClauseElement): a condition on Submission, true for the
+        submissions scored by the shard (see get_scoring_shard).
+
+    """
+    return Submission.participation_id % shards == shard
+
+
+def get_operations(session, shard=0, shards=1):
     """Return all the operations to do for all submissions.
 
     session (Session): the database session to use.
+    shard (int): the shard of ScoringService asking.
+    shards (int): the number of shards of ScoringService; only the
+        operations for the submissions scored by shard are returned.
 
     return ([ScoringOperation, float]): a list of operations and
         timestamps.
@@ -65,13 +96,16 @@ def get_operations(session):
     """
     # Retrieve all the compilation operations for submissions
     # already having a result for a dataset to judge.
-    results = session.query(Submission)\
+    query = session.query(Submission)\
         .join(Submission.task)\
         .join(Submission.results)\
         .join(SubmissionResult.dataset)\
         .filter(
             (FILTER_DATASETS_TO_JUDGE) &
-            (FILTER_SUBMISSION_RESULTS_TO_SCORE))\
+            (FILTER_SUBMISSION_RESULTS_TO_SCORE))
+    if shards > 1:
+        query = query.filter(filter_scoring_shard(shard, shards))
+    results = query\
         .with_entities(Submission.id, Dataset.id, Submission.timestamp)\
         .all()
 
@@ -37,7 +37,9 @@ from six import iterkeys, iteritems
 import logging
 import random
 
+from collections import OrderedDict, defaultdict
 from datetime import timedelta
+from functools import partial
 
 import gevent.lock
 
@@ -51,6 +53,59 @@ from cmscommon.datetime import make_datetime, make_timestamp
 logger = logging.getLogger(__name__)
 
 
+class IndexedSet(object):
+    """A set supporting the extraction of a random element in O(1).
+
+    """
+
+    def __init__(self):
+        self._elements = []
+        # Type: {object: int}
+        self._index = {}
+
+    def __len__(self):
+        return len(self._elements)
+
+    def __contains__(self, element):
+        return element in self._index
+
+    def __iter__(self):
+        return iter(self._elements)
+
+    def add(self, element):
+        """Add an element, if not already present.
+
+        element (object): the (hashable) element to add.
+
+        """
+        if element not in self._index:
+            self._index[element] = len(self._elements)
+            self._elements.append(element)
+
+    def discard(self, element):
+        """Remove an element, if present.
+
+        element (object): the element to remove.
+
+        """
+        index = self._index.pop(element, None)
+        if index is not None:
+            last = self._elements.pop()
+            if index < len(self._elements):
+                self._elements[index] = last
+                self._index[last] = index
+
+    def choice(self):
+        """Return a random element.
+
+        return (object): an element, chosen uniformly.
+
+        raise (IndexError): if the set is empty.
+
+        """
+        return random.choice(self._elements)
+
+
 class WorkerPool(object):
     """This class keeps the state of the workers attached to ES, and
     allow the ES to get a usable worker when it needs it.
@@ -63,6 +118,10 @@ class WorkerPool(object):
     # Seconds after which we declare a worker stale.
     WORKER_TIMEOUT = timedelta(seconds=600)
 
+    # Number of datasets whose files we assume to be in the file
+    # cache of a host after its workers executed operations on them.
+    CACHED_DATASETS_PER_HOST = 20
+
     def __init__(self, service):
         """service (Service): the EvaluationService using this
         WorkerPool.
@@ -89,6 +148,34 @@ class WorkerPool(object):
         self._schedule_disabling = {}
         # Type: {int: bool}
         self._ignore = {}
+        # Number of jobs that the worker can execute at once, as it
+        # declared when it last connected.
+        # Type: {int: int}
+        self._slots = {}
+        # Type: {int: unicode}
+        self._host = {}
+
+        # Indices of the workers by state, kept in sync with the
+        # operations and the connection status by _update_indices, to
+        # avoid scanning all workers on every acquire: the inactive
+        # and connected workers (as a whole and by host), the busy
+        # ones and the disabled ones.
+        # Type: IndexedSet(int)
+        self._available = IndexedSet()
+        # Type: {unicode: IndexedSet(int)}
+        self._available_by_host = defaultdict(IndexedSet)
+        # Type: {int}
+        self._busy = set()
+        # Type: {int}
+        self._disabled = set()
+
+        # The datasets recently used by the workers of each host, and
+        # the hosts that recently used each dataset, both from least
+        # to most recent (the values are always None).
+        # Type: {unicode: OrderedDict(int, None)}
+        self._host_datasets = defaultdict(OrderedDict)
+        # Type: {int: OrderedDict(unicode, None)}
+        self._dataset_hosts = defaultdict(OrderedDict)
 
         # TODO: given the number of pieces data associated to each
         # worker, this class could be simplified by creating a new
@@ -118,6 +205,30 @@ class WorkerPool(object):
     def __contains__(self, operation):
         return operation in self._operations_reverse
 
+    def _update_indices(self, shard):
+        """Update the indices with the current state of a worker.
+
+        shard (int): the worker whose state may have changed.
+
+        """
+        operations = self._operations[shard]
+        by_host = self._available_by_host[self._host[shard]]
+        if operations == WorkerPool.WORKER_INACTIVE and \
+                self._worker[shard].connected:
+            self._available.add(shard)
+            by_host.add(shard)
+        else:
+            self._available.discard(shard)
+            by_host.discard(shard)
+        if isinstance(operations, list):
+            self._busy.add(shard)
+        else:
+            self._busy.discard(shard)
+        if operations == WorkerPool.WORKER_DISABLED:
+            self._disabled.add(shard)
+        else:
+            self._disabled.discard(shard)
+
     def _remove_operations(self, shard, new_operation):
         """Safely remove operations from a worker, assigning a new status.
 
@@ -129,6 +240,7 @@ class WorkerPool(object):
         with self._operation_lock:
             operations = self._operations[shard]
             self._operations[shard] = new_operation
+            self._update_indices(shard)
             if isinstance(operations, list):
                 for operation in operations:
                     del self._operations_reverse[operation]
@@ -144,6 +256,7 @@ class WorkerPool(object):
             raise ValueError("Shard %s is already doing an operation.", shard)
         with self._operation_lock:
             self._operations[shard] = operations
+            self._update_indices(shard)
             for operation in operations:
                 self._operations_reverse[operation] = shard
 
@@ -161,7 +274,8 @@ class WorkerPool(object):
         # Instruct GeventLibrary to connect ES to the Worker.
         self._worker[shard] = self._service.connect_to(
             worker_coord,
-            on_connect=self.on_worker_connected)
+            on_connect=self.on_worker_connected,
+            on_disconnect=partial(self.on_worker_disconnected, worker_coord))
 
         # And we fill all data.
         self._operations[shard] = WorkerPool.WORKER_INACTIVE
@@ -169,6 +283,9 @@ class WorkerPool(object):
         self._start_time[shard] = None
         self._schedule_disabling[shard] = False
         self._ignore[shard] = False
+        self._slots[shard] = 1
+        self._host[shard] = self._worker[shard].remote_address.ip
+        self._update_indices(shard)
         self._workers_available_event.set()
         logger.debug("Worker %s added.", shard)
 
@@ -183,6 +300,9 @@ class WorkerPool(object):
         """
         shard = worker_coord.shard
         logger.info("Worker %s online again.", shard)
+        self._update_indices(shard)
+        self._worker[shard].get_slots(
+            callback=self._set_slots, plus=shard)
         if self._service.contest_id is not None:
             self._worker[shard].precache_files(
                 contest_id=self._service.contest_id
@@ -194,12 +314,102 @@ class WorkerPool(object):
         # so we wake up the consumers.
         self._workers_available_event.set()
 
-    def acquire_worker(self, operations):
+    def on_worker_disconnected(self, worker_coord):
+        """To be called when a worker goes offline.
+
+        worker_coord (ServiceCoord): the coordinates of the worker
+            that went offline.
+
+        """
+        self._update_indices(worker_coord.shard)
+
+    def _set_slots(self, data, shard, error=None):
+        """Store the number of slots of a worker, sent on connection.
+
+        data (int): the number of slots of the worker.
+        shard (int): the shard of the worker.
+        error (unicode|None): the error, if any; in that case we assume
+            the worker executes one job at a time.
+
+        """
+        if error is not None:
+            logger.warning("Could not get the number of slots of worker "
+                           "%s: %s.", shard, error)
+            return
+        if data != self._slots[shard]:
+            logger.info("Worker %s has %d slots.", shard, data)
+        self._slots[shard] = data
+
+    def total_slots(self):
+        """Return the number of slots summed over all enabled workers.
+
+        return (int): the total number of slots.
+
+        """
+        return sum(self._slots.values()) - \
+            sum(self._slots[shard] for shard in self._disabled)
+
+    def max_slots(self):
+        """Return the number of slots of the largest worker.
+
+        return (int): the maximum number of slots of a worker.
+
+        """
+        return max(self._slots.values()) if self._slots else 1
+
+    def _record_datasets(self, host, dataset_ids):
+        """Remember that a host is using some datasets.
+
+        host (unicode): the address of the host.
+        dataset_ids ({int}): the ids of the datasets.
+
+        """
+        datasets = self._host_datasets[host]
+        for dataset_id in dataset_ids:
+            datasets.pop(dataset_id, None)
+            datasets[dataset_id] = None
+            hosts = self._dataset_hosts[dataset_id]
+            hosts.pop(host, None)
+            hosts[host] = None
+        while len(datasets) > WorkerPool.CACHED_DATASETS_PER_HOST:
+            dataset_id, _ = datasets.popitem(last=False)
+            hosts = self._dataset_hosts[dataset_id]
+            del hosts[host]
+            if len(hosts) == 0:
+                del self._dataset_hosts[dataset_id]
+
+    def warm_hosts(self, dataset_id):
+        """Return the hosts likely to have the files of a dataset.
+
+        These are the hosts whose workers recently executed operations
+        on the dataset. They are returned in random order, so that
+        preferring them spreads the load among all of them.
+
+        dataset_id (int): the id of the dataset.
+
+        return ([unicode]): the addresses of the hosts.
+
+        """
+        hosts = list(self._dataset_hosts.get(dataset_id, ()))
+        random.shuffle(hosts)
+        return hosts
+
+    def acquire_worker(self, operations, batch_length=None,
+                       preferred_hosts=None):
         """Tries to assign an operation to an available worker. If no workers
         are available then this returns None, otherwise this returns
         the chosen worker.
 
         operations ([ESOperation]): the operations to assign to a worker.
+        batch_length (function|None): if not None, a function that,
+            given the operations and the number of slots of the chosen
+            worker, returns how many operations to assign to it, taken
+            from the head of operations; the caller can find out which
+            ones were assigned via __contains__.
+        preferred_hosts ([unicode]|None): if not None, the addresses
+            of the hosts whose workers to choose, if available, in
+            order of preference; otherwise, or if none of them is
+            available, a random worker is chosen.
 
         return (int|None): None if no workers are available, the worker
             assigned to the operation otherwise.
@@ -207,15 +417,20 @@ class WorkerPool(object):
         """
         # We look for an available worker.
         try:
-            shard = self.find_worker(WorkerPool.WORKER_INACTIVE,
-                                     require_connection=True,
-                                     random_worker=True)
+            shard = self._choose_worker(preferred_hosts)
         except LookupError:
             self._workers_available_event.clear()
             return None
 
+        if batch_length is not None:
+            operations = operations[
+                :batch_length(operations, self._slots[shard])]
+
         # Then we fill the info for future memory.
         self._add_operations(shard, operations)
+        self._record_datasets(
+            self._host[shard],
+            set(operation.dataset_id for operation in operations))
 
         logger.debug("Worker %s acquired.", shard)
         self._start_time[shard] = make_datetime()
@@ -277,6 +492,33 @@ class WorkerPool(object):
         else:
             return ret
 
+    def _choose_worker(self, preferred_hosts=None):
+        """Return a random inactive and connected worker.
+
+        preferred_hosts ([unicode]|None): the hosts to look into
+            first, in order.
+
+        return (int): the shard of the worker.
+
+        raise (LookupError): if no worker is available.
+
+        """
+        candidates = []
+        if preferred_hosts is not None:
+            candidates += [self._available_by_host[host]
+                           for host in preferred_hosts
+                           if host in self._available_by_host]
+        candidates.append(self._available)
+        for available in candidates:
+            while len(available) > 0:
+                shard = available.choice()
+                # The disconnection handlers run asynchronously, so
+                # the index might not be up to date yet.
+                if self._worker[shard].connected:
+                    return shard
+                self._update_indices(shard)
+        raise LookupError("No available worker.")
+
     def find_worker(self, operation, require_connection=False,
                     random_worker=False):
         """Return a worker whose assigned operation is operation.
@@ -297,6 +539,9 @@ class WorkerPool(object):
         raise (LookupError): if nothing has been found.
 
         """
+        if operation == WorkerPool.WORKER_INACTIVE and require_connection:
+            return self._choose_worker()
+
         pool = []
         for shard, worker_operation in iteritems(self._operations):
             if worker_operation == operation:
@@ -346,6 +591,7 @@ class WorkerPool(object):
                                for operation in self._operations[shard]]
                 if isinstance(self._operations[shard], list)
                 else self._operations[shard],
+                'slots': self._slots[shard],
                 'start_time': s_time}
         return result
 
@@ -360,7 +606,8 @@ class WorkerPool(object):
         """
         now = make_datetime()
         lost_operations = []
-        for shard in self._worker:
+        # Only busy workers have a start time.
+        for shard in list(self._busy):
             if self._start_time[shard] is not None:
                 active_for = now - self._start_time[shard]
 
@@ -415,6 +662,7 @@ class WorkerPool(object):
         lost_operations = []
         if self._operations[shard] == WorkerPool.WORKER_INACTIVE:
             self._operations[shard] = WorkerPool.WORKER_DISABLED
+            self._update_indices(shard)
 
         else:
             # We return all non-ignored operations so ES can do what
@@ -451,6 +699,7 @@ class WorkerPool(object):
             raise ValueError(err_msg)
 
         self._operations[shard] = WorkerPool.WORKER_INACTIVE
+        self._update_indices(shard)
         self._operations_to_ignore[shard] = []
         self._workers_available_event.set()
         logger.info("Worker %s enabled.", shard)
@@ -464,11 +713,8 @@ class WorkerPool(object):
 
         """
         lost_operations = []
-        for shard in self._worker:
-            if not self._worker[shard].connected and \
-                    self._operations[shard] not in [
-                        WorkerPool.WORKER_DISABLED,
-                        WorkerPool.WORKER_INACTIVE]:
+        for shard in list(self._busy):
+            if not self._worker[shard].connected:
                 if not self._ignore[shard]:
                     lost_operations += self._operations[shard]
                 self.release_worker(shard)
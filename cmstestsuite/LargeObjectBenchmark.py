@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the throughput of the ways of reading files from the DB.
+
+The benchmark stores a random file as a large object in the database
+configured in cms.conf (which must already be initialized), then reads
+it back as FileCacher does (that is, copying it with buffers of
+FileCacher.CHUNK_SIZE bytes), both through LargeObject (one loread
+query per buffer) and through LargeObjectReader (one lo_get query per
+slice), for each of the requested slice sizes. The large object is
+deleted at the end.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+from cms.db import LargeObject, LargeObjectReader
+from cms.db.filecacher import FileCacher
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_lobject(size):
+    """Store a random large object of the given size.
+
+    size (int): size of the large object, in bytes.
+
+    return (int): the LOID of the new large object.
+
+    """
+    with LargeObject(0, mode='wb') as lobj:
+        remaining = size
+        while remaining > 0:
+            buf = os.urandom(min(remaining, 2 ** 20))
+            lobj.write(buf)
+            remaining -= len(buf)
+    return lobj.loid
+
+
+def time_read(fobj):
+    """Read fobj until the end as FileCacher does, and close it.
+
+    fobj (fileobj): the file to read.
+
+    return ((int, float)): the number of bytes read and the time
+        elapsed, in seconds.
+
+    """
+    start = time.time()
+    read = 0
+    with fobj:
+        while True:
+            buf = fobj.read(FileCacher.CHUNK_SIZE)
+            if len(buf) == 0:
+                break
+            read += len(buf)
+    return read, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark reading large objects from the database.")
+    parser.add_argument(
+        "-s", "--size", action="store", type=int, default=200,
+        help="size in MiB of the large object to read (default 200)")
+    parser.add_argument(
+        "-r", "--repetitions", action="store", type=int, default=3,
+        help="number of times to read the file with each method "
+             "(default 3)")
+    parser.add_argument(
+        "-c", "--chunk-size", action="append", type=int, default=[],
+        help="maximum slice size in KiB for LargeObjectReader; can be "
+             "specified multiple times (default 1024 and 4096)")
+    args = parser.parse_args()
+
+    chunk_sizes = args.chunk_size or [1024, 4096]
+    size = args.size * 1024 * 1024
+
+    logger.info("Storing a large object of %d MiB.", args.size)
+    loid = create_lobject(size)
+
+    methods = [("LargeObject (loread)", lambda: LargeObject(loid, mode='rb'))]
+    for chunk_size in chunk_sizes:
+        methods.append((
+            "LargeObjectReader (lo_get, %d KiB)" % chunk_size,
+            lambda chunk_size=chunk_size:
+            LargeObjectReader(loid, chunk_size * 1024)))
+
+    try:
+        for name, open_fobj in methods:
+            elapsed = []
+            for _ in range(args.repetitions):
+                read, seconds = time_read(open_fobj())
+                if read != size:
+                    logger.error("%s read %d bytes instead of %d.",
+                                 name, read, size)
+                    return 1
+                elapsed.append(seconds)
+            best = min(elapsed)
+            print("%-40s best %7.3f s, %8.1f MiB/s" %
+                  (name, best, args.size / best))
+    finally:
+        LargeObject.unlink(loid)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
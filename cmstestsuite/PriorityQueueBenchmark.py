@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the time and memory used by the operations of PriorityQueue.
+
+The benchmark fills the queue with evaluation operations, as a full
+sweep of EvaluationService does, then changes the priority of some of
+them, removes some others and pops the rest, timing each phase and
+measuring the memory allocated by the full queue.
+
+Other implementations can be measured too, passing the path of a
+module defining a PriorityQueue class with the same interface; for
+example, to compare with the version in the parent commit:
+
+    git show HEAD~1:cms/io/priorityqueue.py > /tmp/old_priorityqueue.py
+    python cmstestsuite/PriorityQueueBenchmark.py \
+        -b /tmp/old_priorityqueue.py
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+import argparse
+import gc
+import random
+import runpy
+import sys
+import time
+
+from cms.io import PriorityQueue
+from cms.service.esoperations import ESOperation
+from cmscommon.datetime import make_datetime
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def make_operations(n):
+    """Return n evaluation operations with priority and timestamp.
+
+    n (int): the number of operations.
+
+    return ([(ESOperation, int, datetime)]): the operations.
+
+    """
+    rnd = random.Random(42)
+    now = make_datetime()
+    return [(ESOperation(ESOperation.EVALUATION, i // 50, 1, "%03d" % (i % 50)),
+             rnd.randint(PriorityQueue.PRIORITY_EXTRA_HIGH,
+                         PriorityQueue.PRIORITY_EXTRA_LOW),
+             now.replace(microsecond=rnd.randint(0, 999999)))
+            for i in range(n)]
+
+
+def timed(func, *args):
+    """Run func, and return its result and the time it took.
+
+    func (function): the function to run.
+
+    return ((object, float)): the result and the seconds elapsed.
+
+    """
+    start = time.time()
+    ret = func(*args)
+    return ret, time.time() - start
+
+
+def fill(queue_class, operations, many):
+    """Return a queue with all the operations.
+
+    queue_class (type): the class of the queue.
+    operations ([(ESOperation, int, datetime)]): the operations.
+    many (bool): whether to use push_many instead of push.
+
+    return (PriorityQueue): the queue.
+
+    """
+    queue = queue_class()
+    if many:
+        queue.push_many(operations)
+    else:
+        for operation, priority, timestamp in operations:
+            queue.push(operation, priority, timestamp)
+    return queue
+
+
+def run(queue_class, operations):
+    """Run the benchmark on an implementation.
+
+    queue_class (type): the class of the queue.
+    operations ([(ESOperation, int, datetime)]): the operations.
+
+    return ([(str, float)]): the name and the result of each
+        measurement.
+
+    """
+    results = []
+    gc.collect()
+    queue, seconds = timed(fill, queue_class, operations, False)
+    results.append(("push (s)", seconds))
+    if hasattr(queue_class, "push_many"):
+        _, seconds = timed(fill, queue_class, operations, True)
+        results.append(("push_many (s)", seconds))
+
+    if tracemalloc is not None:
+        # Not del, which Python 2 forbids on variables used by nested
+        # functions.
+        queue = None
+        gc.collect()
+        tracemalloc.start()
+        queue = fill(queue_class, operations, False)
+        results.append(("memory (MiB)",
+                        tracemalloc.get_traced_memory()[0] / 2 ** 20))
+        tracemalloc.stop()
+
+    tenth = operations[::10]
+
+    def set_priorities():
+        for operation, _, _ in tenth:
+            queue.set_priority(operation, PriorityQueue.PRIORITY_HIGH)
+    _, seconds = timed(set_priorities)
+    results.append(("set_priority 10% (s)", seconds))
+
+    def remove():
+        for operation, _, _ in operations[5::10]:
+            queue.remove(operation)
+    _, seconds = timed(remove)
+    results.append(("remove 10% (s)", seconds))
+
+    def pop_all():
+        while not queue.empty():
+            queue.pop()
+    _, seconds = timed(pop_all)
+    results.append(("pop rest (s)", seconds))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the operations of PriorityQueue.")
+    parser.add_argument(
+        "-n", "--operations", action="store", type=int, default=200000,
+        help="number of operations in the queue (default 200000)")
+    parser.add_argument(
+        "-b", "--baseline", action="append", default=[],
+        help="path of a module with another PriorityQueue to measure; "
+             "can be specified multiple times")
+    args = parser.parse_args()
+
+    operations = make_operations(args.operations)
+
+    implementations = [("current", PriorityQueue)]
+    for path in args.baseline:
+        implementations.append(
+            (path, runpy.run_path(path)["PriorityQueue"]))
+
+    for name, queue_class in implementations:
+        print("%s:" % name)
+        for measurement, value in run(queue_class, operations):
+            print("    %-24s %8.3f" % (measurement, value))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the time and memory used by the white-diff comparator.
+
+The benchmark writes some large outputs with different shapes (many
+short lines, a single long line, a lot of whitespace) and compares
+each with a copy that differs only in the whitespaces, timing the
+comparison and measuring the peak of the memory it allocates.
+
+Other implementations can be measured too, passing the path of a
+module defining a _white_diff function with the same interface; for
+example, to compare with the version in the parent commit:
+
+    git show HEAD~1:cms/grading/steps/whitediff.py \
+        | sed 's/^from \\.evaluation .*//' > /tmp/old_whitediff.py
+    python cmstestsuite/WhiteDiffBenchmark.py -b /tmp/old_whitediff.py
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+import argparse
+import gc
+import io
+import os
+import random
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+
+from cms.grading.steps import _white_diff
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def make_lines(size, rnd):
+    """Return an output made of many lines with a number each.
+
+    size (int): the approximate size in bytes.
+    rnd (Random): the random generator to use.
+
+    return ((bytes, bytes)): the output and an equivalent one.
+
+    """
+    numbers = [b"%d" % rnd.randint(0, 10 ** 9) for _ in range(size // 10)]
+    return (b"\n".join(numbers) + b"\n",
+            b" \n".join(numbers) + b"\r\n\n")
+
+
+def make_long_line(size, rnd):
+    """Return an output made of a single line of numbers.
+
+    size (int): the approximate size in bytes.
+    rnd (Random): the random generator to use.
+
+    return ((bytes, bytes)): the output and an equivalent one.
+
+    """
+    numbers = [b"%d" % rnd.randint(0, 10 ** 9) for _ in range(size // 10)]
+    return b" ".join(numbers) + b"\n", b"\t".join(numbers)
+
+
+def make_whitespace(size, rnd):
+    """Return an output with long runs of whitespaces.
+
+    size (int): the approximate size in bytes.
+    rnd (Random): the random generator to use.
+
+    return ((bytes, bytes)): the output and an equivalent one.
+
+    """
+    lines = [[b"%d" % rnd.randint(0, 9) for _ in range(10)]
+             for _ in range(size // 100)]
+    return (b"\n".join(b" " * 8 + b" \t  ".join(line) for line in lines),
+            b"\n".join(b" ".join(line) + b"  \r" for line in lines))
+
+
+SHAPES = [
+    ("many lines", make_lines),
+    ("long line", make_long_line),
+    ("whitespace", make_whitespace),
+]
+
+
+def run(white_diff, output_path, correct_path):
+    """Compare two files, measuring time and memory.
+
+    white_diff (function): the comparator to use.
+    output_path (str): the path of the first file.
+    correct_path (str): the path of the second file.
+
+    return ([(str, float)]): the name and the result of each
+        measurement.
+
+    """
+    results = []
+    gc.collect()
+    with io.open(output_path, "rb") as output, \
+            io.open(correct_path, "rb") as correct:
+        start = time.time()
+        if not white_diff(output, correct):
+            raise AssertionError("The files are not considered equal.")
+        results.append(("time (s)", time.time() - start))
+
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        with io.open(output_path, "rb") as output, \
+                io.open(correct_path, "rb") as correct:
+            white_diff(output, correct)
+        results.append(("peak memory (MiB)",
+                        tracemalloc.get_traced_memory()[1] / 2 ** 20))
+        tracemalloc.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the white-diff comparator.")
+    parser.add_argument(
+        "-s", "--size", action="store", type=int, default=64,
+        help="approximate size of each output in MiB (default 64)")
+    parser.add_argument(
+        "-b", "--baseline", action="append", default=[],
+        help="path of a module with another _white_diff to measure; "
+             "can be specified multiple times")
+    args = parser.parse_args()
+
+    implementations = [("current", _white_diff)]
+    for path in args.baseline:
+        implementations.append((path, runpy.run_path(path)["_white_diff"]))
+
+    rnd = random.Random(42)
+    directory = tempfile.mkdtemp()
+    try:
+        output_path = os.path.join(directory, "output.txt")
+        correct_path = os.path.join(directory, "correct.txt")
+        for shape, make in SHAPES:
+            output, correct = make(args.size * 2 ** 20, rnd)
+            with io.open(output_path, "wb") as f:
+                f.write(output)
+            with io.open(correct_path, "wb") as f:
+                f.write(correct)
+            del output, correct
+
+            print("%s:" % shape)
+            for name, white_diff in implementations:
+                print("  %s:" % name)
+                for measurement, value in run(
+                        white_diff, output_path, correct_path):
+                    print("    %-24s %8.3f" % (measurement, value))
+    finally:
+        shutil.rmtree(directory)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
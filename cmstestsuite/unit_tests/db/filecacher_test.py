@@ -36,14 +36,20 @@ import io
 import os
 import random
 import shutil
+import stat
+import tempfile
 import unittest
 from io import BytesIO
 
+import gevent
+from mock import patch
+
 # Needs to be first to allow for monkey patching the DB connection string.
 from cmstestsuite.unit_tests.databasemixin import DatabaseMixin
 
+from cms import config
 from cmscommon.digest import Digester, bytes_digest
-from cms.db.filecacher import FileCacher
+from cms.db.filecacher import CacheIndex, FileCacher
 
 
 class RandomFile(object):
@@ -401,5 +407,319 @@ class TestFileCacherFS(TestFileCacherBase, unittest.TestCase):
         shutil.rmtree("fs-storage", ignore_errors=True)
 
 
+class TestFileCacherEviction(unittest.TestCase):
+    """Tests for the size-bounded local cache of FileCacher."""
+
+    def setUp(self):
+        super(TestFileCacherEviction, self).setUp()
+        self.file_cacher = FileCacher(path="fs-storage")
+        self.cache_base_path = self.file_cacher.file_dir
+        self.file_cacher.index.max_size = 250
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_base_path, ignore_errors=True)
+        shutil.rmtree("fs-storage", ignore_errors=True)
+
+    def in_cache(self, digest):
+        return os.path.exists(os.path.join(self.cache_base_path, digest))
+
+    def test_least_recently_used_evicted(self):
+        first = self.file_cacher.put_file_content(os.urandom(100))
+        second = self.file_cacher.put_file_content(os.urandom(100))
+        # Access the first file, so that the second becomes the least
+        # recently used.
+        self.file_cacher.get_file_content(first)
+        third = self.file_cacher.put_file_content(os.urandom(100))
+
+        self.assertTrue(self.in_cache(first))
+        self.assertFalse(self.in_cache(second))
+        self.assertTrue(self.in_cache(third))
+        self.assertEqual(self.file_cacher.index.total_size, 200)
+
+        # Evicted files are still available from the backend.
+        self.file_cacher.get_file_content(second)
+        self.assertTrue(self.in_cache(second))
+        self.assertFalse(self.in_cache(first))
+
+    def test_pinned_not_evicted(self):
+        first = self.file_cacher.put_file_content(os.urandom(100))
+        second = self.file_cacher.put_file_content(os.urandom(100))
+        with self.file_cacher.index.pinned(first):
+            third = self.file_cacher.put_file_content(os.urandom(100))
+        self.assertTrue(self.in_cache(first))
+        self.assertFalse(self.in_cache(second))
+        self.assertTrue(self.in_cache(third))
+
+    def test_drop(self):
+        digest = self.file_cacher.put_file_content(os.urandom(100))
+        self.file_cacher.drop(digest)
+        self.assertNotIn(digest, self.file_cacher.index)
+        self.assertEqual(self.file_cacher.index.total_size, 0)
+
+    def test_scan(self):
+        first = self.file_cacher.put_file_content(os.urandom(100))
+        second = self.file_cacher.put_file_content(os.urandom(50))
+        index = CacheIndex(self.cache_base_path)
+        self.assertIn(first, index)
+        self.assertIn(second, index)
+        self.assertEqual(index.total_size, 150)
+
+
+class TestFileCacherLoadMany(unittest.TestCase):
+    """Tests for the bulk loading of files into the cache."""
+
+    def setUp(self):
+        super(TestFileCacherLoadMany, self).setUp()
+        self.file_cacher = FileCacher(path="fs-storage")
+
+    def tearDown(self):
+        shutil.rmtree(self.file_cacher.file_dir, ignore_errors=True)
+        shutil.rmtree("fs-storage", ignore_errors=True)
+
+    def test_load_many(self):
+        digests = [self.file_cacher.put_file_content(os.urandom(100))
+                   for _ in range(5)]
+        for digest in digests:
+            self.file_cacher.drop(digest)
+        missing = bytes_digest(b"not stored")
+        progress = []
+
+        errors = self.file_cacher.load_many(
+            digests + [missing, digests[0]], concurrency=2,
+            progress_callback=lambda done, total: progress.append(
+                (done, total)))
+
+        self.assertEqual(list(errors), [missing])
+        self.assertIsInstance(errors[missing], KeyError)
+        for digest in digests:
+            self.assertTrue(os.path.exists(
+                os.path.join(self.file_cacher.file_dir, digest)))
+        self.assertEqual(progress, [(i, 6) for i in range(1, 7)])
+
+
+class TestFileCacherLink(unittest.TestCase):
+    """Tests for the zero-copy retrieval of files from FileCacher."""
+
+    def setUp(self):
+        super(TestFileCacherLink, self).setUp()
+        self.file_cacher = FileCacher(path="fs-storage")
+        self.content = os.urandom(100)
+        self.digest = self.file_cacher.put_file_content(self.content)
+        self.cache_path = os.path.join(self.file_cacher.file_dir, self.digest)
+        self.dst_dir = tempfile.mkdtemp(dir=config.temp_dir)
+        self.dst_path = os.path.join(self.dst_dir, "input.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.file_cacher.file_dir, ignore_errors=True)
+        shutil.rmtree(self.dst_dir, ignore_errors=True)
+        shutil.rmtree("fs-storage", ignore_errors=True)
+
+    def assertReadOnlyCopy(self):
+        with io.open(self.dst_path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        mode = os.stat(self.dst_path).st_mode
+        self.assertEqual(mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH),
+                         0)
+
+    def test_link(self):
+        self.assertTrue(
+            self.file_cacher.link_file_to_path(self.digest, self.dst_path))
+        self.assertReadOnlyCopy()
+
+    def test_no_hard_link(self):
+        self.file_cacher.link_file_to_path(self.digest, self.dst_path,
+                                           allow_hard_link=False)
+        self.assertReadOnlyCopy()
+        self.assertNotEqual(os.stat(self.dst_path).st_ino,
+                            os.stat(self.cache_path).st_ino)
+
+    def test_cross_device(self):
+        mode = os.stat(self.cache_path).st_mode
+        with patch("cms.db.filecacher.reflink", return_value=False), \
+                patch("cms.db.filecacher.os.link",
+                      side_effect=OSError(errno.EXDEV, "Cross-device")):
+            self.assertFalse(
+                self.file_cacher.link_file_to_path(self.digest,
+                                                   self.dst_path))
+        self.assertReadOnlyCopy()
+        self.assertEqual(os.stat(self.cache_path).st_mode, mode)
+
+    def test_not_in_cache(self):
+        self.file_cacher.drop(self.digest)
+        self.file_cacher.link_file_to_path(self.digest, self.dst_path)
+        self.assertReadOnlyCopy()
+
+    def test_existing_destination(self):
+        io.open(self.dst_path, "wb").close()
+        with self.assertRaises(OSError):
+            self.file_cacher.link_file_to_path(self.digest, self.dst_path)
+
+
+class TestFileCacherPutFromPath(unittest.TestCase):
+    """Tests for the storage of files given their path."""
+
+    def setUp(self):
+        super(TestFileCacherPutFromPath, self).setUp()
+        self.file_cacher = FileCacher(path="fs-storage")
+        self.content = os.urandom(100000)
+        self.src_dir = tempfile.mkdtemp(dir=config.temp_dir)
+        self.src_path = os.path.join(self.src_dir, "output.txt")
+        with io.open(self.src_path, "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.file_cacher.file_dir, ignore_errors=True)
+        shutil.rmtree(self.src_dir, ignore_errors=True)
+        shutil.rmtree("fs-storage", ignore_errors=True)
+
+    def assertStored(self, digest, content):
+        self.assertEqual(digest, bytes_digest(content))
+        self.assertEqual(self.file_cacher.index.total_size, len(content))
+        self.file_cacher.drop(digest)
+        self.assertEqual(self.file_cacher.get_file_content(digest), content)
+
+    def test_put(self):
+        digest = self.file_cacher.put_file_from_path(self.src_path)
+        self.assertStored(digest, self.content)
+        # The source is left alone.
+        with io.open(self.src_path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_put_without_reflinks(self):
+        with patch("cms.db.filecacher.clone_fobj", return_value=False):
+            digest = self.file_cacher.put_file_from_path(
+                self.src_path, trunc_len=1000)
+        self.assertStored(digest, self.content[:1000])
+
+    def test_truncated(self):
+        digest = self.file_cacher.put_file_from_path(
+            self.src_path, trunc_len=1000)
+        self.assertStored(digest, self.content[:1000])
+
+    def test_read_failure(self):
+        with patch("cms.db.filecacher.Digester") as digester:
+            digester.return_value.update.side_effect = IOError()
+            with self.assertRaises(IOError):
+                self.file_cacher.put_file_from_path(self.src_path)
+        # The temporary copy was deleted.
+        self.assertEqual(os.listdir(self.file_cacher.temp_dir), [])
+
+    def test_background(self):
+        with self.file_cacher.background_saves():
+            digest = self.file_cacher.put_file_from_path(self.src_path)
+            # The file is in the cache, but not yet in the backend.
+            self.assertEqual(self.file_cacher.get_file_content(digest),
+                             self.content)
+            with self.assertRaises(KeyError):
+                self.file_cacher.backend.get_size(digest)
+        self.assertEqual(self.file_cacher.backend.get_size(digest),
+                         len(self.content))
+
+    def test_background_failure(self):
+        with patch.object(self.file_cacher.backend, "commit_file",
+                          side_effect=IOError()):
+            with self.assertRaises(IOError):
+                with self.file_cacher.background_saves():
+                    self.file_cacher.put_file_from_path(self.src_path)
+
+
+class FakeService(object):
+    def __init__(self, name, shard):
+        self.name = name
+        self.shard = shard
+
+
+class TestFileCacherShared(unittest.TestCase):
+    """Tests for the local cache shared by all services of a host."""
+
+    def setUp(self):
+        super(TestFileCacherShared, self).setUp()
+        patcher = patch.object(config, "shared_cache", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.file_cachers = [
+            FileCacher(FakeService("Worker", shard), path="fs-storage")
+            for shard in range(2)]
+
+    def tearDown(self):
+        shutil.rmtree(self.file_cachers[0].file_dir, ignore_errors=True)
+        shutil.rmtree("fs-storage", ignore_errors=True)
+
+    def test_same_directory(self):
+        self.assertEqual(self.file_cachers[0].file_dir,
+                         self.file_cachers[1].file_dir)
+
+    def test_concurrent_loads_fetch_once(self):
+        content = os.urandom(100)
+        digest = self.file_cachers[0].put_file_content(content)
+        self.file_cachers[0].drop(digest)
+
+        fetches = []
+        for file_cacher in self.file_cachers:
+            backend_get_file = file_cacher.backend.get_file
+
+            def slow_get_file(digest, backend_get_file=backend_get_file):
+                fetches.append(digest)
+                gevent.sleep(0.1)
+                return backend_get_file(digest)
+
+            file_cacher.backend.get_file = slow_get_file
+
+        greenlets = [gevent.spawn(file_cacher.get_file_content, digest)
+                     for file_cacher in self.file_cachers * 2]
+        gevent.joinall(greenlets, raise_error=True)
+
+        self.assertEqual(fetches, [digest])
+        for greenlet in greenlets:
+            self.assertEqual(greenlet.value, content)
+
+    def test_eviction_skips_locked_files(self):
+        file_cacher = self.file_cachers[0]
+        first = file_cacher.put_file_content(os.urandom(100))
+        file_cacher.index.max_size = 150
+
+        # The other process is reading the first file.
+        with self.file_cachers[1]._digest_lock(first):
+            second = file_cacher.put_file_content(os.urandom(100))
+            self.assertTrue(os.path.exists(
+                os.path.join(file_cacher.file_dir, first)))
+
+        third = file_cacher.put_file_content(os.urandom(100))
+        self.assertFalse(os.path.exists(
+            os.path.join(file_cacher.file_dir, first)))
+        self.assertFalse(os.path.exists(
+            os.path.join(file_cacher.file_dir, second)))
+        self.assertTrue(os.path.exists(
+            os.path.join(file_cacher.file_dir, third)))
+
+    def test_lock_files_removed_with_files(self):
+        file_cacher = self.file_cachers[0]
+        digest = file_cacher.put_file_content(os.urandom(100))
+        file_cacher.drop(digest)
+        file_cacher.get_file_content(digest)
+        self.assertTrue(os.path.exists(
+            os.path.join(file_cacher.lock_dir, digest)))
+
+        file_cacher.index.max_size = 150
+        file_cacher.put_file_content(os.urandom(100))
+        self.assertFalse(os.path.exists(
+            os.path.join(file_cacher.file_dir, digest)))
+        self.assertFalse(os.path.exists(
+            os.path.join(file_cacher.lock_dir, digest)))
+
+    def test_purge_cache(self):
+        digests = [file_cacher.put_file_content(os.urandom(100))
+                   for file_cacher in self.file_cachers]
+
+        self.file_cachers[0].purge_cache()
+
+        for digest in digests:
+            self.assertFalse(os.path.exists(
+                os.path.join(self.file_cachers[0].file_dir, digest)))
+        # The cache is still usable.
+        for digest in digests:
+            self.file_cachers[1].get_file_content(digest)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for fsobject.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+import os
+import unittest
+
+from mock import patch
+
+# Needs to be first to allow for monkey patching the DB connection string.
+from cmstestsuite.unit_tests.databasemixin import DatabaseMixin
+
+from cms.db import LargeObject, LargeObjectReader
+
+
+class TestLargeObjectReader(DatabaseMixin, unittest.TestCase):
+    """Tests for LargeObjectReader."""
+
+    def setUp(self):
+        super(TestLargeObjectReader, self).setUp()
+        self.loids = []
+
+    def tearDown(self):
+        for loid in self.loids:
+            LargeObject.unlink(loid)
+        super(TestLargeObjectReader, self).tearDown()
+
+    def create_lobject(self, content):
+        with LargeObject(0, mode='wb') as lobj:
+            lobj.write(content)
+        self.loids.append(lobj.loid)
+        return lobj.loid
+
+    def test_read_all(self):
+        content = os.urandom(100000)
+        loid = self.create_lobject(content)
+        with patch.object(LargeObjectReader, "MIN_CHUNK_SIZE", 1000):
+            with LargeObjectReader(loid, 8000) as reader:
+                self.assertEqual(reader.read(), content)
+
+    def test_slices_grow_up_to_max(self):
+        loid = self.create_lobject(os.urandom(30000))
+        with patch.object(LargeObjectReader, "MIN_CHUNK_SIZE", 1000):
+            with LargeObjectReader(loid, 4000) as reader:
+                with patch.object(reader, "_fetch",
+                                  wraps=reader._fetch) as fetch:
+                    received = []
+                    while True:
+                        buf = bytearray(10)
+                        n = reader.readinto(buf)
+                        if n == 0:
+                            break
+                        received.append(n)
+        # 1000 + 2000 + 4000 * 6 + 3000 (short, hence no further query).
+        self.assertEqual(fetch.call_count, 9)
+        self.assertEqual(sum(received), 30000)
+
+    def test_large_buffer(self):
+        # A buffer larger than the current slice size is filled in a
+        # single query.
+        content = os.urandom(50000)
+        loid = self.create_lobject(content)
+        with patch.object(LargeObjectReader, "MIN_CHUNK_SIZE", 1000):
+            with LargeObjectReader(loid, 4000) as reader:
+                buf = bytearray(20000)
+                self.assertEqual(reader.readinto(buf), 20000)
+                self.assertEqual(bytes(buf), content[:20000])
+
+    def test_empty(self):
+        loid = self.create_lobject(b"")
+        with LargeObjectReader(loid, 4000) as reader:
+            self.assertEqual(reader.read(), b"")
+
+    def test_closed(self):
+        loid = self.create_lobject(b"content")
+        reader = LargeObjectReader(loid, 4000)
+        reader.close()
+        self.assertTrue(reader.closed)
+        with self.assertRaises(ValueError):
+            reader.read()
+        # Closing again does nothing.
+        reader.close()
+
+    def test_missing(self):
+        loid = self.create_lobject(b"content")
+        LargeObject.unlink(loid)
+        self.loids.remove(loid)
+        with LargeObjectReader(loid, 4000) as reader:
+            with self.assertRaises(IOError):
+                reader.read()
+
+
+if __name__ == "__main__":
+    unittest.main()
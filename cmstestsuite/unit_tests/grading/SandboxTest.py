@@ -29,8 +29,13 @@ from future.builtins import *  # noqa
 
 import unittest
 import io
+import os
+import shutil
+import tempfile
 
-from cms.grading.Sandbox import Truncator
+from mock import Mock, patch
+
+from cms.grading.Sandbox import IsolateSandbox, SandboxSlot, Truncator
 
 
 class TestTruncator(unittest.TestCase):
@@ -70,5 +75,97 @@ class TestTruncator(unittest.TestCase):
         self.perform_truncator_test(100, 40, 7)
 
 
+class TestIsolateSandboxPool(unittest.TestCase):
+    """Test the reuse of isolate boxes amongst the sandboxes of a slot."""
+
+    def setUp(self):
+        super(TestIsolateSandboxPool, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        patcher = patch("cms.grading.Sandbox.subprocess")
+        self.subprocess = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.subprocess.Popen.side_effect = self.popen
+        self.slot = SandboxSlot(0, 10)
+        self.inits = []
+
+    def popen(self, command, **kwargs):
+        """Simulate isolate --init, creating the box directory."""
+        box_dir = os.path.join(self.temp_dir, "box%d" % len(self.inits))
+        os.makedirs(os.path.join(box_dir, "box"))
+        self.inits.append(command)
+        popen = Mock(returncode=0)
+        popen.communicate.return_value = (box_dir.encode("utf-8"), None)
+        return popen
+
+    def isolate_cleanups(self):
+        return [c for c in self.subprocess.call.call_args_list
+                if "--cleanup" in c[0][0]]
+
+    def new_sandbox(self):
+        with self.slot.use():
+            return IsolateSandbox(None, temp_dir=self.temp_dir)
+
+    def test_reuse(self):
+        sandbox = self.new_sandbox()
+        self.assertEqual(len(self.inits), 1)
+        sandbox.create_file_from_string("output.txt", b"1")
+        box_path = os.path.join(self.temp_dir, "box0", "box")
+        os.makedirs(os.path.join(box_path, "dir"))
+        self.subprocess.call.reset_mock()
+
+        sandbox.cleanup(delete=True)
+        self.assertEqual(self.isolate_cleanups(), [])
+        self.assertFalse(os.path.exists(sandbox.get_root_path()))
+        self.assertEqual(os.listdir(box_path), [])
+
+        other = self.new_sandbox()
+        self.assertEqual(len(self.inits), 1)
+        self.assertEqual(other.box_id, sandbox.box_id)
+        self.assertFalse(other.file_exists("output.txt"))
+        self.assertEqual(self.slot.leases, 2)
+        self.assertEqual(self.slot.reused_leases, 1)
+
+    def test_not_deleted(self):
+        # Sandboxes kept around (e.g., after a failure) give back their
+        # box to isolate, and the next sandbox starts from scratch.
+        sandbox = self.new_sandbox()
+        self.subprocess.call.reset_mock()
+        sandbox.cleanup(delete=False)
+        self.assertEqual(len(self.isolate_cleanups()), 1)
+
+        self.new_sandbox()
+        self.assertEqual(len(self.inits), 2)
+        self.assertEqual(self.slot.reused_leases, 0)
+
+    def test_cannot_recycle(self):
+        sandbox = self.new_sandbox()
+        self.subprocess.call.reset_mock()
+        with patch("cms.grading.Sandbox.rmtree",
+                   side_effect=[OSError(), None]):
+            sandbox.cleanup(delete=True)
+        self.assertEqual(len(self.isolate_cleanups()), 1)
+
+        self.new_sandbox()
+        self.assertEqual(len(self.inits), 2)
+
+    def test_clear(self):
+        sandbox = self.new_sandbox()
+        sandbox.create_file_from_string("foo", b"exe")
+        sandbox.create_file_from_string("output.txt", b"1")
+        box_path = os.path.join(self.temp_dir, "box0", "box")
+        io.open(os.path.join(box_path, "left"), "wb").close()
+
+        sandbox.clear(keep=["foo"])
+        self.assertEqual(os.listdir(sandbox.relative_path("")), ["foo"])
+        self.assertEqual(os.listdir(box_path), [])
+
+    def test_no_slot(self):
+        sandbox = IsolateSandbox(None, temp_dir=self.temp_dir)
+        sandbox.cleanup(delete=True)
+        IsolateSandbox(None, temp_dir=self.temp_dir)
+        self.assertEqual(len(self.inits), 2)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -272,10 +272,11 @@ class TestCheckerStep(unittest.TestCase):
         ret = checker_step(self.sandbox, "c_dig", "i_dig", "co_dig", "o")
 
         self.assertEqual(ret, (True, 0.123, ["Text."]))
-        self.file_cacher.get_file_to_fobj.assert_has_calls([
-            call("c_dig", ANY),
-            call("i_dig", ANY),
-            call("co_dig", ANY),
+        self.file_cacher.get_file_to_fobj.assert_called_once_with(
+            "c_dig", ANY)
+        self.file_cacher.link_file_to_path.assert_has_calls([
+            call("i_dig", ANY, allow_hard_link=True),
+            call("co_dig", ANY, allow_hard_link=True),
         ], any_order=True)
         self.mock_trusted_step.assert_called_once_with(
             self.sandbox, [["./checker", trusted.CHECKER_INPUT_FILENAME,
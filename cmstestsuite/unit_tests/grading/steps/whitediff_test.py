@@ -26,10 +26,38 @@ from __future__ import unicode_literals
 from future.builtins.disabled import *  # noqa
 from future.builtins import *  # noqa
 
+import random
+import tempfile
 import unittest
 from io import BytesIO
 
-from cms.grading.steps import _WHITES, _white_diff
+from mock import patch
+
+from cms.grading.steps import _WHITES, _white_diff, white_diff_fobj_step
+from cms.grading.steps.whitediff import _exact_match
+
+
+def _white_diff_by_lines(output, res):
+    """Compare the files as _white_diff did before reading them in
+    chunks, one line at a time; used as a reference.
+
+    """
+    whites = b''.join(_WHITES)
+    while True:
+        lout = output.readline()
+        lres = res.readline()
+        if len(lres) == 0 and len(lout) == 0:
+            return True
+        elif len(lres) == 0 or len(lout) == 0:
+            if len(lout.strip(whites)) > 0 or len(lres.strip(whites)) > 0:
+                return False
+        else:
+            for char in _WHITES[1:]:
+                lout = lout.replace(char, _WHITES[0])
+                lres = lres.replace(char, _WHITES[0])
+            if [x for x in lout.split(_WHITES[0]) if len(x) > 0] != \
+                    [x for x in lres.split(_WHITES[0]) if len(x) > 0]:
+                return False
 
 
 class TestWhiteDiff(unittest.TestCase):
@@ -76,5 +104,105 @@ class TestWhiteDiff(unittest.TestCase):
         self.assertFalse(self._diff("1\n\n2", "1\n2"))
 
 
+class TestWhiteDiffChunks(unittest.TestCase):
+    """Compare _white_diff with the line-based reference on random
+    files, reading them in tiny chunks to exercise the boundaries.
+
+    """
+
+    ALPHABET = [b'a', b'b', b'\n'] + _WHITES
+
+    def setUp(self):
+        super(TestWhiteDiffChunks, self).setUp()
+        self.random = random.Random(42)
+
+    def random_file(self):
+        return b''.join(self.random.choice(TestWhiteDiffChunks.ALPHABET)
+                        for _ in range(self.random.randint(0, 20)))
+
+    def respace(self, content):
+        """Return content with different whitespaces, but the same
+        tokens in the same lines, plus possibly some blank lines.
+
+        """
+        lines = []
+        for line in content.split(b'\n'):
+            tokens = line.split()
+            # Whitespaces between the tokens can change but not vanish.
+            whites = [self.random.choice(_WHITES[:2] + _WHITES[3:])
+                      * self.random.randint(0 if i in (0, len(tokens))
+                                            else 1, 2)
+                      for i in range(len(tokens) + 1)]
+            lines.append(b''.join(w + t for w, t in zip(whites, tokens))
+                         + whites[-1])
+        lines.extend([b' '] * self.random.randint(0, 2))
+        return b'\n'.join(lines)
+
+    def assertSameAsReference(self, s1, s2):
+        expected = _white_diff_by_lines(BytesIO(s1), BytesIO(s2))
+        for chunk_size in [1, 2, 3, 5, 2 ** 20]:
+            with patch("cms.grading.steps.whitediff._CHUNK_SIZE",
+                       chunk_size):
+                self.assertEqual(
+                    _white_diff(BytesIO(s1), BytesIO(s2)), expected,
+                    "%r %r (chunk size %d)" % (s1, s2, chunk_size))
+
+    def test_random(self):
+        for _ in range(2000):
+            self.assertSameAsReference(self.random_file(),
+                                       self.random_file())
+
+    def test_random_equivalent(self):
+        for _ in range(2000):
+            content = self.random_file()
+            self.assertSameAsReference(content, self.respace(content))
+
+    def test_random_one_change(self):
+        for _ in range(2000):
+            content = self.random_file() + b'a'
+            changed = bytearray(self.respace(content))
+            changed[self.random.randrange(len(changed))] = \
+                ord(self.random.choice(TestWhiteDiffChunks.ALPHABET))
+            self.assertSameAsReference(content, bytes(changed))
+
+
+class TestExactMatch(unittest.TestCase):
+
+    @staticmethod
+    def _file(content):
+        fobj = tempfile.TemporaryFile()
+        fobj.write(content)
+        fobj.seek(0)
+        return fobj
+
+    def test_identical(self):
+        with self._file(b"1 2\n3\n") as f1, self._file(b"1 2\n3\n") as f2:
+            self.assertTrue(_exact_match(f1, f2))
+
+    def test_same_size(self):
+        with self._file(b"1 2\n3\n") as f1, self._file(b"1  2\n3") as f2:
+            self.assertFalse(_exact_match(f1, f2))
+            # The files are rewound to be compared again.
+            self.assertEqual(f1.tell(), 0)
+            self.assertEqual(f2.tell(), 0)
+
+    def test_different_size(self):
+        with self._file(b"1 2\n3\n") as f1, self._file(b"1 2\n3") as f2:
+            self.assertFalse(_exact_match(f1, f2))
+
+    def test_no_file_descriptor(self):
+        self.assertFalse(_exact_match(BytesIO(b"1"), BytesIO(b"1")))
+
+    def test_step(self):
+        with patch("cms.grading.steps.whitediff._CHUNK_SIZE", 2):
+            for content, outcome in [(b"1 2\n3\n", 1.0),
+                                     (b"1  2\n3", 1.0),
+                                     (b"1 2\n4\n", 0.0)]:
+                with self._file(content) as f1, \
+                        self._file(b"1 2\n3\n") as f2:
+                    self.assertEqual(white_diff_fobj_step(f1, f2)[0],
+                                     outcome)
+
+
 if __name__ == "__main__":
     unittest.main()
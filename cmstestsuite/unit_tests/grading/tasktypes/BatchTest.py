@@ -31,7 +31,9 @@ import unittest
 from mock import MagicMock, call, ANY
 
 from cms.db import File, Manager, Executable
+from cms.db.filecacher import TombstoneError
 from cms.grading.Job import CompilationJob, EvaluationJob
+from cms.grading.Sandbox import SandboxSlot
 from cms.grading.tasktypes.Batch import Batch
 from cmstestsuite.unit_tests.grading.tasktypes.tasktypetestutils import \
     COMPILATION_COMMAND_1, COMPILATION_COMMAND_2, EVALUATION_COMMAND_1, \
@@ -354,7 +356,7 @@ class TestEvaluate(TaskTypeTestMixin, unittest.TestCase):
         # executable copied in the sandbox.
         sandbox.create_file_from_storage.assert_has_calls([
             call("foo", "digest of foo", executable=True),
-            call("input.txt", "digest of input"),
+            call("input.txt", "digest of input", readonly=True),
         ], any_order=True)
         self.assertEqual(sandbox.create_file_from_storage.call_count, 2)
         # Evaluation step called with the right arguments, in particular
@@ -475,7 +477,7 @@ class TestEvaluate(TaskTypeTestMixin, unittest.TestCase):
         # executable copied in the sandbox.
         sandbox.create_file_from_storage.assert_has_calls([
             call("foo", "digest of foo", executable=True),
-            call("myin", "digest of input"),
+            call("myin", "digest of input", readonly=True),
         ], any_order=True)
         self.assertEqual(sandbox.create_file_from_storage.call_count, 2)
         # Evaluation step called with the right arguments, in particular
@@ -528,5 +530,163 @@ class TestEvaluate(TaskTypeTestMixin, unittest.TestCase):
         sandbox.cleanup.assert_called_once_with(delete=True)
 
 
+class TestEvaluateMany(TaskTypeTestMixin, unittest.TestCase):
+    """Tests for evaluate_many()."""
+
+    def setUp(self):
+        super(TestEvaluateMany, self).setUp()
+        self.setUpMocks("Batch")
+        self.languages.update({LANG_1})
+        self.file_cacher = MagicMock()
+        self.tt = Batch(["alone", ["", ""], "diff"])
+        self.evaluation_step.return_value = (True, True, STATS_OK)
+        self.eval_output.return_value = (True, OUTCOME, TEXT)
+
+    @staticmethod
+    def job(executable, input_digest):
+        return EvaluationJob(language="L1",
+                             input=input_digest,
+                             output="digest of correct output",
+                             time_limit=2.5,
+                             memory_limit=123,
+                             executables={executable.filename: executable})
+
+    def test_shared_sandbox(self):
+        exe_bar = Executable(digest="digest of bar", filename="bar")
+        jobs = [self.job(EXE_FOO, "digest of input 1"),
+                self.job(EXE_FOO, "digest of input 2"),
+                self.job(exe_bar, "digest of input 3")]
+        sandbox = self.expect_sandbox()
+        other_sandbox = self.expect_sandbox()
+
+        self.tt.evaluate_many(jobs, self.file_cacher)
+
+        # The executable is put in the sandbox once, and the files of
+        # the first job are deleted before the second.
+        sandbox.create_file_from_storage.assert_has_calls([
+            call("foo", "digest of foo", executable=True),
+            call("input.txt", "digest of input 1", readonly=True),
+            call("input.txt", "digest of input 2", readonly=True),
+        ])
+        self.assertEqual(sandbox.create_file_from_storage.call_count, 3)
+        sandbox.clear.assert_called_once_with(keep=["foo"])
+        sandbox.cleanup.assert_called_once_with(delete=True)
+        # A different executable needs a new sandbox.
+        other_sandbox.create_file_from_storage.assert_has_calls([
+            call("bar", "digest of bar", executable=True),
+            call("input.txt", "digest of input 3", readonly=True),
+        ])
+        other_sandbox.clear.assert_not_called()
+        other_sandbox.cleanup.assert_called_once_with(delete=True)
+
+        self.assertEqual(self.evaluation_step.call_count, 3)
+        for job in jobs:
+            self.assertTrue(job.success)
+            self.assertEqual(job.outcome, str(OUTCOME))
+
+    def test_failure(self):
+        # A sandbox that failed is kept, and not reused.
+        jobs = [self.job(EXE_FOO, "digest of input 1"),
+                self.job(EXE_FOO, "digest of input 2")]
+        sandbox = self.expect_sandbox()
+        other_sandbox = self.expect_sandbox()
+        self.evaluation_step.side_effect = [(False, None, None),
+                                            (True, True, STATS_OK)]
+
+        self.tt.evaluate_many(jobs, self.file_cacher)
+
+        sandbox.cleanup.assert_called_once_with(delete=False)
+        sandbox.clear.assert_not_called()
+        other_sandbox.cleanup.assert_called_once_with(delete=True)
+        self.assertFalse(jobs[0].success)
+        self.assertTrue(jobs[1].success)
+
+    def test_clear_failure(self):
+        jobs = [self.job(EXE_FOO, "digest of input 1"),
+                self.job(EXE_FOO, "digest of input 2")]
+        sandbox = self.expect_sandbox()
+        sandbox.clear.side_effect = OSError()
+        other_sandbox = self.expect_sandbox()
+
+        self.tt.evaluate_many(jobs, self.file_cacher)
+
+        sandbox.cleanup.assert_called_once_with(delete=True)
+        other_sandbox.create_file_from_storage.assert_any_call(
+            "foo", "digest of foo", executable=True)
+        self.assertTrue(jobs[1].success)
+
+    def test_interrupted(self):
+        # The sandbox is deleted, and its box freed, on errors too.
+        jobs = [self.job(EXE_FOO, "digest of input 1"),
+                self.job(EXE_FOO, "digest of input 2")]
+        sandbox = self.expect_sandbox()
+        self.evaluation_step.side_effect = [(True, True, STATS_OK),
+                                            TombstoneError()]
+
+        with self.assertRaises(TombstoneError):
+            self.tt.evaluate_many(jobs, self.file_cacher)
+
+        sandbox.cleanup.assert_called_once_with(delete=True)
+        self.assertTrue(jobs[0].success)
+        self.assertIsNone(jobs[1].success)
+
+    def test_pipelined_checker(self):
+        # The checker of each job runs while the next job runs.
+        tt = Batch(["alone", ["", ""], "comparator"])
+        jobs = [self.job(EXE_FOO, "digest of input %d" % i)
+                for i in range(3)]
+        for job in jobs:
+            job.managers["checker"] = Manager(digest="digest of checker",
+                                              filename="checker")
+        sandbox = self.expect_sandbox()
+        sandbox.file_exists.return_value = True
+        events = []
+
+        def run(*args, **kwargs):
+            events.append("run")
+            return True, True, STATS_OK
+        self.evaluation_step.side_effect = run
+
+        def check(file_cacher, job, checker_codename, **kwargs):
+            events.append("start check")
+            greenlet = MagicMock()
+            greenlet.get.side_effect = \
+                lambda: events.append("end check") or (True, OUTCOME, TEXT)
+            return greenlet
+        self.eval_output_in_background.side_effect = check
+
+        slot = SandboxSlot(0, 10, cpu=0)
+        slot.checker_slot = SandboxSlot(1, 20, cpu=1)
+        with slot.use():
+            tt.evaluate_many(jobs, self.file_cacher)
+
+        self.assertEqual(events, ["run", "start check",
+                                  "run", "start check", "end check",
+                                  "run", "start check", "end check",
+                                  "end check"])
+        self.eval_output.assert_not_called()
+        self.eval_output_in_background.assert_called_with(
+            self.file_cacher, jobs[2], "checker",
+            user_output_path="/path/0/output.txt",
+            user_output_filename="", slot=slot.checker_slot)
+        for job in jobs:
+            self.assertTrue(job.success)
+            self.assertEqual(job.outcome, str(OUTCOME))
+            self.assertEqual(job.text, TEXT)
+            self.assertEqual(job.plus, STATS_OK)
+
+    def test_pipelined_checker_without_checker(self):
+        # Outputs checked by white diff are not pipelined.
+        sandbox = self.expect_sandbox()
+        sandbox.file_exists.return_value = True
+        slot = SandboxSlot(0, 10)
+        slot.checker_slot = SandboxSlot(1, 20)
+        with slot.use():
+            self.tt.evaluate_many([self.job(EXE_FOO, "digest of input")],
+                                  self.file_cacher)
+        self.eval_output.assert_called_once()
+        self.eval_output_in_background.assert_not_called()
+
+
 if __name__ == "__main__":
     unittest.main()
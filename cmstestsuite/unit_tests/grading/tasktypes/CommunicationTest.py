@@ -379,7 +379,7 @@ class TestEvaluate(TaskTypeTestMixin, FileSystemMixin, unittest.TestCase):
         # executable copied in the sandbox.
         sandbox_mgr.create_file_from_storage.assert_has_calls([
             call("manager", "digest of manager", executable=True),
-            call("input.txt", "digest of input"),
+            call("input.txt", "digest of input", readonly=True),
         ], any_order=True)
         self.assertEqual(sandbox_mgr.create_file_from_storage.call_count, 2)
         sandbox_usr.create_file_from_storage.assert_has_calls([
@@ -625,7 +625,7 @@ class TestEvaluate(TaskTypeTestMixin, FileSystemMixin, unittest.TestCase):
         # executable copied in the sandbox.
         sandbox_mgr.create_file_from_storage.assert_has_calls([
             call("manager", "digest of manager", executable=True),
-            call("input.txt", "digest of input"),
+            call("input.txt", "digest of input", readonly=True),
         ], any_order=True)
         self.assertEqual(sandbox_mgr.create_file_from_storage.call_count, 2)
         # Same content in both user sandboxes.
@@ -134,6 +134,8 @@ class TaskTypeTestMixin(object):
         self.human_evaluation_message = self._maybe_patch(
             "human_evaluation_message")
         self.eval_output = self._maybe_patch("eval_output")
+        self.eval_output_in_background = self._maybe_patch(
+            "eval_output_in_background")
         self.extract_outcome_and_text = self._maybe_patch(
             "extract_outcome_and_text")
 
@@ -26,10 +26,21 @@ from __future__ import unicode_literals
 from future.builtins.disabled import *  # noqa
 from future.builtins import *  # noqa
 
+import io
+import os
+import shutil
+import tempfile
 import unittest
+from io import BytesIO
 
+from mock import Mock, patch
+
+from cms import config
 from cms.grading import Language
+from cms.grading.Sandbox import SandboxSlot
 from cms.grading.tasktypes import is_manager_for_compilation
+from cms.grading.tasktypes.util import eval_output, \
+    eval_output_in_background
 
 
 class TestLanguage(Language):
@@ -99,5 +110,97 @@ class TestIsManagerForCompilation(unittest.TestCase):
         self.assertIsNotForCompilation("test.srcext1.")
 
 
+class TestEvalOutput(unittest.TestCase):
+    """Test the function eval_output with the white diff."""
+
+    def setUp(self):
+        super(TestEvalOutput, self).setUp()
+        self.file_cacher = Mock()
+        self.file_cacher.get_file.side_effect = \
+            lambda digest: BytesIO(self.files[digest])
+        self.job = Mock(output="correct")
+
+    def test_identical_digest(self):
+        self.assertEqual(
+            eval_output(self.file_cacher, self.job, None,
+                        user_output_digest="correct")[:2],
+            (True, 1.0))
+        # Nothing was read.
+        self.file_cacher.get_file.assert_not_called()
+
+    def test_different_digest(self):
+        self.files = {"correct": b"1 2\n", "user": b"1  2"}
+        self.assertEqual(
+            eval_output(self.file_cacher, self.job, None,
+                        user_output_digest="user")[:2],
+            (True, 1.0))
+        self.files["user"] = b"1 3"
+        self.assertEqual(
+            eval_output(self.file_cacher, self.job, None,
+                        user_output_digest="user")[:2],
+            (True, 0.0))
+
+
+class TestEvalOutputInBackground(unittest.TestCase):
+    """Test the function eval_output_in_background with a checker."""
+
+    def setUp(self):
+        super(TestEvalOutputInBackground, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.user_output_path = os.path.join(self.dir, "output.txt")
+        with io.open(self.user_output_path, "wb") as f:
+            f.write(b"output")
+
+        self.sandbox = Mock()
+        self.sandbox.relative_path.side_effect = \
+            lambda path: os.path.join(self.dir, "copy_" + path)
+        patcher = patch("cms.grading.tasktypes.util.create_sandbox",
+                        return_value=self.sandbox)
+        self.create_sandbox = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(config, "keep_sandbox", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("cms.grading.tasktypes.util.checker_step",
+                        return_value=(True, 1.0, ["Ok"]))
+        self.checker_step = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.job = Mock(managers={"checker": Mock(digest="checker")},
+                        input="input", output="correct", sandboxes=[],
+                        keep_sandbox=False)
+
+    def test_checker(self):
+        slot = SandboxSlot(0, 10, cpu=1)
+        slots = []
+        self.create_sandbox.side_effect = \
+            lambda *args, **kwargs: slots.append(SandboxSlot.current()) \
+            or self.sandbox
+
+        greenlet = eval_output_in_background(
+            Mock(), self.job, "checker",
+            user_output_path=self.user_output_path, slot=slot)
+        # The sandbox of the checker is created in the slot, and the
+        # output copied, before returning.
+        self.assertEqual(slots, [slot])
+        os.remove(self.user_output_path)
+        with io.open(self.sandbox.relative_path("user_output.txt"),
+                     "rb") as f:
+            self.assertEqual(f.read(), b"output")
+
+        self.assertEqual(greenlet.get(), (True, 1.0, ["Ok"]))
+        self.checker_step.assert_called_once_with(
+            self.sandbox, "checker", "input", "correct", "user_output.txt")
+        self.sandbox.cleanup.assert_called_once_with(delete=True)
+
+    def test_no_output(self):
+        greenlet = eval_output_in_background(
+            Mock(), self.job, "checker",
+            user_output_path=os.path.join(self.dir, "missing.txt"))
+        self.assertEqual(greenlet.get()[:2], (True, 0.0))
+        self.create_sandbox.assert_not_called()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -181,7 +181,68 @@ class TestPriorityQueue(unittest.TestCase):
         self.assertTrue(self.item_b in self.queue)
         self.queue.remove(self.item_b)
         self.assertFalse(self.item_b in self.queue)
-        self.queue._verify()
+        self.assertTrue(self.queue._verify())
+
+        with self.assertRaises(KeyError):
+            self.queue.remove(self.item_b)
+        self.assertEqual(self.queue.pop().item, self.item_c)
+        self.assertEqual(self.queue.pop().item, self.item_a)
+        self.assertTrue(self.queue._verify())
+
+    def test_set_priority_repeated(self):
+        """Test that stale priorities are ignored."""
+        self.queue.push(self.item_a, PriorityQueue.PRIORITY_LOW)
+        self.queue.push(self.item_b, PriorityQueue.PRIORITY_MEDIUM)
+        for priority in [PriorityQueue.PRIORITY_HIGH,
+                         PriorityQueue.PRIORITY_EXTRA_LOW,
+                         PriorityQueue.PRIORITY_LOW]:
+            self.queue.set_priority(self.item_a, priority)
+        self.assertTrue(self.queue._verify())
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(self.queue.pop().item, self.item_b)
+        top = self.queue.pop()
+        self.assertEqual(top.item, self.item_a)
+        self.assertEqual(top.priority, PriorityQueue.PRIORITY_LOW)
+        self.assertTrue(self.queue.empty())
+        self.assertTrue(self.queue._verify())
+
+    def test_push_many(self):
+        """Test that many items are pushed at once."""
+        self.queue.push(self.item_a, PriorityQueue.PRIORITY_LOW)
+        entries = self.queue.push_many([
+            (self.item_a, PriorityQueue.PRIORITY_HIGH, None),
+            (self.item_b, PriorityQueue.PRIORITY_MEDIUM, make_datetime(10)),
+            (self.item_c, None, make_datetime(5)),
+            (self.item_d, PriorityQueue.PRIORITY_HIGH, None),
+            (self.item_d, PriorityQueue.PRIORITY_LOW, None),
+        ])
+        self.assertEqual([entry.item for entry in entries],
+                         [self.item_b, self.item_c, self.item_d])
+        self.assertTrue(self.queue._verify())
+        self.assertEqual(self.queue.push_many([]), [])
+
+        self.assertEqual(
+            [self.queue.pop().item for _ in range(4)],
+            [self.item_d, self.item_c, self.item_b, self.item_a])
+        self.assertTrue(self.queue._verify())
+
+    def test_rebuild(self):
+        """Test that the queue stays consistent when many items are
+        removed.
+
+        """
+        items = [FakeQueueItem("%d" % i)
+                 for i in range(3 * PriorityQueue.MIN_STALE_TO_REBUILD)]
+        self.queue.push_many(
+            (item, PriorityQueue.PRIORITY_MEDIUM, make_datetime(i))
+            for i, item in enumerate(items))
+        for item in items[1:-1]:
+            self.queue.remove(item)
+        self.assertTrue(self.queue._verify())
+        self.assertLess(len(self.queue._heap), len(items))
+        self.assertEqual(self.queue.pop().item, items[0])
+        self.assertEqual(self.queue.pop().item, items[-1])
+        self.assertTrue(self.queue._verify())
 
 
 if __name__ == "__main__":
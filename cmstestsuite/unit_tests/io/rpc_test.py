@@ -29,6 +29,7 @@ from __future__ import unicode_literals
 from future.builtins.disabled import *  # noqa
 from future.builtins import *  # noqa
 
+import json
 import unittest
 
 import gevent
@@ -41,6 +42,9 @@ from mock import Mock, patch
 from cms import Address, ServiceCoord
 from cms.io import RPCError, rpc_method, RemoteServiceServer, \
     RemoteServiceClient
+from cms.io.rpc import FRAME_HEADER, FRAME_LAST, FRAMING_BINARY, \
+    FRAMING_LINE, NEGOTIATION_METHOD, SERIALIZATION_JSON, \
+    SERIALIZATION_MSGPACK, supported_serializations
 
 
 class MockService(object):
@@ -427,6 +431,154 @@ class TestRPC(unittest.TestCase):
         self.assertFalse(self.servers[0].connected)
         sock.close()
 
+    def test_negotiation(self):
+        client = self.get_client(ServiceCoord("Foo", 0))
+        self.sleep()
+        for endpoint in [client, self.servers[0]]:
+            self.assertEqual(endpoint._framing, FRAMING_BINARY)
+            self.assertEqual(endpoint._serialization,
+                             supported_serializations()[0])
+
+    @patch("cms.io.rpc.supported_serializations")
+    def test_negotiation_json(self, supported_serializations_mock):
+        supported_serializations_mock.return_value = [SERIALIZATION_JSON]
+        client = self.get_client(ServiceCoord("Foo", 0))
+        self.sleep()
+        self.assertEqual(client._serialization, SERIALIZATION_JSON)
+        result = client.echo(value={"a": [1, 2.5, None, "b"]})
+        result.wait()
+        self.assertEqual(result.value, {"a": [1, 2.5, None, "b"]})
+
+    def assertJSONSemantics(self, serialization):
+        with patch("cms.io.rpc.supported_serializations",
+                   return_value=[serialization]):
+            client = self.get_client(ServiceCoord("Foo", 0))
+            self.sleep()
+            self.assertEqual(client._serialization, serialization)
+            result = client.echo(value={1: b"a", "b": [b"c", {2.5: 3}]})
+            result.wait()
+        self.assertTrue(result.successful())
+        self.assertEqual(result.value, {"1": "a", "b": ["c", {"2.5": 3}]})
+        self.assertIsInstance(result.value["1"], str)
+
+    def test_json_semantics_json(self):
+        self.assertJSONSemantics(SERIALIZATION_JSON)
+
+    def test_json_semantics_msgpack(self):
+        if SERIALIZATION_MSGPACK not in supported_serializations():
+            self.skipTest("msgpack not available.")
+        self.assertJSONSemantics(SERIALIZATION_MSGPACK)
+
+    @patch.object(RemoteServiceServer, "negotiate")
+    def test_server_without_negotiation(self, negotiate_mock):
+        # A server predating the negotiation treats the negotiation as
+        # a call to a missing method; the client falls back to the
+        # original transport.
+        negotiate_mock.return_value = False
+        client = self.get_client(ServiceCoord("Foo", 0))
+        self.assertEqual(client._framing, FRAMING_LINE)
+        self.assertEqual(client._serialization, SERIALIZATION_JSON)
+        result = client.echo(value=42)
+        result.wait()
+        self.assertTrue(result.successful())
+        self.assertEqual(result.value, 42)
+
+    def test_client_without_negotiation(self):
+        sock = gevent.socket.create_connection((self.host, self.port))
+        sock.sendall(json.dumps({"__id": "foo",
+                                 "__method": "echo",
+                                 "__data": {"value": 42}}).encode('utf-8')
+                     + b"\r\n")
+        response = json.loads(sock.makefile('rb').readline().decode('utf-8'))
+        self.assertEqual(response["__id"], "foo")
+        self.assertEqual(response["__data"], 42)
+        self.assertEqual(self.servers[0]._framing, FRAMING_LINE)
+        sock.close()
+
+    def test_large_message(self):
+        # Larger than MAX_MESSAGE_SIZE, and spanning many frames.
+        value = "x" * (3 * RemoteServiceServer.MAX_MESSAGE_SIZE)
+        client = self.get_client(ServiceCoord("Foo", 0))
+        result = client.echo(value=value)
+        result.wait()
+        self.assertTrue(result.successful())
+        self.assertEqual(result.value, value)
+
+    def test_interleaved_frames(self):
+        sock = gevent.socket.create_connection((self.host, self.port))
+        reader = sock.makefile('rb')
+        sock.sendall(json.dumps({
+            "__id": "nego",
+            "__method": NEGOTIATION_METHOD,
+            "__data": {"framings": [FRAMING_BINARY],
+                       "serializations": [SERIALIZATION_JSON]}
+        }).encode('utf-8') + b"\r\n")
+        response = json.loads(reader.readline().decode('utf-8'))
+        self.assertEqual(response["__data"],
+                         {"framing": FRAMING_BINARY,
+                          "serialization": SERIALIZATION_JSON})
+
+        def frame(message_id, payload, last):
+            return FRAME_HEADER.pack(message_id, len(payload),
+                                     FRAME_LAST if last else 0) + payload
+
+        first = json.dumps({"__id": "first", "__method": "echo",
+                            "__data": {"value": 1}}).encode('utf-8')
+        second = json.dumps({"__id": "second", "__method": "echo",
+                             "__data": {"value": 2}}).encode('utf-8')
+        sock.sendall(frame(7, first[:10], False)
+                     + frame(8, second, True)
+                     + frame(7, first[10:], True))
+
+        values = dict()
+        for _ in range(2):
+            message_id, length, flags = FRAME_HEADER.unpack(
+                reader.read(FRAME_HEADER.size))
+            self.assertTrue(flags & FRAME_LAST)
+            response = json.loads(reader.read(length).decode('utf-8'))
+            values[response["__id"]] = response["__data"]
+        self.assertEqual(values, {"first": 1, "second": 2})
+        sock.close()
+
+    def test_frame_too_long(self):
+        client = self.get_client(ServiceCoord("Foo", 0))
+        self.sleep()
+        client._writer.write(FRAME_HEADER.pack(
+            0, RemoteServiceServer.MAX_MESSAGE_SIZE + 1, FRAME_LAST))
+        client._writer.flush()
+        self.sleep()
+        self.assertFalse(self.servers[0].connected)
+
+    def _send_partial_frames(self, message_ids, frames, size):
+        client = self.get_client(ServiceCoord("Foo", 0))
+        self.sleep()
+        for message_id in message_ids:
+            for _ in range(frames):
+                client._writer.write(
+                    FRAME_HEADER.pack(message_id, size, 0) + b"x" * size)
+        client._writer.flush()
+        self.sleep()
+
+    @patch.object(RemoteServiceServer, "MAX_PARTIAL_MESSAGE_SIZE", 1000)
+    def test_partial_message_too_long(self):
+        self._send_partial_frames([0], 11, 100)
+        self.assertFalse(self.servers[0].connected)
+
+    @patch.object(RemoteServiceServer, "MAX_PARTIAL_MESSAGES_SIZE", 1000)
+    def test_partial_messages_too_long(self):
+        self._send_partial_frames(range(4), 3, 100)
+        self.assertFalse(self.servers[0].connected)
+
+    @patch.object(RemoteServiceServer, "MAX_PARTIAL_MESSAGES", 4)
+    def test_too_many_partial_messages(self):
+        self._send_partial_frames(range(5), 1, 1)
+        self.assertFalse(self.servers[0].connected)
+
+    @patch.object(RemoteServiceServer, "MAX_PARTIAL_MESSAGES", 4)
+    def test_partial_messages_within_limits(self):
+        self._send_partial_frames(range(4), 1, 1)
+        self.assertTrue(self.servers[0].connected)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -77,6 +77,15 @@ class FakeBatchExecutor(FakeExecutor):
         super(FakeBatchExecutor, self).execute(operations[0])
 
 
+class FakeSmallBatchExecutor(FakeBatchExecutor):
+    def __init__(self, notifier, batch_size):
+        super(FakeSmallBatchExecutor, self).__init__(notifier)
+        self._batch_size = batch_size
+
+    def fits_in_batch(self, entries, entry):
+        return len(entries) < self._batch_size
+
+
 class FakeTriggeredService(TriggeredService):
     def __init__(self, shard, timeout):
         super(FakeTriggeredService, self).__init__(shard)
@@ -86,10 +95,21 @@ class FakeTriggeredService(TriggeredService):
         # missing_operations().
         self._operations = []
 
+        self.full_sweeps = 0
+        self.incremental_sweeps = 0
+
     def add_missing_operation(self, operation):
         self._operations.append(operation)
 
     def _missing_operations(self):
+        self.full_sweeps += 1
+        return self._enqueue_missing_operations()
+
+    def _missing_operations_incremental(self):
+        self.incremental_sweeps += 1
+        return self._enqueue_missing_operations()
+
+    def _enqueue_missing_operations(self):
         counter = 0
         while self._operations != []:
             counter += 1
@@ -141,6 +161,18 @@ class TestTriggeredService(unittest.TestCase):
         for notifier in self.notifiers:
             self.assertEqual(notifier.get_notifications(), 2)
 
+    def test_sweeper_full(self):
+        """Test that only the first and requested sweeps are full."""
+        self.setUpService(0.1)
+        gevent.sleep(0.25)
+        self.assertEqual(self.service.full_sweeps, 1)
+        self.assertEqual(self.service.incremental_sweeps, 2)
+
+        self.service.search_operations_not_done()
+        gevent.sleep(0.01)
+        self.assertEqual(self.service.full_sweeps, 2)
+        self.assertEqual(self.service.incremental_sweeps, 2)
+
     def test_bad_executor(self):
         """Test that a slow executor does not block the others."""
         self.setUpService()
@@ -179,6 +211,17 @@ class TestTriggeredService(unittest.TestCase):
         # Just one call to the batch executor.
         self.assertEqual(batch_notifier.get_notifications(), 1)
 
+    def test_batch_fits(self):
+        """Test a batch executor limiting the batches."""
+        self.setUpService()
+        batch_notifier = Notifier()
+        self.service.add_executor(FakeSmallBatchExecutor(batch_notifier, 2))
+        for i in range(5):
+            self.service.enqueue(FakeQueueItem('op %d' % i))
+        gevent.sleep(0.01)
+        # Batches of 2, 2 and 1 operations.
+        self.assertEqual(batch_notifier.get_notifications(), 3)
+
 
 if __name__ == "__main__":
     unittest.main()
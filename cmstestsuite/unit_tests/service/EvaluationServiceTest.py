@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the evaluation service.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime
+
+from mock import Mock, patch
+from sqlalchemy import event
+
+# Needs to be first to allow for monkey patching the DB connection string.
+from cmstestsuite.unit_tests.databasemixin import DatabaseMixin
+
+from cms import config
+from cms.db import engine
+from cms.db import Dataset, Evaluation, Submission, SubmissionResult
+from cms.grading.Job import EvaluationJob, Job
+from cms.service.EvaluationService import EvaluationService, Result
+from cms.service.esoperations import ESOperation
+from cmscommon.datetime import make_timestamp
+
+
+class TestWriteResults(DatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestWriteResults, self).setUp()
+
+        patcher = patch.object(EvaluationService, "connect_to")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = EvaluationService(0)
+        self.service.evaluation_ended = Mock()
+        self.service.compilation_ended = Mock()
+
+        self.contest = self.add_contest()
+        task = self.add_task(contest=self.contest)
+        self.dataset = self.add_dataset(task=task)
+        self.testcases = [self.add_testcase(dataset=self.dataset)
+                          for _ in range(3)]
+        self.sr = self.add_submission_result(
+            submission=self.add_submission(task=task),
+            dataset=self.dataset, compilation_outcome="ok")
+        self.session.commit()
+
+    def result(self, testcase, success=True):
+        operation = ESOperation(ESOperation.EVALUATION,
+                                self.sr.submission_id, self.dataset.id,
+                                testcase.codename)
+        job = EvaluationJob(operation=operation, shard=0, sandboxes=[],
+                            success=success, outcome="1.0", text=["Ok"],
+                            plus={"execution_time": 0.5})
+        return operation, Result(job, success)
+
+    def evaluations(self):
+        self.session.expire_all()
+        return self.session.query(Evaluation)\
+            .filter(Evaluation.submission_id == self.sr.submission_id)\
+            .filter(Evaluation.dataset_id == self.dataset.id)\
+            .all()
+
+    def sr_from_db(self):
+        self.session.expire_all()
+        return SubmissionResult.get_from_id(
+            (self.sr.submission_id, self.dataset.id), self.session)
+
+    def test_all_evaluations(self):
+        self.service.write_results(
+            [self.result(testcase) for testcase in self.testcases])
+
+        evaluations = self.evaluations()
+        self.assertEqual(
+            set(e.testcase_id for e in evaluations),
+            set(t.id for t in self.testcases))
+        for evaluation in evaluations:
+            self.assertEqual(evaluation.outcome, "1.0")
+            self.assertEqual(evaluation.text, ["Ok"])
+            self.assertEqual(evaluation.execution_time, 0.5)
+        self.assertTrue(self.sr_from_db().evaluated())
+        self.service.evaluation_ended.assert_called_once()
+
+    def test_partial_evaluations(self):
+        self.service.write_results(
+            [self.result(testcase) for testcase in self.testcases[:2]])
+        self.assertEqual(len(self.evaluations()), 2)
+        self.assertFalse(self.sr_from_db().evaluated())
+        self.service.evaluation_ended.assert_not_called()
+
+        self.service.write_results([self.result(self.testcases[2])])
+        self.assertEqual(len(self.evaluations()), 3)
+        self.assertTrue(self.sr_from_db().evaluated())
+
+    def test_conflict(self):
+        # An evaluation for the first testcase is already there: the
+        # other ones are still written.
+        self.add_evaluation(self.sr, self.testcases[0], outcome="0.0")
+        self.session.commit()
+
+        self.service.write_results(
+            [self.result(testcase) for testcase in self.testcases])
+
+        evaluations = self.evaluations()
+        self.assertEqual(len(evaluations), 3)
+        self.assertEqual(sorted(e.outcome for e in evaluations),
+                         ["0.0", "1.0", "1.0"])
+        self.assertTrue(self.sr_from_db().evaluated())
+
+    def test_failure(self):
+        self.service.write_results(
+            [self.result(self.testcases[0], success=False),
+             self.result(self.testcases[1])])
+        self.assertEqual(len(self.evaluations()), 1)
+        self.assertEqual(self.sr_from_db().evaluation_tries, 1)
+
+
+class TestEvaluationMemo(DatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestEvaluationMemo, self).setUp()
+
+        patcher = patch.object(config, "es_evaluation_memo_size", 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(EvaluationService, "connect_to")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = EvaluationService(0)
+
+        # Languages of the contest would be looked up to create jobs.
+        self.contest = self.add_contest(languages=[])
+        task = self.add_task(contest=self.contest)
+        submission = self.add_submission(task=task)
+        # A dataset and its clone, differing only in the score type,
+        # and another one with a different time limit.
+        self.datasets = [
+            self.add_dataset(task=task, time_limit=1.0, score_type=score_type)
+            for score_type in ["Sum", "GroupMin"]]
+        self.datasets.append(self.add_dataset(task=task, time_limit=2.0))
+        for dataset in self.datasets:
+            self.add_testcase(dataset=dataset, codename="001",
+                              input="digest of input",
+                              output="digest of output")
+            sr = self.add_submission_result(
+                submission=submission, dataset=dataset,
+                compilation_outcome="ok")
+            self.add_executable(sr, filename="foo", digest="digest of exe")
+        self.session.commit()
+
+        self.operations = [
+            ESOperation(ESOperation.EVALUATION, submission.id, dataset.id,
+                        "001")
+            for dataset in self.datasets]
+
+    def evaluate(self, operation):
+        """Simulate the evaluation of an operation by a worker."""
+        job = Job.from_operation(
+            operation, self.session.query(Submission).get(
+                operation.object_id),
+            self.session.query(Dataset).get(operation.dataset_id))
+        job.success = True
+        job.outcome = "1.0"
+        job.text = ["Ok"]
+        job.plus = {"execution_time": 0.5,
+                    "execution_wall_clock_time": 30.0}
+        job.shard = 0
+        self.service.evaluation_memo.store(job)
+
+    def test_memo(self):
+        self.evaluate(self.operations[0])
+        entries = [Mock(item=operation) for operation in self.operations]
+        cost_estimator = self.service.get_executor().cost_estimator
+        default_cost = cost_estimator.estimate(self.operations[1])
+
+        missing = self.service.execute_from_memo(entries)
+
+        self.assertEqual([entry.item for entry in missing],
+                         [self.operations[2]])
+        self.assertIn(self.operations[0], self.service.result_cache)
+        self.assertIn(self.operations[1], self.service.result_cache)
+        self.assertNotIn(self.operations[2], self.service.result_cache)
+        # Hits count for the estimates, as results from the workers.
+        self.assertGreater(cost_estimator.estimate(self.operations[1]),
+                           default_cost)
+
+
+class TestQueueJournal(DatabaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestQueueJournal, self).setUp()
+        task = self.add_task(contest=self.add_contest())
+        dataset = self.add_dataset(task=task)
+        task.active_dataset = dataset
+        self.submission = self.add_submission(task=task)
+        self.session.commit()
+        self.operation = ESOperation(ESOperation.COMPILATION,
+                                     self.submission.id, dataset.id)
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        for name, value in [("es_queue_journal", True),
+                            ("data_dir", data_dir)]:
+            patcher = patch.object(config, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # The sweeper, and the executor if there were workers, would
+        # look at the whole database.
+        for name in ["connect_to", "start_sweeper"]:
+            patcher = patch.object(EvaluationService, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch("cms.service.EvaluationService.get_service_shards",
+                        return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def restart(self):
+        service = EvaluationService(0)
+        self.addCleanup(service.journal.close)
+        return service
+
+    def test_restore(self):
+        operation = self.operation
+        timestamp = datetime(2018, 1, 1)
+        service = self.restart()
+        self.assertTrue(service._full_sweep_requested)
+        service.enqueue(operation, 1, timestamp)
+        service._submissions_high_water_mark = 10
+        service._user_tests_high_water_mark = 20
+        service.journal.set_high_water_marks(10, 20, make_timestamp())
+
+        service = self.restart()
+        self.assertIn(operation, service.get_executor())
+        self.assertEqual(service._submissions_high_water_mark, 10)
+        self.assertEqual(service._user_tests_high_water_mark, 20)
+        # The first sweep only checks the consistency with the DB.
+        self.assertFalse(service._full_sweep_requested)
+
+    def test_restore_done_while_down(self):
+        service = self.restart()
+        service.enqueue(self.operation, 1, datetime(2018, 1, 1))
+        self.add_submission_result(
+            submission=self.submission, dataset=self.session.query(
+                Dataset).get(self.operation.dataset_id),
+            compilation_outcome="ok")
+        self.session.commit()
+
+        service = self.restart()
+        self.assertNotIn(self.operation, service.get_executor())
+        # It was also removed from the journal.
+        service = self.restart()
+        self.assertNotIn(self.operation, service.get_executor())
+        self.assertEqual(service.journal.load(), [])
+
+    def test_operations_to_do_queries(self):
+        # The objects are loaded in bulk, not one by one.
+        task = self.submission.task
+        dataset = self.session.query(Dataset).get(self.operation.dataset_id)
+        testcases = [self.add_testcase(dataset=dataset) for _ in range(2)]
+        to_compile = [self.add_submission(task=task) for _ in range(10)]
+        to_evaluate = [self.add_submission(task=task) for _ in range(10)]
+        for submission in to_evaluate:
+            self.add_submission_result(submission=submission,
+                                       dataset=dataset,
+                                       compilation_outcome="ok")
+        self.session.commit()
+        operations = [self.operation]
+        operations += [ESOperation(ESOperation.COMPILATION,
+                                   submission.id, dataset.id)
+                       for submission in to_compile]
+        operations += [ESOperation(ESOperation.EVALUATION,
+                                   submission.id, dataset.id,
+                                   testcase.codename)
+                       for submission in to_evaluate
+                       for testcase in testcases]
+        service = self.restart()
+
+        queries = []
+
+        def count(*args):
+            queries.append(args)
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            to_do = service._operations_to_do(operations)
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+
+        self.assertEqual(to_do, set(operations))
+        self.assertLess(len(queries), 10)
+
+    def test_restore_full_sweep_due(self):
+        service = self.restart()
+        service.journal.set_high_water_marks(
+            10, 20, make_timestamp() - 2 * 3600)
+
+        service = self.restart()
+        # Things might have changed while the service was down.
+        self.assertTrue(service._full_sweep_requested)
+        self.assertIsNone(service._last_full_sweep)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -78,9 +78,11 @@ class TestProxyService(DatabaseMixin, unittest.TestCase):
                                                     team=self.team)
 
         self.new_sr_unscored()
-        self.new_sr_scored()
+        self.sr_scored = self.new_sr_scored()
         result = self.new_sr_scored()
         self.add_token(submission=result.submission)
+        self.sr_unofficial = self.new_sr_scored()
+        self.sr_unofficial.submission.official = False
 
         self.session.commit()
 
@@ -117,6 +119,21 @@ class TestProxyService(DatabaseMixin, unittest.TestCase):
         self.assertTrue(urls[4].endswith("submissions/"))
         self.assertTrue(urls[5].endswith("subchanges/"))
 
+    def test_submissions_scored(self):
+        """Scores of many submissions are sent together."""
+        service = ProxyService(0, self.contest.id)
+        gevent.sleep(0.1)
+
+        scored = []
+        with patch.object(service, "operations_for_score",
+                          side_effect=lambda s: scored.append(s.id) or []):
+            service.submissions_scored(
+                [self.sr_scored.submission_id,
+                 self.sr_unofficial.submission_id,
+                 self.sr_scored.submission_id + 1000])
+
+        self.assertEqual(scored, [self.sr_scored.submission_id])
+
 
 if __name__ == "__main__":
     unittest.main()
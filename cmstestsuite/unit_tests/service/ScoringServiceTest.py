@@ -38,12 +38,14 @@ gevent.monkey.patch_all()  # noqa
 import unittest
 
 import gevent
-from mock import patch, PropertyMock
+from mock import Mock, patch, PropertyMock
 
 # Needs to be first to allow for monkey patching the DB connection string.
 from cmstestsuite.unit_tests.databasemixin import DatabaseMixin
 
-from cms.service.ScoringService import ScoringService
+from cms.io.priorityqueue import QueueEntry
+from cms.service.ScoringService import ScoringExecutor, ScoringService
+from cms.service.scoringoperations import ScoringOperation
 from cmstestsuite.unit_tests.testidgenerator import unique_long_id, \
     unique_unicode_id
 
@@ -145,6 +147,107 @@ class TestScoringService(DatabaseMixin, unittest.TestCase):
         # Asserts that compute_score was called.
         self.score_type.compute_score.assert_not_called()
 
+    def test_new_evaluation_error(self):
+        """An error scoring a submission does not affect the others.
+
+        """
+        sr_a = self.new_sr_to_score()
+        sr_b = self.new_sr_to_score()
+        self.session.commit()
+
+        def compute_score(sr):
+            if sr.submission_id == sr_a.submission_id:
+                raise ValueError("Bad score type parameters.")
+            return self.compute_score(sr)
+        self.score_type.compute_score.side_effect = compute_score
+
+        service = ScoringService(0)
+        service.new_evaluation(sr_a.submission_id, sr_a.dataset_id)
+        service.new_evaluation(sr_b.submission_id, sr_b.dataset_id)
+
+        gevent.sleep(0.1)  # Needed to trigger the score loop.
+
+        self.assertEqual(self.call_args,
+                         [(sr_b.submission_id, sr_b.dataset_id)])
+        self.session.expire_all()
+        self.assertFalse(sr_a.scored())
+        self.assertTrue(sr_b.scored())
+
+    def test_new_evaluation_flush_error(self):
+        """A score that cannot be stored does not affect the others.
+
+        """
+        sr_a = self.new_sr_to_score()
+        sr_b = self.new_sr_to_score()
+        self.session.commit()
+
+        def compute_score(sr):
+            if sr.submission_id == sr_a.submission_id:
+                # The database rejects this when flushing.
+                return ("not a number",) + self.score_info[1:]
+            return self.compute_score(sr)
+        self.score_type.compute_score.side_effect = compute_score
+
+        proxy_service = Mock()
+        ScoringExecutor(proxy_service).execute([
+            QueueEntry(ScoringOperation(sr.submission_id, sr.dataset_id),
+                       None, None, i)
+            for i, sr in enumerate([sr_a, sr_b])])
+
+        self.session.expire_all()
+        self.assertFalse(sr_a.scored())
+        self.assertTrue(sr_b.scored())
+
+    def test_new_evaluation_notify(self):
+        """ProxyService is notified once of all active results.
+
+        """
+        sr_a = self.new_sr_to_score()
+        sr_b = self.new_sr_to_score()
+        sr_c = self.new_sr_to_score()
+        for sr in [sr_a, sr_b]:
+            sr.submission.task.active_dataset = sr.dataset
+        self.session.commit()
+
+        # Execute the batch directly, as the score loop might pick
+        # the operations one by one.
+        proxy_service = Mock()
+        ScoringExecutor(proxy_service).execute([
+            QueueEntry(ScoringOperation(sr.submission_id, sr.dataset_id),
+                       None, None, i)
+            for i, sr in enumerate([sr_a, sr_b, sr_c])])
+
+        self.assertEqual(len(self.call_args), 3)
+        proxy_service.submissions_scored.assert_called_once()
+        six.assertCountEqual(
+            self, proxy_service.submissions_scored.call_args[1]
+            ["submission_ids"],
+            [sr_a.submission_id, sr_b.submission_id])
+
+    # Testing invalidate_submission.
+
+    def test_invalidate_sharded(self):
+        """Each shard invalidates only its own partition.
+
+        """
+        sr_a = self.new_sr_scored()
+        sr_b = self.new_sr_scored()
+        self.session.commit()
+
+        service = ScoringService(0)
+        service.get_executor().enqueue = Mock()
+        service.shards = 2
+        service.other_shards = [Mock()]
+        service.invalidate_submission(contest_id=self.contest.id)
+
+        service.other_shards[0].invalidate_submission.assert_called_once_with(
+            submission_id=None, dataset_id=None, participation_id=None,
+            task_id=None, contest_id=self.contest.id, forward=False)
+        self.session.expire_all()
+        for sr in [sr_a, sr_b]:
+            self.assertEqual(sr.scored(),
+                             sr.submission.participation_id % 2 != 0)
+
 
 if __name__ == "__main__":
     unittest.main()
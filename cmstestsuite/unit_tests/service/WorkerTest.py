@@ -31,14 +31,17 @@ from future.builtins import *  # noqa
 
 import gevent
 import unittest
-from mock import Mock, call
+from mock import Mock, call, patch
 
 from cmstestsuite.unit_tests.testidgenerator import \
     unique_long_id, unique_unicode_id
 
 import cms.service.Worker
+from cms import Address, ConfigError, ServiceCoord
+from cms.db.filecacher import TombstoneError
 from cms.grading import JobException
 from cms.grading.Job import JobGroup, EvaluationJob
+from cms.grading.Sandbox import SandboxSlot
 from cms.service.Worker import Worker
 from cms.service.esoperations import ESOperation
 
@@ -257,6 +260,167 @@ class TestWorker(unittest.TestCase):
             JobGroup.import_from_dict(
                 self.service.execute_job_group(job_groups[0].export_to_dict()))
 
+    # Testing execution with multiple slots.
+
+    def set_slots(self, n_slots, pin=False):
+        with patch.object(cms.service.Worker.config, "worker_slots",
+                          n_slots), \
+                patch.object(cms.service.Worker.config, "worker_pin_slots",
+                             pin):
+            self.service.slots = Worker._create_slots(self.service.shard)
+
+    def test_create_slots(self):
+        """Slots have disjoint box id ranges."""
+        self.set_slots(4)
+        self.assertEqual(self.service.get_slots(), 4)
+        box_ids = set()
+        for slot in self.service.slots:
+            self.assertIsNone(slot.cpu)
+            slot_box_ids = set(slot.next_box_id()
+                               for _ in range(SandboxSlot.BOX_IDS_PER_SLOT))
+            self.assertEqual(len(slot_box_ids), SandboxSlot.BOX_IDS_PER_SLOT)
+            self.assertTrue(box_ids.isdisjoint(slot_box_ids))
+            box_ids |= slot_box_ids
+
+    def test_create_slots_pinned(self):
+        """Slots are pinned to the available cores, round robin."""
+        with patch("os.sched_getaffinity", create=True,
+                   return_value={3, 1}):
+            self.set_slots(3, pin=True)
+        self.assertEqual([slot.cpu for slot in self.service.slots],
+                         [1, 3, 1])
+
+    def test_create_slots_one_per_core(self):
+        """Zero slots means one for each available core."""
+        with patch("os.sched_getaffinity", create=True,
+                   return_value={0, 1, 2, 5}):
+            self.set_slots(0)
+        self.assertEqual(self.service.get_slots(), 4)
+
+    def test_create_slots_pipelined_checker(self):
+        """Checker slots have their own box id ranges and cores."""
+        with patch("os.sched_getaffinity", create=True,
+                   return_value={0, 1, 2, 3}), \
+                patch.object(cms.service.Worker.config,
+                             "worker_pipelined_checker", True):
+            self.set_slots(0, pin=True)
+        self.assertEqual(self.service.get_slots(), 2)
+        slots = self.service.slots + [slot.checker_slot
+                                      for slot in self.service.slots]
+        self.assertEqual([slot.cpu for slot in slots], [0, 1, 2, 3])
+        self.assertEqual(len(set(slot.first_box_id for slot in slots)), 4)
+
+    def test_create_slots_workers_on_same_host(self):
+        """Workers on the same host use different cores and box ids."""
+        core_services = {
+            ServiceCoord("Worker", 0): Address("10.0.0.1", 26000),
+            ServiceCoord("Worker", 1): Address("10.0.0.2", 26000),
+            ServiceCoord("Worker", 2): Address("10.0.0.1", 26001),
+        }
+        with patch.object(cms.service.Worker.config.async_config,
+                          "core_services", core_services), \
+                patch("os.sched_getaffinity", create=True,
+                      return_value={0, 1, 2, 3}), \
+                patch.object(cms.service.Worker.config, "worker_slots", 2), \
+                patch.object(cms.service.Worker.config, "worker_pin_slots",
+                             True):
+            slots = [Worker._create_slots(shard) for shard in range(3)]
+        self.assertEqual([slot.cpu for slot in slots[0]], [0, 1])
+        self.assertEqual([slot.cpu for slot in slots[1]], [0, 1])
+        self.assertEqual([slot.cpu for slot in slots[2]], [2, 3])
+        self.assertTrue(
+            {slot.first_box_id for slot in slots[0]}.isdisjoint(
+                {slot.first_box_id for slot in slots[2]}))
+
+    def test_create_slots_too_many(self):
+        """Box ids are not reused when there are too many slots."""
+        with self.assertRaises(ConfigError):
+            self.set_slots(100)
+
+    def test_execute_job_group_slots(self):
+        """Executes a job group concurrently in two slots."""
+        self.set_slots(2)
+        n_jobs = 4
+        job_groups, calls = TestWorker.new_job_groups([n_jobs])
+        task_type = FakeTaskType([0.01] * n_jobs)
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        result = JobGroup.import_from_dict(
+            self.service.execute_job_group(job_groups[0].export_to_dict()))
+
+        for job in result.jobs:
+            self.assertTrue(job.success)
+        cms.service.Worker.get_task_type.assert_has_calls(calls,
+                                                          any_order=True)
+        self.assertEquals(task_type.call_count, n_jobs)
+        self.assertEquals(task_type.max_concurrency, 2)
+        self.assertEquals(set(task_type.slots), set(self.service.slots))
+
+    def test_execute_job_group_slots_exception(self):
+        """An exception in a slot fails the whole group."""
+        self.set_slots(2)
+        job_groups, unused_calls = TestWorker.new_job_groups([3])
+        task_type = FakeTaskType([0.01, Exception(), 0.01])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        with self.assertRaises(JobException):
+            JobGroup.import_from_dict(
+                self.service.execute_job_group(job_groups[0].export_to_dict()))
+
+        # The worker is usable again.
+        job_groups, unused_calls = TestWorker.new_job_groups([2])
+        task_type.set_results([True, True])
+        task_type.index = 0
+        result = JobGroup.import_from_dict(
+            self.service.execute_job_group(job_groups[0].export_to_dict()))
+        for job in result.jobs:
+            self.assertTrue(job.success)
+
+    def test_execute_job_group_together(self):
+        """Evaluations with the same task type are executed at once."""
+        jobs, unused_calls = TestWorker.new_jobs(3)
+        for job in jobs:
+            job.task_type_parameters = "fake_parameters"
+        task_type = FakeTaskType([True] * 3)
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        result = JobGroup.import_from_dict(
+            self.service.execute_job_group(JobGroup(jobs).export_to_dict()))
+
+        for job in result.jobs:
+            self.assertTrue(job.success)
+        self.assertEqual(task_type.groups, [3])
+
+    def test_execute_job_group_together_tombstone(self):
+        """Only the jobs without results are executed again."""
+        jobs, unused_calls = TestWorker.new_jobs(3)
+        for job in jobs:
+            job.task_type_parameters = "fake_parameters"
+        task_type = FakeTaskType([True, TombstoneError(), True, True])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        result = JobGroup.import_from_dict(
+            self.service.execute_job_group(JobGroup(jobs).export_to_dict()))
+
+        for job in result.jobs:
+            self.assertTrue(job.success)
+        self.assertEqual(task_type.call_count, 4)
+
+    def test_execute_job_group_together_slots(self):
+        """Evaluations executed at once are split amongst the slots."""
+        self.set_slots(2)
+        jobs, unused_calls = TestWorker.new_jobs(4)
+        for job in jobs:
+            job.task_type_parameters = "fake_parameters"
+        task_type = FakeTaskType([0.01] * 4)
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        JobGroup.import_from_dict(
+            self.service.execute_job_group(JobGroup(jobs).export_to_dict()))
+
+        self.assertEqual(task_type.groups, [2, 2])
+        self.assertEquals(task_type.max_concurrency, 2)
+
     @staticmethod
     def new_jobs(number_of_jobs, prefix=None):
         prefix = prefix if prefix is not None else ""
@@ -296,9 +460,19 @@ class FakeTaskType(object):
         self.execute_results = execute_results
         self.index = 0
         self.call_count = 0
+        self.concurrency = 0
+        self.max_concurrency = 0
+        self.slots = []
+        self.groups = []
+
+    def evaluate_many(self, jobs, file_cacher):
+        self.groups.append(len(jobs))
+        for job in jobs:
+            self.execute_job(job, file_cacher)
 
     def execute_job(self, job, file_cacher):
         self.call_count += 1
+        self.slots.append(SandboxSlot.current())
         result = self.execute_results[self.index]
         self.index += 1
         if isinstance(result, bool):
@@ -310,7 +484,13 @@ class FakeTaskType(object):
         else:
             # Float: wait the number of seconds.
             job.success = True
-            gevent.sleep(result)
+            self.concurrency += 1
+            self.max_concurrency = max(self.max_concurrency,
+                                       self.concurrency)
+            try:
+                gevent.sleep(result)
+            finally:
+                self.concurrency -= 1
 
     def set_results(self, results):
         self.execute_results = results
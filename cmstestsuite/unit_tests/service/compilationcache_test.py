@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the compilation cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+import unittest
+
+from mock import Mock
+
+from cms.db import Executable, File, Manager
+from cms.grading.Job import CompilationJob, EvaluationJob
+from cms.service.compilationcache import CompilationCache
+
+
+class TestCompilationCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestCompilationCache, self).setUp()
+        self.cache = CompilationCache(2)
+        self.task_type = Mock()
+        self.task_type.get_compilation_commands.return_value = {
+            "L1": [["/bin/true", "foo.l1"]]}
+        self.file_cacher = Mock()
+
+    @staticmethod
+    def job(source_digest="digest of foo", language="L1"):
+        return CompilationJob(
+            task_type="Batch",
+            task_type_parameters=["alone", ["", ""], "diff"],
+            language=language,
+            files={"foo.%l": File(digest=source_digest, filename="foo.%l")},
+            managers={"grader.l1": Manager(digest="digest of grader",
+                                           filename="grader.l1")})
+
+    def compile(self, job, success=True):
+        """Look the job up, and simulate its compilation on a miss."""
+        if self.cache.lookup(job, self.task_type, self.file_cacher):
+            return True
+        job.success = True
+        job.compilation_success = success
+        job.text = ["Compilation succeeded"]
+        job.plus = {"execution_time": 1.0}
+        if success:
+            job.executables["foo"] = Executable("foo", "digest of exe")
+        self.cache.store(job, self.task_type)
+        return False
+
+    def test_hit(self):
+        self.assertFalse(self.compile(self.job()))
+        job = self.job()
+        self.assertTrue(self.compile(job))
+        self.assertTrue(job.success)
+        self.assertTrue(job.compilation_success)
+        self.assertEqual(job.text, ["Compilation succeeded"])
+        self.assertEqual(job.plus, {"execution_time": 1.0})
+        self.assertEqual(job.executables["foo"].digest, "digest of exe")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_different_inputs(self):
+        self.compile(self.job())
+        self.assertFalse(self.compile(self.job(source_digest="other")))
+        self.assertFalse(self.compile(self.job(language="L2")))
+        self.task_type.get_compilation_commands.return_value = {
+            "L1": [["/bin/true", "-O2", "foo.l1"]]}
+        self.assertFalse(self.compile(self.job()))
+
+    def test_failed_compilation(self):
+        self.assertFalse(self.compile(self.job(), success=False))
+        self.assertFalse(self.compile(self.job(), success=False))
+
+    def test_eviction(self):
+        self.compile(self.job("a"))
+        self.compile(self.job("b"))
+        self.compile(self.job("a"))
+        # "b" is the least recently used.
+        self.compile(self.job("c"))
+        self.assertTrue(self.compile(self.job("a")))
+        self.assertFalse(self.compile(self.job("b")))
+
+    def test_executable_deleted(self):
+        self.compile(self.job())
+        self.file_cacher.load.side_effect = KeyError()
+        self.assertFalse(self.compile(self.job()))
+
+    def test_not_cached(self):
+        job = self.job()
+        job.keep_sandbox = True
+        self.compile(job)
+        self.assertFalse(self.compile(job))
+        self.assertFalse(
+            self.cache.lookup(EvaluationJob(), self.task_type,
+                              self.file_cacher))
+
+        self.cache = CompilationCache(0)
+        self.compile(self.job())
+        self.assertFalse(self.compile(self.job()))
+
+
+if __name__ == "__main__":
+    unittest.main()
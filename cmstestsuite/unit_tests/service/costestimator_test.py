@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the operation cost estimator."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+import unittest
+
+from cms.service.costestimator import OperationCostEstimator
+from cms.service.esoperations import ESOperation
+
+
+def evaluation(object_id, dataset_id, testcase_codename):
+    return ESOperation(ESOperation.EVALUATION,
+                       object_id, dataset_id, testcase_codename)
+
+
+class TestOperationCostEstimator(unittest.TestCase):
+
+    def setUp(self):
+        super(TestOperationCostEstimator, self).setUp()
+        self.estimator = OperationCostEstimator(1.0, smoothing=0.5,
+                                                overhead=0.1)
+
+    def test_default(self):
+        self.assertEqual(self.estimator.estimate(evaluation(1, 1, "a")), 1.0)
+
+    def test_same_testcase(self):
+        """Evaluations of the same testcase share the estimate."""
+        self.estimator.update(evaluation(1, 1, "a"), 2.0)
+        self.assertAlmostEqual(
+            self.estimator.estimate(evaluation(2, 1, "a")), 2.1)
+
+    def test_moving_average(self):
+        self.estimator.update(evaluation(1, 1, "a"), 2.0)
+        self.estimator.update(evaluation(2, 1, "a"), 4.0)
+        self.assertAlmostEqual(
+            self.estimator.estimate(evaluation(3, 1, "a")), 3.1)
+
+    def test_unknown_testcase(self):
+        """Unknown testcases get the average of their dataset."""
+        self.estimator.update(evaluation(1, 1, "a"), 0.9)
+        self.estimator.update(evaluation(1, 1, "b"), 2.9)
+        self.estimator.update(evaluation(2, 1, "b"), 4.9)
+        self.assertAlmostEqual(
+            self.estimator.estimate(evaluation(2, 1, "c")), 2.5)
+        # Other datasets and types are not affected.
+        self.assertEqual(
+            self.estimator.estimate(evaluation(2, 2, "a")), 1.0)
+        self.assertEqual(
+            self.estimator.estimate(
+                ESOperation(ESOperation.COMPILATION, 2, 1)), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
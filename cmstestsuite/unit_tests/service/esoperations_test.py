@@ -35,8 +35,45 @@ import unittest
 from cmstestsuite.unit_tests.databasemixin import DatabaseMixin
 
 from cms.io.priorityqueue import PriorityQueue
-from cms.service.esoperations import ESOperation, get_submissions_operations, \
-    get_user_tests_operations
+from cms.service.esoperations import ESOperation, \
+    get_submissions_high_water_mark, get_submissions_operations, \
+    get_user_tests_high_water_mark, get_user_tests_operations
+
+
+class TestESOperation(unittest.TestCase):
+
+    def setUp(self):
+        super(TestESOperation, self).setUp()
+        self.operation = ESOperation(ESOperation.EVALUATION, 1, 2, "003")
+
+    def test_value(self):
+        other = ESOperation(ESOperation.EVALUATION, 1, 2, "003")
+        self.assertEqual(self.operation, other)
+        self.assertEqual(hash(self.operation), hash(other))
+        self.assertNotEqual(
+            self.operation, ESOperation(ESOperation.EVALUATION, 1, 2, "004"))
+        self.assertNotEqual(
+            ESOperation(ESOperation.COMPILATION, 1, 2),
+            ESOperation(ESOperation.USER_TEST_COMPILATION, 1, 2))
+        self.assertNotEqual(self.operation, None)
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.operation.object_id = 3
+        with self.assertRaises(AttributeError):
+            self.operation.other = 3
+        with self.assertRaises(AttributeError):
+            del self.operation.type_
+        self.operation.side_data = (1, None)
+        self.assertEqual(self.operation.side_data, (1, None))
+
+    def test_dict(self):
+        self.assertEqual(self.operation.to_dict(),
+                         {"type": ESOperation.EVALUATION,
+                          "object_id": 1, "dataset_id": 2,
+                          "testcase_codename": "003"})
+        self.assertEqual(ESOperation.from_dict(self.operation.to_dict()),
+                         self.operation)
 
 
 class TestESOperations(DatabaseMixin, unittest.TestCase):
@@ -248,6 +285,36 @@ class TestESOperations(DatabaseMixin, unittest.TestCase):
             set(get_submissions_operations(self.session, self.contest.id)),
             expected_operations)
 
+    def test_get_submissions_operations_high_water_mark(self):
+        """Test that only new or pending submissions are looked at."""
+        # An old submission without results (for example, because a
+        # dataset was enabled for judging) is missed.
+        self.add_submission(self.tasks[0], self.participation)
+
+        # An old submission with results to be evaluated is found.
+        old, old_results = self.add_submission_with_results(
+            self.tasks[0], self.participation, True)
+        self.session.flush()
+        expected_operations = set(
+            self.submission_evaluation_operation(result, codename)
+            for result in old_results if self.to_judge(result.dataset)
+            for codename in result.dataset.testcases)
+
+        high_water_mark = get_submissions_high_water_mark(self.session)
+        self.assertEqual(high_water_mark, old.id)
+
+        # A new submission is found.
+        submission = self.add_submission(self.tasks[0], self.participation)
+        self.session.flush()
+        expected_operations.update(set(
+            self.submission_compilation_operation(submission, dataset)
+            for dataset in submission.task.datasets if self.to_judge(dataset)))
+
+        self.assertEqual(
+            set(get_submissions_operations(self.session, self.contest.id,
+                                           high_water_mark)),
+            expected_operations)
+
     def submission_compilation_operation(
             self, submission, dataset, result=None):
         active_priority = PriorityQueue.PRIORITY_HIGH \
@@ -403,6 +470,29 @@ class TestESOperations(DatabaseMixin, unittest.TestCase):
             set(get_user_tests_operations(self.session, self.contest.id)),
             expected_operations)
 
+    def test_get_user_tests_operations_high_water_mark(self):
+        """Test that only new or pending user tests are looked at."""
+        self.add_user_test(self.tasks[0], self.participation)
+        old, old_results = self.add_user_test_with_results(True)
+        self.session.flush()
+        expected_operations = set(
+            self.user_test_evaluation_operation(result)
+            for result in old_results if self.to_judge(result.dataset))
+
+        high_water_mark = get_user_tests_high_water_mark(self.session)
+        self.assertEqual(high_water_mark, old.id)
+
+        user_test = self.add_user_test(self.tasks[0], self.participation)
+        self.session.flush()
+        expected_operations.update(set(
+            self.user_test_compilation_operation(user_test, dataset)
+            for dataset in user_test.task.datasets if self.to_judge(dataset)))
+
+        self.assertEqual(
+            set(get_user_tests_operations(self.session, self.contest.id,
+                                          high_water_mark)),
+            expected_operations)
+
     def user_test_compilation_operation(self, user_test, dataset, result=None):
         active_priority = PriorityQueue.PRIORITY_HIGH \
             if result is None or result.compilation_tries == 0 \
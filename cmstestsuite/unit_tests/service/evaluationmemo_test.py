@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the evaluation memo."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+import unittest
+
+from cms.db import Executable, Manager
+from cms.grading.Job import CompilationJob, EvaluationJob
+from cms.service.esoperations import ESOperation
+from cms.service.evaluationmemo import EvaluationMemo
+
+
+class TestEvaluationMemo(unittest.TestCase):
+
+    def setUp(self):
+        super(TestEvaluationMemo, self).setUp()
+        self.memo = EvaluationMemo(2)
+
+    @staticmethod
+    def job(executable_digest="digest of exe", input_="digest of input",
+            time_limit=1.0, type_=ESOperation.EVALUATION, dataset_id=1):
+        return EvaluationJob(
+            operation=ESOperation(type_, 1, dataset_id, "001"),
+            task_type="Batch",
+            task_type_parameters=["alone", ["", ""], "comparator"],
+            language="L1",
+            managers={"checker": Manager(digest="digest of checker",
+                                         filename="checker")},
+            executables={"foo": Executable("foo", executable_digest)},
+            input=input_,
+            output="digest of output",
+            time_limit=time_limit,
+            memory_limit=256 * 1024 * 1024)
+
+    def evaluate(self, job, success=True):
+        """Look the job up, and simulate its evaluation on a miss."""
+        if self.memo.lookup(job):
+            return True
+        job.success = success
+        job.outcome = "1.0"
+        job.text = ["Output is correct"]
+        job.plus = {"execution_time": 0.5}
+        job.shard = 3
+        job.sandboxes = ["/tmp/box"]
+        self.memo.store(job)
+        return False
+
+    def test_hit(self):
+        self.assertFalse(self.evaluate(self.job()))
+        # Another dataset with the same inputs.
+        job = self.job(dataset_id=2)
+        self.assertTrue(self.evaluate(job))
+        self.assertTrue(job.success)
+        self.assertEqual(job.outcome, "1.0")
+        self.assertEqual(job.text, ["Output is correct"])
+        self.assertEqual(job.plus, {"execution_time": 0.5})
+        self.assertEqual(job.shard, 3)
+        self.assertEqual(job.sandboxes, ["/tmp/box"])
+        self.assertEqual((self.memo.hits, self.memo.misses), (1, 1))
+
+    def test_different_inputs(self):
+        self.evaluate(self.job())
+        self.assertFalse(self.evaluate(self.job(executable_digest="other")))
+        self.assertFalse(self.evaluate(self.job(input_="other")))
+        self.assertFalse(self.evaluate(self.job(time_limit=2.0)))
+        job = self.job()
+        job.managers["checker"] = Manager(digest="other", filename="checker")
+        self.assertFalse(self.evaluate(job))
+        job = self.job()
+        job.task_type_parameters = ["alone", ["", ""], "diff"]
+        self.assertFalse(self.evaluate(job))
+
+    def test_failed_evaluation(self):
+        self.assertFalse(self.evaluate(self.job(), success=False))
+        self.assertFalse(self.evaluate(self.job(), success=False))
+
+    def test_eviction(self):
+        self.evaluate(self.job("a"))
+        self.evaluate(self.job("b"))
+        self.evaluate(self.job("a"))
+        # "b" is the least recently used.
+        self.evaluate(self.job("c"))
+        self.assertTrue(self.evaluate(self.job("a")))
+        self.assertFalse(self.evaluate(self.job("b")))
+
+    def test_not_memoized(self):
+        job = self.job(type_=ESOperation.USER_TEST_EVALUATION)
+        self.evaluate(job)
+        self.assertFalse(self.evaluate(job))
+        self.assertFalse(self.memo.lookup(CompilationJob(
+            operation=ESOperation(ESOperation.COMPILATION, 1, 1))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the queue journal."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime
+
+from mock import patch
+
+from cms.service.esoperations import ESOperation
+from cms.service.queuejournal import QueueJournal
+
+
+class TestQueueJournal(unittest.TestCase):
+
+    def setUp(self):
+        super(TestQueueJournal, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.journal = self.reopen()
+        self.op1 = ESOperation(ESOperation.COMPILATION, 1, 1)
+        self.op2 = ESOperation(ESOperation.EVALUATION, 1, 1, "000")
+        self.op3 = ESOperation(ESOperation.USER_TEST_COMPILATION, 2, 1)
+        self.timestamp = datetime(2018, 1, 1, 12, 30)
+
+    def reopen(self, contest_id=1):
+        journal = QueueJournal(self.directory, contest_id)
+        self.entries = sorted(journal.load(), key=lambda e: e[1])
+        self.addCleanup(journal.close)
+        return journal
+
+    def test_empty(self):
+        self.assertEqual(self.entries, [])
+        self.assertIsNone(self.journal.high_water_marks)
+
+    def test_replay(self):
+        self.journal.enqueued(self.op1, 1, self.timestamp)
+        self.journal.enqueued(self.op2, 2, self.timestamp)
+        self.journal.enqueued(self.op3, 3, None)
+        self.journal.dispatched([self.op1, self.op2], 4)
+        self.journal.completed([self.op1])
+        self.journal.set_high_water_marks(10, 20, 1000.0)
+
+        self.reopen()
+        self.assertEqual(self.entries, [
+            (self.op2, 2, self.timestamp, 4),
+            (self.op3, 3, None, None),
+        ])
+        self.assertEqual(self.journal.high_water_marks, [10, 20])
+        self.assertEqual(self.journal.full_sweep_time, 1000.0)
+
+    def test_enqueued_again(self):
+        self.journal.enqueued(self.op1, 1, self.timestamp)
+        self.journal.dispatched([self.op1], 4)
+        # The worker was lost, and the operation put back in the queue.
+        self.journal.enqueued(self.op1, 1, self.timestamp)
+        self.reopen()
+        self.assertEqual(self.entries, [(self.op1, 1, self.timestamp, None)])
+
+    def test_completed_unknown(self):
+        self.journal.completed([self.op1])
+        with io.open(os.path.join(self.directory, "journal.log"), "rt",
+                     encoding="utf-8") as f:
+            self.assertEqual(f.read(), "")
+
+    def test_snapshot(self):
+        with patch.object(QueueJournal, "SNAPSHOT_THRESHOLD", 3):
+            self.journal.enqueued(self.op1, 1, self.timestamp)
+            self.journal.enqueued(self.op2, 2, self.timestamp)
+            self.journal.completed([self.op1])
+            # The log was compacted into the snapshot.
+            self.assertEqual(
+                os.path.getsize(os.path.join(self.directory, "journal.log")),
+                0)
+            self.journal.enqueued(self.op3, 3, self.timestamp)
+
+        self.reopen()
+        self.assertEqual(self.entries, [
+            (self.op2, 2, self.timestamp, None),
+            (self.op3, 3, self.timestamp, None),
+        ])
+
+    def test_truncated_log(self):
+        self.journal.enqueued(self.op1, 1, self.timestamp)
+        self.journal.close()
+        with io.open(os.path.join(self.directory, "journal.log"), "at",
+                     encoding="utf-8") as f:
+            f.write("{\"type\": \"enq")
+
+        self.reopen()
+        self.assertEqual(self.entries, [(self.op1, 1, self.timestamp, None)])
+
+    def test_writes_bytes(self):
+        # What json.dumps returns is bytes on Python 2, which files
+        # opened in text mode do not accept: everything must be encoded.
+        writes = []
+        real_open = io.open
+
+        class CheckedFile(object):
+            def __init__(self, f):
+                self._f = f
+
+            def __getattr__(self, name):
+                return getattr(self._f, name)
+
+            def __iter__(self):
+                return iter(self._f)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return self._f.__exit__(*args)
+
+            def write(self, data):
+                writes.append(data)
+                return self._f.write(data)
+
+        def checked_open(*args, **kwargs):
+            return CheckedFile(real_open(*args, **kwargs))
+
+        with patch("cms.service.queuejournal.io.open", checked_open):
+            self.journal.close()
+            self.journal = self.reopen()
+            self.journal.enqueued(self.op1, 1, self.timestamp)
+            self.journal.set_high_water_marks(10, 20, 1000.0)
+            self.journal.snapshot()
+
+        self.assertGreater(len(writes), 0)
+        for data in writes:
+            self.assertIsInstance(data, bytes)
+        self.journal = self.reopen()
+        self.assertEqual(self.entries, [(self.op1, 1, self.timestamp, None)])
+
+    def test_other_contest(self):
+        self.journal.enqueued(self.op1, 1, self.timestamp)
+        self.journal.set_high_water_marks(10, 20, 1000.0)
+        self.journal.snapshot()
+
+        self.journal = self.reopen(contest_id=2)
+        self.assertEqual(self.entries, [])
+        self.assertIsNone(self.journal.high_water_marks)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -34,7 +34,8 @@ import unittest
 
 from cmstestsuite.unit_tests.databasemixin import DatabaseMixin
 
-from cms.service.scoringoperations import ScoringOperation, get_operations
+from cms.service.scoringoperations import ScoringOperation, \
+    get_operations, get_scoring_shard
 
 
 class TestScoringOperations(DatabaseMixin, unittest.TestCase):
@@ -145,6 +146,32 @@ class TestScoringOperations(DatabaseMixin, unittest.TestCase):
             set(get_operations(self.session)),
             expected_operations)
 
+    def test_get_operations_sharded(self):
+        """Test that each shard gets the submissions of its partition."""
+        participations = [self.participation] + [
+            self.add_participation(contest=self.contest) for _ in range(3)]
+        submissions = []
+        for participation in participations:
+            submission, _ = self.add_submission_with_results(
+                self.tasks[0], participation, False)
+            submissions.append(submission)
+        self.session.flush()
+
+        all_operations = set(get_operations(self.session))
+        shards = 3
+        by_shard = [set(get_operations(self.session, shard, shards))
+                    for shard in range(shards)]
+        self.assertEqual(set().union(*by_shard), all_operations)
+        self.assertEqual(sum(len(ops) for ops in by_shard),
+                         len(all_operations))
+        for submission in submissions:
+            shard = get_scoring_shard(submission.participation_id, shards)
+            for dataset in submission.task.datasets:
+                if self.to_judge(dataset):
+                    self.assertIn(
+                        self._scoring_operation(submission, dataset),
+                        by_shard[shard])
+
     def _scoring_operation(self, submission, dataset):
         return (ScoringOperation(submission.id, dataset.id),
                 submission.timestamp)
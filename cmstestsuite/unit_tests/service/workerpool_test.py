@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the worker pool."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from future.builtins.disabled import *  # noqa
+from future.builtins import *  # noqa
+
+import unittest
+
+from mock import Mock, patch
+
+from cms import Address, ServiceCoord
+from cms.service.esoperations import ESOperation
+from cms.service.workerpool import IndexedSet, WorkerPool
+
+
+class TestIndexedSet(unittest.TestCase):
+
+    def test_add_discard(self):
+        s = IndexedSet()
+        for i in range(5):
+            s.add(i)
+        s.add(3)
+        self.assertEqual(len(s), 5)
+        s.discard(1)
+        s.discard(4)
+        s.discard(7)
+        self.assertEqual(sorted(s), [0, 2, 3])
+        self.assertIn(3, s)
+        self.assertNotIn(1, s)
+        self.assertIn(s.choice(), [0, 2, 3])
+
+    def test_choice_empty(self):
+        with self.assertRaises(IndexError):
+            IndexedSet().choice()
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    # Hosts of the workers, by shard.
+    HOSTS = ["10.0.0.1", "10.0.0.1", "10.0.0.2"]
+
+    def setUp(self):
+        super(TestWorkerPool, self).setUp()
+        self.service = Mock()
+        self.service.contest_id = None
+        self.service.connect_to.side_effect = self.connect_to
+        self.workers = {}
+        self.pool = WorkerPool(self.service)
+        for shard in range(len(TestWorkerPool.HOSTS)):
+            self.pool.add_worker(ServiceCoord("Worker", shard))
+
+        patcher = patch("cms.service.workerpool.SessionGen")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("cms.service.workerpool.JobGroup")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect_to(self, coord, on_connect=None, on_disconnect=None):
+        worker = Mock()
+        worker.connected = True
+        worker.remote_address = Address(TestWorkerPool.HOSTS[coord.shard],
+                                        28000 + coord.shard)
+        worker.on_disconnect = on_disconnect
+        self.workers[coord.shard] = worker
+        return worker
+
+    @staticmethod
+    def operations(n):
+        return [ESOperation(ESOperation.EVALUATION, i, 1, "%d" % i)
+                for i in range(n)]
+
+    def test_acquire_all(self):
+        operations = TestWorkerPool.operations(4)
+        shards = set()
+        for operation in operations[:3]:
+            shards.add(self.pool.acquire_worker([operation]))
+        self.assertEqual(shards, set(range(3)))
+        self.assertIsNone(self.pool.acquire_worker(operations[3:]))
+        for operation in operations[:3]:
+            self.assertIn(operation, self.pool)
+
+        self.pool.release_worker(1)
+        self.assertEqual(self.pool.acquire_worker(operations[3:]), 1)
+
+    def test_disconnected(self):
+        self.workers[0].connected = False
+        self.workers[1].connected = False
+        # Disconnection handlers might not have been called yet.
+        self.assertEqual(
+            self.pool.acquire_worker(TestWorkerPool.operations(1)), 2)
+        self.assertIsNone(
+            self.pool.acquire_worker(TestWorkerPool.operations(1)))
+
+        self.workers[0].connected = True
+        self.pool.on_worker_connected(ServiceCoord("Worker", 0))
+        self.assertEqual(
+            self.pool.acquire_worker(TestWorkerPool.operations(1)), 0)
+
+    def test_check_connections(self):
+        operations = TestWorkerPool.operations(1)
+        shard = self.pool.acquire_worker(operations)
+        self.assertEqual(self.pool.check_connections(), [])
+        self.workers[shard].connected = False
+        self.workers[shard].on_disconnect()
+        self.assertEqual(self.pool.check_connections(), operations)
+        self.assertNotIn(operations[0], self.pool)
+
+    def test_preferred_hosts(self):
+        for _ in range(2):
+            self.assertIn(
+                self.pool.acquire_worker(TestWorkerPool.operations(1),
+                                         preferred_hosts=["10.0.0.1"]),
+                [0, 1])
+        # No more workers on the preferred host, but others are fine.
+        self.assertEqual(
+            self.pool.acquire_worker(TestWorkerPool.operations(1),
+                                     preferred_hosts=["10.0.0.1"]),
+            2)
+
+    def test_preferred_hosts_order(self):
+        self.assertEqual(
+            self.pool.acquire_worker(
+                TestWorkerPool.operations(1),
+                preferred_hosts=["10.0.0.3", "10.0.0.2", "10.0.0.1"]),
+            2)
+
+    def test_warm_hosts(self):
+        self.assertEqual(self.pool.warm_hosts(1), [])
+        operations = TestWorkerPool.operations(2)
+        shard = self.pool.acquire_worker(operations)
+        self.assertEqual(self.pool.warm_hosts(1),
+                         [TestWorkerPool.HOSTS[shard]])
+        self.pool.release_worker(shard)
+
+        # Later operations on the dataset go to the same host.
+        for _ in range(3):
+            shard = self.pool.acquire_worker(
+                operations, preferred_hosts=self.pool.warm_hosts(1))
+            self.assertEqual(self.pool.warm_hosts(1),
+                             [TestWorkerPool.HOSTS[shard]])
+            self.pool.release_worker(shard)
+
+    def test_warm_hosts_evicted(self):
+        host = TestWorkerPool.HOSTS[2]
+        shard = self.pool.acquire_worker(TestWorkerPool.operations(1),
+                                         preferred_hosts=[host])
+        self.pool.release_worker(shard)
+        for dataset_id in range(2, WorkerPool.CACHED_DATASETS_PER_HOST + 2):
+            shard = self.pool.acquire_worker(
+                [ESOperation(ESOperation.COMPILATION, 1, dataset_id)],
+                preferred_hosts=[host])
+            self.pool.release_worker(shard)
+        self.assertEqual(self.pool.warm_hosts(1), [])
+        self.assertEqual(self.pool.warm_hosts(2), [host])
+
+    def test_disable_enable(self):
+        self.pool.disable_worker(0)
+        self.pool.disable_worker(1)
+        self.assertEqual(self.pool.total_slots(), 1)
+        self.assertEqual(
+            self.pool.acquire_worker(TestWorkerPool.operations(1)), 2)
+        self.assertIsNone(
+            self.pool.acquire_worker(TestWorkerPool.operations(1)))
+
+        self.pool.enable_worker(1)
+        self.assertEqual(self.pool.total_slots(), 2)
+        self.assertEqual(
+            self.pool.acquire_worker(TestWorkerPool.operations(1)), 1)
+
+    def test_check_timeouts(self):
+        operations = TestWorkerPool.operations(1)
+        shard = self.pool.acquire_worker(operations)
+        self.assertEqual(self.pool.check_timeouts(), [])
+        with patch.object(WorkerPool, "WORKER_TIMEOUT",
+                          WorkerPool.WORKER_TIMEOUT * 0):
+            self.assertEqual(self.pool.check_timeouts(), operations)
+        self.workers[shard].quit.assert_called_once()
+        # The worker stays out of the pool.
+        for _ in range(2):
+            self.assertNotEqual(
+                self.pool.acquire_worker(TestWorkerPool.operations(1)),
+                shard)
+        self.assertIsNone(
+            self.pool.acquire_worker(TestWorkerPool.operations(1)))
+
+
+if __name__ == "__main__":
+    unittest.main()